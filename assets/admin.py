@@ -6,6 +6,7 @@ from .models import (
     Departement, Categorie, Materiel, Client, Attribution, HistoriqueAttribution, 
     Alerte, Salle, AuditLog, NotificationLog, NotificationPreferences, WhatsAppConfig
 )
+from .services import CompteurAlertesService
 
 
 @admin.register(Departement)
@@ -255,7 +256,7 @@ class AlerteAdmin(admin.ModelAdmin):
     list_display = ('get_type_icon', 'type_alerte', 'get_materiel_display', 'get_client_display', 'departement', 'get_severite_color', 'reglementee', 'date_creation')
     list_filter = ('type_alerte', 'severite', 'departement', 'reglementee', 'date_creation')
     search_fields = ('description', 'materiel__asset_id', 'materiel__nom', 'attribution__client__nom', 'departement__nom')
-    readonly_fields = ('date_creation', 'materiel', 'attribution', 'departement')
+    readonly_fields = ('date_creation', 'materiel', 'attribution', 'departement', 'nom_equipement')
     date_hierarchy = 'date_creation'
     ordering = ('-date_creation',)
     
@@ -285,7 +286,7 @@ class AlerteAdmin(admin.ModelAdmin):
             'fields': ('type_alerte', 'severite')
         }),
         ('Objet', {
-            'fields': ('materiel', 'attribution', 'departement')
+            'fields': ('materiel', 'attribution', 'departement', 'nom_equipement')
         }),
         ('Contenu', {
             'fields': ('description',)
@@ -302,13 +303,20 @@ class AlerteAdmin(admin.ModelAdmin):
     actions = ['marquer_comme_reglementee', 'marquer_comme_non_reglementee']
 
     def marquer_comme_reglementee(self, request, queryset):
-        updated = queryset.update(reglementee=True)
+        updated = CompteurAlertesService.regler(queryset, reglementee=True)
         self.message_user(request, f'{updated} alerte(s) marquée(s) comme réglementée(s).')
     marquer_comme_reglementee.short_description = "✓ Marquer comme réglementées"
     
     def marquer_comme_non_reglementee(self, request, queryset):
-        updated = queryset.update(reglementee=False)
+        reglees = queryset.filter(reglementee=True).count()
+        updated = CompteurAlertesService.regler(queryset, reglementee=False)
         self.message_user(request, f'{updated} alerte(s) réouvertes.')
+        if reglees > updated:
+            self.message_user(
+                request,
+                f'{reglees - updated} alerte(s) laissée(s) réglée(s): une alerte identique est déjà ouverte.',
+                level=messages.WARNING,
+            )
     marquer_comme_non_reglementee.short_description = "✕ Rouvrir les alertes"
     
     def has_add_permission(self, request):
@@ -98,7 +98,7 @@ class AlerteSerializer(serializers.ModelSerializer):
         model = Alerte
         fields = [
             'id', 'type_alerte', 'severite', 'materiel', 'attribution',
-            'departement', 'description', 'reglementee', 'date_creation'
+            'departement', 'nom_equipement', 'description', 'reglementee', 'date_creation'
         ]
 
 
@@ -0,0 +1,191 @@
+# assets/archive_audit_service.py
+"""
+Archivage des journaux d'audit
+
+Les lignes d'AuditLog plus anciennes que AUDIT_ARCHIVE_APRES_JOURS sont déplacées dans
+des segments JSONL compressés (gzip) sous AUDIT_ARCHIVE_DIR: un segment par type de
+contenu et par lot d'au plus TAILLE_SEGMENT lignes. Un segment est écrit une seule fois
+puis n'est plus modifié; il est enregistré dans SegmentAudit avec sa période, son type
+de contenu et sa plage d'identifiants, dans la transaction qui supprime les lignes
+archivées de la table. Les vues des rapports lisent les segments quand une ligne n'est
+plus dans la table.
+
+Paramètres (settings, optionnels):
+    AUDIT_ARCHIVE_DIR           répertoire des segments (défaut: BASE_DIR/archives/audit)
+    AUDIT_ARCHIVE_APRES_JOURS   âge en jours au-delà duquel une ligne est archivée (défaut: 180)
+"""
+import os
+import gzip
+import json
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import AuditLog, SegmentAudit
+
+logger = logging.getLogger(__name__)
+
+
+class ArchivageAuditService:
+    """Écriture et lecture des segments d'archive du journal d'audit"""
+
+    TAILLE_SEGMENT = 5000
+    CHAMPS = (
+        'id', 'user_id', 'action', 'content_type_id', 'object_id', 'object_repr',
+        'changes', 'ip_address', 'metadata', 'timestamp',
+    )
+
+    @staticmethod
+    def repertoire():
+        return str(getattr(settings, 'AUDIT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archives', 'audit')))
+
+    @staticmethod
+    def age():
+        return timedelta(days=getattr(settings, 'AUDIT_ARCHIVE_APRES_JOURS', 180))
+
+    @classmethod
+    def archiver(cls, avant=None, taille=None):
+        """
+        Archive les lignes antérieures à `avant` (par défaut: maintenant moins l'âge configuré).
+        Retourne (nombre de segments écrits, nombre de lignes archivées).
+        """
+        avant = avant or timezone.now() - cls.age()
+        taille = taille or cls.TAILLE_SEGMENT
+        anciennes = AuditLog.objects.filter(timestamp__lt=avant).order_by()
+        segments = lignes = 0
+        for content_type_id in list(anciennes.values_list('content_type_id', flat=True).distinct()):
+            du_type = anciennes.filter(content_type_id=content_type_id)
+            while True:
+                lot = list(du_type.order_by('id').values(*cls.CHAMPS)[:taille])
+                if not lot:
+                    break
+                cls._ecrire_segment(du_type, content_type_id, lot)
+                segments += 1
+                lignes += len(lot)
+        return segments, lignes
+
+    @classmethod
+    def _ecrire_segment(cls, du_type, content_type_id, lot):
+        """Écrit le segment d'un lot (ordonné par id), puis l'enregistre et supprime ses lignes"""
+        premier, dernier = lot[0]['id'], lot[-1]['id']
+        debut = min(ligne['timestamp'] for ligne in lot)
+        fin = max(ligne['timestamp'] for ligne in lot)
+        relatif = os.path.join(f"{fin:%Y}", f"{fin:%m}", f"ct{content_type_id or 0}_{premier}-{dernier}.jsonl.gz")
+        chemin = os.path.join(cls.repertoire(), relatif)
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+
+        # Écriture dans un fichier temporaire renommé ensuite: un segment visible est toujours complet
+        temporaire = chemin + '.tmp'
+        with gzip.open(temporaire, 'wt', encoding='utf-8') as f:
+            for ligne in lot:
+                f.write(json.dumps({**ligne, 'timestamp': ligne['timestamp'].isoformat()}, ensure_ascii=False))
+                f.write('\n')
+        os.replace(temporaire, chemin)
+
+        try:
+            with transaction.atomic():
+                SegmentAudit.objects.create(
+                    content_type_id=content_type_id,
+                    fichier=relatif,
+                    date_debut=debut,
+                    date_fin=fin,
+                    premier_id=premier,
+                    dernier_id=dernier,
+                    nb_lignes=len(lot),
+                )
+                # Les identifiants croissent: les lignes du type jusqu'à `dernier` sont exactement le lot
+                du_type.filter(id__lte=dernier).delete()
+        except Exception:
+            os.remove(chemin)
+            raise
+        logger.info(f"Segment d'audit {relatif}: {len(lot)} ligne(s) archivée(s)")
+
+    @classmethod
+    def lire(cls, segment):
+        """Entrées d'un segment, en instances AuditLog non enregistrées marquées `archive`"""
+        chemin = os.path.join(cls.repertoire(), segment.fichier)
+        try:
+            with gzip.open(chemin, 'rt', encoding='utf-8') as f:
+                for ligne in f:
+                    valeurs = json.loads(ligne)
+                    valeurs['timestamp'] = parse_datetime(valeurs['timestamp'])
+                    entree = AuditLog(**valeurs)
+                    entree.archive = True
+                    yield entree
+        except FileNotFoundError:
+            logger.error(f"Segment d'audit introuvable: {chemin}")
+
+    @staticmethod
+    def _resoudre(entrees):
+        """Rattache utilisateurs et types de contenu aux entrées (une requête pour les utilisateurs)"""
+        utilisateurs = User.objects.in_bulk({e.user_id for e in entrees if e.user_id})
+        for entree in entrees:
+            # Utilisateur supprimé depuis l'archivage: l'entrée est affichée comme "System"
+            entree.user = utilisateurs.get(entree.user_id)
+            if entree.content_type_id:
+                try:
+                    entree.content_type = ContentType.objects.get_for_id(entree.content_type_id)
+                except ContentType.DoesNotExist:
+                    entree.content_type = None
+        return entrees
+
+    @classmethod
+    def trouver(cls, pk):
+        """Entrée archivée d'identifiant `pk`, ou None"""
+        for segment in SegmentAudit.objects.filter(premier_id__lte=pk, dernier_id__gte=pk):
+            for entree in cls.lire(segment):
+                if entree.pk == pk:
+                    return cls._resoudre([entree])[0]
+        return None
+
+    @classmethod
+    def entrees(cls, limite, action=None, content_type=None, user=None, avant=None):
+        """
+        Jusqu'à `limite` entrées archivées, des plus récentes aux plus anciennes, filtrées
+        comme report_list (action, nom du modèle, nom d'utilisateur contenant `user`) et
+        antérieures au curseur `avant` = (timestamp, id) s'il est fourni.
+        Les segments sont lus par date de fin décroissante, et seulement tant qu'ils peuvent
+        contenir des entrées plus récentes que les `limite` déjà retenues.
+        """
+        if limite <= 0:
+            return []
+        segments = SegmentAudit.objects.order_by('-date_fin')
+        if avant:
+            segments = segments.filter(date_debut__lte=avant[0])
+        if content_type:
+            segments = segments.filter(content_type__model=content_type)
+        utilisateurs = None
+        if user:
+            utilisateurs = set(User.objects.filter(username__icontains=user).values_list('id', flat=True))
+            if not utilisateurs:
+                return []
+
+        retenues = []
+        for segment in segments.iterator():
+            if len(retenues) >= limite and segment.date_fin < retenues[-1].timestamp:
+                break
+            retenues.extend(
+                e for e in cls.lire(segment)
+                if (not action or e.action == action)
+                and (utilisateurs is None or e.user_id in utilisateurs)
+                and (avant is None or (e.timestamp, e.pk) < avant)
+            )
+            retenues.sort(key=lambda e: (e.timestamp, e.pk), reverse=True)
+            del retenues[limite:]
+        return cls._resoudre(retenues)
+
+    @classmethod
+    def historique(cls, content_type_id, object_id):
+        """Entrées archivées d'un objet, des plus récentes aux plus anciennes"""
+        entrees = [
+            e
+            for segment in SegmentAudit.objects.filter(content_type_id=content_type_id)
+            for e in cls.lire(segment)
+            if e.object_id == str(object_id)
+        ]
+        entrees.sort(key=lambda e: (e.timestamp, e.pk), reverse=True)
+        return cls._resoudre(entrees)
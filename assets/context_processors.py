@@ -2,7 +2,7 @@
 """
 Context processors pour les alertes
 """
-from .services import AlerteService
+from .services import CompteurAlertesService
 
 
 def alertes_context(request):
@@ -14,13 +14,11 @@ def alertes_context(request):
         departement = request.departement
         profil = request.profil_utilisateur
         
-        # Super Admin peut voir toutes les alertes
+        # Lecture des compteurs matérialisés (Super Admin: tous les départements)
         if profil and profil.role == 'SUPER_ADMIN':
-            nombre_alertes = AlerteService.get_alertes_non_reglementees().count()
-            nombre_alertes_critiques = AlerteService.get_nombre_alertes_critiques()
+            nombre_alertes, nombre_alertes_critiques = CompteurAlertesService.compter()
         else:
-            nombre_alertes = AlerteService.get_alertes_non_reglementees(departement).count()
-            nombre_alertes_critiques = AlerteService.get_nombre_alertes_critiques(departement)
+            nombre_alertes, nombre_alertes_critiques = CompteurAlertesService.compter(departement)
         
         return {
             'nombre_alertes': nombre_alertes,
@@ -0,0 +1,109 @@
+# assets/dashboard_service.py
+"""
+Instantané (snapshot) du tableau de bord
+
+Toutes les statistiques par département sont calculées par une seule requête groupée
+sur les niveaux de stock, plus une lecture des compteurs d'alertes. Le résultat est mis
+en cache par périmètre (global pour le Super Admin, sinon par département) et invalidé
+par les signaux dès qu'un matériel ou une alerte change; le scheduler le réchauffe
+périodiquement.
+"""
+import time
+import logging
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Alerte, Departement, CompteurAlertes
+
+logger = logging.getLogger(__name__)
+
+
+class DashboardService:
+    """Calcul, mise en cache et invalidation des instantanés du tableau de bord"""
+
+    CLE_GENERATION = 'dashboard:generation'
+    DUREE_CACHE = 300  # secondes, filet de sécurité en plus de l'invalidation par signaux
+
+    @classmethod
+    def _generation(cls):
+        """Génération courante des instantanés; changer sa valeur invalide tous les instantanés"""
+        generation = cache.get(cls.CLE_GENERATION)
+        if generation is None:
+            generation = time.time_ns()
+            cache.set(cls.CLE_GENERATION, generation, None)
+        return generation
+
+    @classmethod
+    def _cle(cls, generation, departement_id=None):
+        perimetre = departement_id if departement_id is not None else 'global'
+        return f"dashboard:snapshot:{generation}:{perimetre}"
+
+    @staticmethod
+    def _lignes_departements(departement_id=None):
+        """Une ligne de totaux par département: une requête groupée sur NiveauStock + une lecture des compteurs"""
+        departements = Departement.objects.order_by('nom')
+        compteurs = CompteurAlertes.objects.filter(severite=Alerte.SEVERITE_CRITICAL)
+        if departement_id is not None:
+            departements = departements.filter(pk=departement_id)
+            compteurs = compteurs.filter(departement_id=departement_id)
+
+        alertes_critiques = dict(compteurs.values_list('departement_id', 'nombre'))
+        lignes = departements.annotate(
+            total=Coalesce(Sum('niveaux_stock__total'), 0),
+            # Statut disponible, quel que soit l'état technique (la liste des matériels compte les fonctionnels)
+            disponible=Coalesce(Sum('niveaux_stock__statut_disponible'), 0),
+            attribue=Coalesce(Sum('niveaux_stock__attribue'), 0),
+            defectueux=Coalesce(Sum('niveaux_stock__defectueux'), 0),
+        ).values('id', 'code', 'nom', 'total', 'disponible', 'attribue', 'defectueux')
+        return [
+            dict(ligne, alertes_critiques=alertes_critiques.get(ligne['id'], 0))
+            for ligne in lignes
+        ]
+
+    @staticmethod
+    def _assembler(lignes):
+        """Construit l'instantané (JSON sérialisable) à partir des lignes par département"""
+        return {
+            'genere_le': timezone.now().isoformat(),
+            'total_materiel': sum(ligne['total'] for ligne in lignes),
+            'materiel_disponible': sum(ligne['disponible'] for ligne in lignes),
+            'materiel_attribue': sum(ligne['attribue'] for ligne in lignes),
+            'materiel_defectueux': sum(ligne['defectueux'] for ligne in lignes),
+            'nombre_alertes_critiques': sum(ligne['alertes_critiques'] for ligne in lignes),
+            'departements': lignes,
+        }
+
+    @classmethod
+    def get_snapshot(cls, departement=None):
+        """
+        Retourne l'instantané du tableau de bord, global si `departement` est None,
+        sinon limité à ce département. Calculé puis mis en cache en cas d'absence.
+        """
+        departement_id = departement.pk if departement else None
+        cle = cls._cle(cls._generation(), departement_id)
+        snapshot = cache.get(cle)
+        if snapshot is None:
+            snapshot = cls._assembler(cls._lignes_departements(departement_id))
+            cache.set(cle, snapshot, cls.DUREE_CACHE)
+        return snapshot
+
+    @classmethod
+    def rafraichir(cls):
+        """
+        Recalcule l'instantané global et en dérive ceux de chaque département,
+        soit deux requêtes pour réchauffer tout le cache. Appelé par le scheduler.
+        """
+        generation = cls._generation()
+        lignes = cls._lignes_departements()
+        instantanes = {cls._cle(generation): cls._assembler(lignes)}
+        for ligne in lignes:
+            instantanes[cls._cle(generation, ligne['id'])] = cls._assembler([ligne])
+        cache.set_many(instantanes, cls.DUREE_CACHE)
+        return len(instantanes)
+
+    @classmethod
+    def invalider(cls):
+        """Invalide tous les instantanés après la validation de la transaction en cours"""
+        transaction.on_commit(lambda: cache.set(cls.CLE_GENERATION, time.time_ns(), None))
@@ -2,7 +2,7 @@
 """
 Service d'envoi d'emails pour les alertes et les notifications
 """
-from django.core.mail import send_mail, EmailMultiAlternatives
+from django.core.mail import send_mail, get_connection, EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.utils.html import strip_tags
@@ -11,10 +11,91 @@ from datetime import datetime
 from .models import Alerte, NotificationLog, Attribution
 from users.models import ProfilUtilisateur
 import logging
+import smtplib
+import uuid
+import time
 
 logger = logging.getLogger(__name__)
 
 
+class ConnexionEmailPartagee:
+    """
+    Connexion SMTP unique réutilisée pour tout un lot d'emails.
+
+    `send_mail` ouvre et ferme une session SMTP (et TLS) par message; ici la session est
+    ouverte une fois par lot et chaque message y est envoyé. Le protocole SMTP n'a pas de
+    commande multi-messages: le gain vient de la poignée de main évitée. Si le serveur
+    coupe la connexion, elle est rouverte et le message renvoyé une fois.
+
+    Usage:
+        with ConnexionEmailPartagee() as connexion:
+            connexion.envoyer(message)
+        connexion.metriques()
+    """
+
+    ERREURS_CONNEXION = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+    def __init__(self, connection=None):
+        self.connection = connection or get_connection(fail_silently=False)
+        self.envoyes = 0
+        self.echecs = 0
+        self.reconnexions = 0
+        self._debut = None
+        self._duree = 0.0
+
+    def __enter__(self):
+        self._debut = time.perf_counter()
+        try:
+            self.connection.open()
+        except Exception as e:
+            # Chaque envoi retentera la connexion et échouera individuellement
+            logger.warning(f"Ouverture de la connexion SMTP impossible: {e}")
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.connection.close()
+        finally:
+            self._duree = time.perf_counter() - self._debut
+        return False
+
+    def _reconnecter(self):
+        self.reconnexions += 1
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        self.connection.open()
+
+    def envoyer(self, message):
+        """Envoie un message sur la connexion partagée; lève l'erreur si le renvoi échoue aussi"""
+        message.connection = self.connection
+        try:
+            try:
+                envoyes = self.connection.send_messages([message])
+            except self.ERREURS_CONNEXION:
+                self._reconnecter()
+                envoyes = self.connection.send_messages([message])
+            if not envoyes:
+                raise smtplib.SMTPException("Message non accepté par le serveur")
+        except Exception:
+            self.echecs += 1
+            raise
+        self.envoyes += 1
+        return True
+
+    def metriques(self):
+        """Métriques du lot: messages envoyés, échecs, reconnexions, durée et débit (msg/s)"""
+        duree = self._duree or (time.perf_counter() - self._debut if self._debut else 0.0)
+        return {
+            'envoyes': self.envoyes,
+            'echecs': self.echecs,
+            'reconnexions': self.reconnexions,
+            'duree': round(duree, 3),
+            'debit': round(self.envoyes / duree, 1) if duree else 0.0,
+        }
+
+
 class EmailAlerteService:
     """Service pour envoyer des emails concernant les alertes"""
     
@@ -67,6 +148,49 @@ class EmailAlerteService:
             print(f"Erreur lors de l'envoi de l'email d'alerte: {e}")
             return False
     
+    @staticmethod
+    def construire_message_alerte(notification_log):
+        """Construit l'email d'alerte critique d'une notification de l'outbox"""
+        alerte = notification_log.alerte
+        context = {
+            'alerte': alerte,
+            'site_name': 'RadGestMat',
+            'site_url': getattr(settings, 'SITE_URL', 'http://localhost:8000'),
+        }
+        html_message = render_to_string('assets/emails/alerte_critique.html', context)
+        message = EmailMultiAlternatives(
+            subject=f"[RadGestMat] Alerte Critique: {alerte.get_type_alerte_display()}",
+            body=strip_tags(html_message),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[notification_log.destinataire],
+        )
+        message.attach_alternative(html_message, 'text/html')
+        return message
+
+    @staticmethod
+    def envoyer_notification_alerte(notification_log, connexion=None):
+        """
+        Envoie l'email d'alerte critique d'une notification de l'outbox à son destinataire,
+        sur la connexion partagée du lot si elle est fournie
+        """
+        alerte = notification_log.alerte
+        try:
+            message = EmailAlerteService.construire_message_alerte(notification_log)
+            if connexion is not None:
+                connexion.envoyer(message)
+            else:
+                message.send(fail_silently=False)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'envoi de l'alerte {alerte.id} à {notification_log.destinataire}: {e}")
+            notification_log.statut = NotificationLog.STATUT_ECHEC
+            notification_log.erreur_message = str(e)
+            notification_log.save(update_fields=['statut', 'erreur_message'])
+            return False
+        notification_log.statut = NotificationLog.STATUT_ENVOYEE
+        notification_log.date_envoi = timezone.now()
+        notification_log.save(update_fields=['statut', 'date_envoi'])
+        return True
+    
     @staticmethod
     def envoyer_rapport_quotidien(departement=None):
         """Envoie un rapport quotidien des alertes aux managers"""
@@ -152,34 +276,96 @@ class NotificationEmailService:
     """Service pour envoyer les notifications de matériel par email"""
     
     @staticmethod
-    def send_notification(notification_log):
+    def construire_message(notification_log):
+        """Construit l'email (texte + HTML) d'une notification"""
+        html_message = NotificationEmailService._get_html_message(notification_log)
+        message = EmailMultiAlternatives(
+            subject=NotificationEmailService._get_subject(notification_log),
+            body=strip_tags(html_message),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[notification_log.destinataire],
+        )
+        message.attach_alternative(html_message, 'text/html')
+        return message
+    
+    @staticmethod
+    def construire_message_digest(notification_logs):
+        """Construit l'email unique (texte + HTML) listant les matériels d'un groupe de notifications"""
+        premiere = notification_logs[0]
+        titre = NotificationEmailService._get_subject(premiere).replace('[RadGestMat] ', '')
+        context = {
+            'titre': titre,
+            'notifications': notification_logs,
+            'client': premiere.attribution.client,
+            'notification_type': premiere.type_notification,
+            'site_name': 'RadGestMat',
+            'site_url': getattr(settings, 'SITE_URL', 'http://localhost:8000'),
+        }
+        html_message = render_to_string('assets/emails/notification_digest.html', context)
+        message = EmailMultiAlternatives(
+            subject=f"[RadGestMat] {titre} ({len(notification_logs)} matériels)",
+            body=strip_tags(html_message),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[premiere.destinataire],
+        )
+        message.attach_alternative(html_message, 'text/html')
+        return message
+    
+    @staticmethod
+    def send_digest(notification_logs, connexion=None):
+        """
+        Envoyer en un seul email les notifications d'un même destinataire et d'un même type
+        
+        Chaque notification garde sa ligne de NotificationLog; toutes reçoivent le même
+        identifiant de digest et le même statut.
+        
+        Returns:
+            bool: True si envoyé avec succès
+        """
+        from .outbox_service import NotificationOutboxService
+        
+        try:
+            message = NotificationEmailService.construire_message_digest(notification_logs)
+            if connexion is not None:
+                connexion.envoyer(message)
+            else:
+                message.send(fail_silently=False)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'envoi du digest à {notification_logs[0].destinataire}: {e}")
+            NotificationOutboxService.marquer(
+                notification_logs, statut=NotificationLog.STATUT_ECHEC, erreur_message=str(e),
+            )
+            return False
+        
+        NotificationOutboxService.marquer(
+            notification_logs, statut=NotificationLog.STATUT_ENVOYEE, digest=uuid.uuid4().hex, date_envoi=timezone.now(),
+        )
+        logger.info(f"Digest de {len(notification_logs)} notification(s) envoyé à {notification_logs[0].destinataire}")
+        return True
+    
+    @staticmethod
+    def send_notification(notification_log, connexion=None):
         """
         Envoyer une notification par email
         
         Args:
             notification_log: Instance de NotificationLog
+            connexion: ConnexionEmailPartagee du lot (optionnel, sinon une connexion par message)
             
         Returns:
             bool: True si envoyé avec succès
         """
         try:
-            attribution = notification_log.attribution
-            subject = NotificationEmailService._get_subject(notification_log)
-            html_message = NotificationEmailService._get_html_message(notification_log)
-            plain_message = strip_tags(html_message)
-            
-            send_mail(
-                subject=subject,
-                message=plain_message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[notification_log.destinataire],
-                html_message=html_message,
-                fail_silently=False,
-            )
+            message = NotificationEmailService.construire_message(notification_log)
+            if connexion is not None:
+                connexion.envoyer(message)
+            else:
+                message.send(fail_silently=False)
             
             # Mettre à jour le log
             notification_log.statut = NotificationLog.STATUT_ENVOYEE
-            notification_log.save(update_fields=['statut'])
+            notification_log.date_envoi = timezone.now()
+            notification_log.save(update_fields=['statut', 'date_envoi'])
             
             logger.info(f"Email notification {notification_log.id} envoyé à {notification_log.destinataire}")
             return True
@@ -0,0 +1,292 @@
+# assets/export_audit_service.py
+"""
+Export groupé des rapports d'audit (PDF + index CSV dans une archive zip)
+
+Les rapports d'une période, filtrés comme report_list (et par département de l'auteur),
+sont rendus en PDF en parallèle par un pool de processus: chaque processus passe par
+le cache disque de RapportPdfService et ne renvoie que le chemin du fichier. Le pool est
+créé une fois par processus (Django n'est initialisé qu'au démarrage de ses processus)
+et partagé par les exports; chacun n'y soumet que quelques rapports d'avance et annule
+les siens s'il est interrompu. Le processus principal recopie les PDF un à un dans un
+zip écrit au fil de l'eau, de sorte qu'aucun export ne tient tous ses PDF en mémoire;
+l'index CSV est ajouté en dernier.
+
+Les exports demandés depuis l'interface (ExportAudit) ne sont pas produits par les
+processus web: le job du scheduler les exécute un à un, écrit l'archive sous
+AUDIT_EXPORT_DIR et publie l'avancement sur la ligne de la demande.
+"""
+import io
+import os
+import csv
+import zipfile
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+from itertools import islice
+from datetime import timedelta
+from multiprocessing import get_context
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+# Ce module est importé par les processus du pool avant l'initialisation de Django:
+# les modèles n'y sont importés qu'à l'exécution.
+
+def _initialiser_processus():
+    """Initialise Django dans un processus du pool (démarré en 'spawn': aucune connexion héritée)"""
+    import django
+    django.setup()
+
+
+def _rendre_pdf(pk):
+    """Rend (ou retrouve en cache) le PDF du rapport `pk`; retourne (pk, chemin ou None, erreur)"""
+    from .models import AuditLog
+    from .rapport_pdf_service import RapportPdfService
+
+    try:
+        report = AuditLog.objects.select_related('user', 'content_type').get(pk=pk)
+        chemin = RapportPdfService.obtenir(report)
+        return pk, chemin, '' if chemin else 'PDF indisponible (aucun moteur PDF)'
+    except Exception as e:
+        return pk, None, str(e)
+
+
+class _TamponZip:
+    """Flux d'écriture non positionnable: zipfile y écrit, le générateur en extrait les octets produits"""
+
+    def __init__(self):
+        self.morceaux = []
+
+    def write(self, donnees):
+        self.morceaux.append(bytes(donnees))
+        return len(donnees)
+
+    def flush(self):
+        pass
+
+    def vider(self):
+        donnees = b''.join(self.morceaux)
+        self.morceaux.clear()
+        return donnees
+
+
+class ExportAuditService:
+    """Sélection, rendu parallèle et archivage zip des rapports d'audit"""
+
+    COLONNES_INDEX = ('id', 'date', 'utilisateur', 'action', 'modele', 'objet_id', 'objet', 'fichier', 'erreur')
+    TAILLE_BLOC = 64 * 1024
+    # Avancement publié tous les N rapports
+    PAS_PROGRESSION = 50
+    # Un export en cours sans avancement depuis ce délai (processus arrêté) est repris
+    DELAI_REPRISE = timedelta(minutes=15)
+    # Rapports soumis d'avance par processus du pool
+    EN_VOL_PAR_PROCESSUS = 4
+
+    _verrou = threading.Lock()
+    _pools = {}
+
+    @staticmethod
+    def rapports(debut, fin, action=None, content_type=None, user=None, departement=None):
+        """Rapports du [debut, fin[ filtrés comme report_list, et par code du département de l'auteur"""
+        from .models import AuditLog
+
+        qs = AuditLog.objects.filter(timestamp__gte=debut, timestamp__lt=fin)
+        if action:
+            qs = qs.filter(action=action)
+        if content_type:
+            qs = qs.filter(content_type__model=content_type)
+        if user:
+            qs = qs.filter(user__username__icontains=user)
+        if departement:
+            qs = qs.filter(user__profilutilisateur__departement__code=departement)
+        return qs.order_by('timestamp', 'id')
+
+    @classmethod
+    def _pool(cls, processus):
+        """Pool de `processus` processus de ce processus web, créé au premier export"""
+        with cls._verrou:
+            pool = cls._pools.get(processus)
+            if pool is None:
+                pool = cls._pools[processus] = ProcessPoolExecutor(
+                    max_workers=processus, mp_context=get_context('spawn'), initializer=_initialiser_processus,
+                )
+            return pool
+
+    @classmethod
+    def _abandonner_pool(cls, processus, pool):
+        """Oublie un pool cassé (processus tué): le prochain export en créera un neuf"""
+        with cls._verrou:
+            if cls._pools.get(processus) is pool:
+                del cls._pools[processus]
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def _resultats(cls, pks, processus, rendu=_rendre_pdf):
+        """
+        (pk, chemin, erreur) dans l'ordre des pks, rendus par `processus` processus (0: dans ce processus).
+        Au plus EN_VOL_PAR_PROCESSUS rapports par processus sont soumis d'avance; fermer le
+        générateur annule ceux qui n'ont pas commencé, sans attendre ceux en cours.
+        """
+        if processus <= 0:
+            for pk in pks:
+                yield rendu(pk)
+            return
+        pool = cls._pool(processus)
+        restants = iter(pks)
+        en_vol = deque()
+        try:
+            en_vol.extend(pool.submit(rendu, pk) for pk in islice(restants, processus * cls.EN_VOL_PAR_PROCESSUS))
+            while en_vol:
+                resultat = en_vol.popleft().result()
+                en_vol.extend(pool.submit(rendu, pk) for pk in islice(restants, 1))
+                yield resultat
+        except BrokenProcessPool:
+            cls._abandonner_pool(processus, pool)
+            raise
+        finally:
+            for future in en_vol:
+                future.cancel()
+
+    @classmethod
+    def generer_zip(cls, rapports, processus=4, rappel=None):
+        """
+        Générateur des octets de l'archive zip: rapports/rapport_<pk>.pdf puis index.csv.
+        `rappel(faits, total)` est appelé avant le premier rapport puis après chacun.
+        """
+        lignes = {
+            ligne['id']: ligne
+            for ligne in rapports.values(
+                'id', 'timestamp', 'user__username', 'action', 'content_type__model', 'object_id', 'object_repr',
+            )
+        }
+        pks = list(lignes)
+        total = len(pks)
+        if rappel:
+            rappel(0, total)
+
+        index = io.StringIO()
+        ecrivain = csv.writer(index)
+        ecrivain.writerow(cls.COLONNES_INDEX)
+
+        tampon = _TamponZip()
+        with closing(cls._resultats(pks, processus)) as resultats, \
+                zipfile.ZipFile(tampon, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for faits, (pk, chemin, erreur) in enumerate(resultats, start=1):
+                fichier = ''
+                if chemin:
+                    fichier = f"rapports/rapport_{pk}.pdf"
+                    with open(chemin, 'rb') as source, archive.open(fichier, 'w') as cible:
+                        while bloc := source.read(cls.TAILLE_BLOC):
+                            cible.write(bloc)
+                            if donnees := tampon.vider():
+                                yield donnees
+                ligne = lignes[pk]
+                ecrivain.writerow([
+                    pk,
+                    timezone.localtime(ligne['timestamp']).isoformat(),
+                    ligne['user__username'] or 'System',
+                    ligne['action'],
+                    ligne['content_type__model'] or '',
+                    ligne['object_id'] or '',
+                    ligne['object_repr'] or '',
+                    fichier,
+                    erreur,
+                ])
+                if rappel:
+                    rappel(faits, total)
+            archive.writestr('index.csv', index.getvalue().encode('utf-8-sig'))
+        yield tampon.vider()
+        logger.info(f"Export d'audit terminé: {total} rapport(s)")
+
+    @staticmethod
+    def repertoire():
+        """Répertoire des archives des exports demandés (AUDIT_EXPORT_DIR)"""
+        return str(getattr(settings, 'AUDIT_EXPORT_DIR', os.path.join(settings.BASE_DIR, 'exports', 'audit')))
+
+    @classmethod
+    def chemin(cls, demande):
+        """Chemin de l'archive d'un export terminé"""
+        return os.path.join(cls.repertoire(), demande.fichier)
+
+    @classmethod
+    def executer(cls, demande, processus=None):
+        """
+        Écrit l'archive d'une demande (ExportAudit réservée) sous AUDIT_EXPORT_DIR, en publiant
+        l'avancement sur sa ligne; la marque terminée ou en échec. Retourne True si terminée.
+        """
+        from .models import ExportAudit
+
+        if processus is None:
+            processus = getattr(settings, 'AUDIT_EXPORT_PROCESSUS', 4)
+        ligne = ExportAudit.objects.filter(pk=demande.pk)
+
+        def rappel(faits, total):
+            if faits % cls.PAS_PROGRESSION == 0 or faits == total:
+                ligne.update(faits=faits, total=total, date_maj=timezone.now())
+
+        repertoire = cls.repertoire()
+        os.makedirs(repertoire, exist_ok=True)
+        fichier = f"{demande.identifiant}.zip"
+        partiel = os.path.join(repertoire, f"{fichier}.part")
+        try:
+            rapports = cls.rapports(demande.debut, demande.fin, **demande.filtres)
+            with open(partiel, 'wb') as f:
+                for morceau in cls.generer_zip(rapports, processus, rappel=rappel):
+                    f.write(morceau)
+            os.replace(partiel, os.path.join(repertoire, fichier))
+        except Exception as e:
+            logger.error(f"Export d'audit {demande.identifiant} en échec: {e}", exc_info=True)
+            if os.path.exists(partiel):
+                os.remove(partiel)
+            ligne.update(statut=ExportAudit.STATUT_ECHEC, erreur=str(e), date_maj=timezone.now())
+            return False
+        ligne.update(statut=ExportAudit.STATUT_TERMINE, fichier=fichier, date_maj=timezone.now())
+        return True
+
+    @classmethod
+    def traiter_demandes(cls, processus=None):
+        """
+        Exécute une à une les demandes en attente, et reprend celles restées en cours sans
+        avancement depuis DELAI_REPRISE. Chaque demande est réservée par une mise à jour
+        conditionnelle. Retourne le nombre de demandes traitées.
+        """
+        from .models import ExportAudit
+
+        traitees = 0
+        while True:
+            a_traiter = Q(statut=ExportAudit.STATUT_EN_ATTENTE) | Q(
+                statut=ExportAudit.STATUT_EN_COURS, date_maj__lt=timezone.now() - cls.DELAI_REPRISE,
+            )
+            pk = ExportAudit.objects.filter(a_traiter).order_by('date_creation', 'id').values_list('pk', flat=True).first()
+            if pk is None:
+                return traitees
+            reservee = ExportAudit.objects.filter(a_traiter, pk=pk).update(
+                statut=ExportAudit.STATUT_EN_COURS, faits=0, date_maj=timezone.now(),
+            )
+            if reservee:
+                cls.executer(ExportAudit.objects.get(pk=pk), processus)
+                traitees += 1
+
+    @classmethod
+    def purger(cls, jours=None):
+        """Supprime les demandes terminées ou en échec de plus de `jours` jours et leurs archives"""
+        from .models import ExportAudit
+
+        if jours is None:
+            jours = getattr(settings, 'AUDIT_EXPORT_CONSERVATION_JOURS', 7)
+        anciennes = ExportAudit.objects.filter(
+            statut__in=[ExportAudit.STATUT_TERMINE, ExportAudit.STATUT_ECHEC],
+            date_maj__lt=timezone.now() - timedelta(days=jours),
+        )
+        for demande in anciennes.exclude(fichier=''):
+            try:
+                os.remove(cls.chemin(demande))
+            except FileNotFoundError:
+                pass
+        return anciennes.delete()[0]
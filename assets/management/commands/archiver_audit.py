@@ -0,0 +1,36 @@
+# assets/management/commands/archiver_audit.py
+"""
+Commande de gestion pour archiver les anciennes lignes du journal d'audit en segments compressés
+Usage: python manage.py archiver_audit [--jours 180] [--taille-segment 5000]
+"""
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from assets.archive_audit_service import ArchivageAuditService
+
+
+class Command(BaseCommand):
+    help = "Déplace les lignes d'audit anciennes vers des segments JSONL compressés"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jours',
+            type=int,
+            default=None,
+            help="Âge en jours au-delà duquel une ligne est archivée (défaut: AUDIT_ARCHIVE_APRES_JOURS)",
+        )
+        parser.add_argument(
+            '--taille-segment',
+            type=int,
+            default=ArchivageAuditService.TAILLE_SEGMENT,
+            help=f"Nombre maximal de lignes par segment (défaut: {ArchivageAuditService.TAILLE_SEGMENT})",
+        )
+
+    def handle(self, *args, **options):
+        avant = None
+        if options['jours'] is not None:
+            avant = timezone.now() - timedelta(days=options['jours'])
+        segments, lignes = ArchivageAuditService.archiver(avant, options['taille_segment'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{lignes} ligne(s) d'audit archivée(s) dans {segments} segment(s) ({ArchivageAuditService.repertoire()})."
+        ))
@@ -0,0 +1,60 @@
+# assets/management/commands/exporter_audit.py
+"""
+Commande de gestion pour exporter les rapports d'audit d'une période (PDF + index CSV en zip)
+Usage: python manage.py exporter_audit --debut 2026-01-01 --fin 2026-02-01 [--departement RAD] [--processus 4] [--sortie audit.zip]
+"""
+from datetime import datetime, time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from assets.export_audit_service import ExportAuditService
+
+
+class Command(BaseCommand):
+    help = "Exporte en zip les rapports d'audit d'une période: un PDF par rapport et un index CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debut', required=True, help='Premier jour inclus (AAAA-MM-JJ)')
+        parser.add_argument('--fin', required=True, help='Dernier jour exclu (AAAA-MM-JJ)')
+        parser.add_argument('--action', help='CREATE, UPDATE ou DELETE')
+        parser.add_argument('--modele', help='Nom du modèle (ex: attribution)')
+        parser.add_argument('--utilisateur', help="Partie du nom d'utilisateur de l'auteur")
+        parser.add_argument('--departement', help="Code du département de l'auteur")
+        parser.add_argument(
+            '--processus',
+            type=int,
+            default=4,
+            help='Nombre de processus de rendu PDF (défaut: 4, 0 pour rendre dans ce processus)',
+        )
+        parser.add_argument('--sortie', help="Fichier zip à écrire (défaut: audit_<debut>_<fin>.zip)")
+
+    @staticmethod
+    def _jour(valeur):
+        try:
+            return timezone.make_aware(datetime.combine(datetime.strptime(valeur, '%Y-%m-%d').date(), time.min))
+        except ValueError:
+            raise CommandError(f"Date invalide: {valeur} (format attendu: AAAA-MM-JJ)")
+
+    def handle(self, *args, **options):
+        debut, fin = self._jour(options['debut']), self._jour(options['fin'])
+        rapports = ExportAuditService.rapports(
+            debut, fin,
+            action=options['action'],
+            content_type=options['modele'],
+            user=options['utilisateur'],
+            departement=options['departement'],
+        )
+        sortie = options['sortie'] or f"audit_{options['debut']}_{options['fin']}.zip"
+        dernier_pourcentage = [-1]
+
+        def rappel(faits, total):
+            pourcentage = faits * 100 // total if total else 100
+            if pourcentage != dernier_pourcentage[0]:
+                dernier_pourcentage[0] = pourcentage
+                self.stdout.write(f"\r{faits}/{total} rapport(s) ({pourcentage}%)", ending='')
+                self.stdout.flush()
+
+        with open(sortie, 'wb') as f:
+            for morceau in ExportAuditService.generer_zip(rapports, options['processus'], rappel=rappel):
+                f.write(morceau)
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f"Export écrit dans {sortie}"))
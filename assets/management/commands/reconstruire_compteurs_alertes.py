@@ -0,0 +1,14 @@
+# assets/management/commands/reconstruire_compteurs_alertes.py
+"""
+Commande de gestion pour recalculer les compteurs d'alertes ouvertes depuis la table Alerte
+"""
+from django.core.management.base import BaseCommand
+from assets.services import CompteurAlertesService
+
+
+class Command(BaseCommand):
+    help = "Recalcule les compteurs d'alertes ouvertes par département et sévérité"
+
+    def handle(self, *args, **options):
+        corriges = CompteurAlertesService.reconstruire()
+        self.stdout.write(self.style.SUCCESS(f'Compteurs d\'alertes reconstruits ({corriges} corrigé(s)).'))
@@ -0,0 +1,14 @@
+# assets/management/commands/reconstruire_niveaux_stock.py
+"""
+Commande de gestion pour recalculer la table des niveaux de stock depuis les matériels
+"""
+from django.core.management.base import BaseCommand
+from assets.services import NiveauStockService
+
+
+class Command(BaseCommand):
+    help = "Recalcule les niveaux de stock par département et nom d'équipement"
+
+    def handle(self, *args, **options):
+        nombre = NiveauStockService.reconstruire()
+        self.stdout.write(self.style.SUCCESS(f'Niveaux de stock reconstruits ({nombre} ligne(s)).'))
@@ -0,0 +1,14 @@
+# assets/management/commands/reconstruire_plans_notifications.py
+"""
+Commande de gestion pour recalculer le plan des rappels de toutes les attributions en cours
+"""
+from django.core.management.base import BaseCommand
+from assets.planification_service import PlanificationService
+
+
+class Command(BaseCommand):
+    help = "Recalcule les notifications planifiées (rappels, retards) des attributions en cours"
+
+    def handle(self, *args, **options):
+        nombre = PlanificationService.reconstruire()
+        self.stdout.write(self.style.SUCCESS(f'Plans de notifications reconstruits ({nombre} ligne(s)).'))
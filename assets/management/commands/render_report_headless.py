@@ -31,17 +31,7 @@ class Command(BaseCommand):
                 return
 
         # Build the same context the view would
-        formatted_changes = asset_views._format_changes_for_display(report)
-        human_sentence = asset_views._build_human_readable_sentence(report, formatted_changes)
-        summary = asset_views._build_creative_summary(report) or ''
-        context = {
-            'report': report,
-            'formatted_changes': formatted_changes,
-            'summary': summary,
-            'human_sentence': human_sentence,
-            'context_sentence': asset_views._build_context_sentence(report),
-            'sanitized_metadata': asset_views._sanitize_metadata(getattr(report, 'metadata', None)),
-        }
+        context = asset_views._report_context(report, prioritise_fields=True)
 
         try:
             html = render_to_string('assets/report_detail.html', context)
@@ -0,0 +1,64 @@
+# assets/management/commands/traiter_notifications.py
+"""
+Worker de l'outbox des notifications (envois et relances des échecs)
+Usage: python manage.py traiter_notifications [--once] [--taille-lot 50] [--concurrence 4]
+"""
+import time
+from django.core.management.base import BaseCommand
+from assets.outbox_service import NotificationOutboxService
+
+
+class Command(BaseCommand):
+    help = "Envoie par lots les notifications en attente dans l'outbox (email, WhatsApp)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help="Vider l'outbox puis s'arrêter au lieu de tourner en continu",
+        )
+        parser.add_argument(
+            '--taille-lot',
+            type=int,
+            default=50,
+            help='Nombre de notifications réservées par lot (défaut: 50)',
+        )
+        parser.add_argument(
+            '--concurrence',
+            type=int,
+            default=4,
+            help="Nombre d'envois simultanés (défaut: 4)",
+        )
+        parser.add_argument(
+            '--intervalle',
+            type=float,
+            default=2.0,
+            help="Attente en secondes quand l'outbox est vide (défaut: 2)",
+        )
+
+    def handle(self, *args, **options):
+        taille = options['taille_lot']
+        concurrence = options['concurrence']
+        self.stdout.write(self.style.SUCCESS(
+            f"Worker de notifications démarré (lots de {taille}, concurrence {concurrence})"
+        ))
+        try:
+            while True:
+                resultat = NotificationOutboxService.traiter_lot(taille, concurrence)
+                if resultat['reservees']:
+                    ligne = (
+                        f"Lot traité: {resultat['envoyees']} envoyée(s) en {resultat['messages']} message(s), "
+                        f"{resultat['echecs']} échec(s)"
+                    )
+                    if resultat['definitifs']:
+                        ligne += f" dont {resultat['definitifs']} définitif(s)"
+                    if resultat['email']:
+                        ligne += f" - emails: {resultat['email']['debit']} msg/s, {resultat['email']['reconnexions']} reconnexion(s)"
+                    self.stdout.write(ligne)
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['intervalle'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Interruption reçue, arrêt du worker.'))
+        self.stdout.write(self.style.SUCCESS('Worker de notifications arrêté'))
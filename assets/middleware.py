@@ -28,12 +28,22 @@ def get_current_user():
 class CurrentUserMiddleware:
     """Middleware that stores the current request in thread-local storage so
     signals and other non-request code can access the current user and request.
+
+    The request is also the unit of work of the audit trail: its audit entries
+    are written with a single INSERT when it ends (see signals_audit.audit_buffer).
     """
 
     def __init__(self, get_response):
+        # Import différé: signals_audit importe ce module
+        from .signals_audit import audit_buffer
+        self.audit_buffer = audit_buffer
         self.get_response = get_response
 
     def __call__(self, request):
         set_current_request(request)
-        response = self.get_response(request)
-        return response
+        try:
+            with self.audit_buffer():
+                return self.get_response(request)
+        finally:
+            # Ne pas attribuer à cet utilisateur le code exécuté ensuite dans ce thread
+            set_current_request(None)
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:50
+
+import re
+
+from django.db import migrations, models
+
+
+def backfill_nom_equipement(apps, schema_editor):
+    """Extraire le nom d'équipement de la description des alertes de stock critique existantes"""
+    Alerte = apps.get_model('assets', 'Alerte')
+    pattern = re.compile(r"^Stock critique pour l'équipement '(.*)': \d+ unité")
+    a_modifier = []
+    for alerte in Alerte.objects.filter(type_alerte='STOCK_CRITIQUE', nom_equipement__isnull=True).only('id', 'description'):
+        match = pattern.match(alerte.description or '')
+        if match:
+            alerte.nom_equipement = match.group(1)
+            a_modifier.append(alerte)
+    Alerte.objects.bulk_update(a_modifier, ['nom_equipement'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0007_notificationlog_notificationpreferences_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alerte',
+            name='nom_equipement',
+            field=models.CharField(blank=True, help_text="Nom d'équipement concerné (stock critique)", max_length=200, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='alerte',
+            index=models.Index(fields=['type_alerte', 'departement', 'nom_equipement', 'reglementee'], name='assets_aler_type_al_87118c_idx'),
+        ),
+        migrations.RunPython(backfill_nom_equipement, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0008_alerte_nom_equipement'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('detecteur', models.CharField(max_length=50, unique=True)),
+                ('date_derniere_execution', models.DateTimeField(help_text='Début de la dernière exécution réussie')),
+                ('date_dernier_balayage_complet', models.DateTimeField(blank=True, help_text='Début du dernier balayage complet', null=True)),
+            ],
+            options={
+                'verbose_name': 'Watermark de détection',
+                'verbose_name_plural': 'Watermarks de détection',
+            },
+        ),
+        migrations.AddField(
+            model_name='attribution',
+            name='date_modification',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='attribution',
+            index=models.Index(fields=['date_modification'], name='assets_attr_date_mo_2b9483_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='materiel',
+            index=models.Index(fields=['date_modification'], name='assets_mate_date_mo_2047fc_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:53
+
+from django.db import migrations, models
+
+
+def reglementer_doublons(apps, schema_editor):
+    """Ne conserver que l'alerte ouverte la plus récente par clé avant de poser les contraintes"""
+    Alerte = apps.get_model('assets', 'Alerte')
+    vues = set()
+    doublons = []
+    ouvertes = Alerte.objects.filter(reglementee=False).order_by('-date_creation', '-id').only(
+        'id', 'type_alerte', 'severite', 'attribution_id', 'materiel_id', 'departement_id', 'nom_equipement'
+    )
+    for alerte in ouvertes.iterator():
+        if alerte.attribution_id:
+            cle = ('attribution', alerte.type_alerte, alerte.severite, alerte.attribution_id)
+        elif alerte.materiel_id:
+            cle = ('materiel', alerte.type_alerte, alerte.severite, alerte.materiel_id)
+        elif alerte.nom_equipement is not None:
+            cle = ('stock', alerte.type_alerte, alerte.severite, alerte.departement_id, alerte.nom_equipement)
+        else:
+            continue
+        if cle in vues:
+            doublons.append(alerte.id)
+        else:
+            vues.add(cle)
+    for debut in range(0, len(doublons), 500):
+        Alerte.objects.filter(id__in=doublons[debut:debut + 500]).update(reglementee=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0009_detection_incrementale'),
+    ]
+
+    operations = [
+        migrations.RunPython(reglementer_doublons, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='alerte',
+            constraint=models.UniqueConstraint(condition=models.Q(('attribution__isnull', False), ('reglementee', False)), fields=('type_alerte', 'attribution', 'severite'), name='alerte_ouverte_unique_attribution'),
+        ),
+        migrations.AddConstraint(
+            model_name='alerte',
+            constraint=models.UniqueConstraint(condition=models.Q(('attribution__isnull', True), ('materiel__isnull', False), ('reglementee', False)), fields=('type_alerte', 'materiel', 'severite'), name='alerte_ouverte_unique_materiel'),
+        ),
+        migrations.AddConstraint(
+            model_name='alerte',
+            constraint=models.UniqueConstraint(condition=models.Q(('nom_equipement__isnull', False), ('reglementee', False)), fields=('type_alerte', 'departement', 'nom_equipement', 'severite'), name='alerte_ouverte_unique_stock'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def initialiser_compteurs(apps, schema_editor):
+    """Calculer les compteurs initiaux depuis les alertes ouvertes existantes"""
+    Alerte = apps.get_model('assets', 'Alerte')
+    CompteurAlertes = apps.get_model('assets', 'CompteurAlertes')
+    CompteurAlertes.objects.bulk_create([
+        CompteurAlertes(departement_id=ligne['departement_id'], severite=ligne['severite'], nombre=ligne['nombre'])
+        for ligne in Alerte.objects.filter(reglementee=False).values('departement_id', 'severite').annotate(nombre=Count('pk'))
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0010_alerte_ouverte_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompteurAlertes',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('severite', models.CharField(choices=[('INFO', 'Information'), ('WARNING', 'Avertissement'), ('CRITICAL', 'Critique')], max_length=20)),
+                ('nombre', models.PositiveIntegerField(default=0)),
+                ('departement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compteurs_alertes', to='assets.departement')),
+            ],
+            options={
+                'verbose_name': "Compteur d'alertes",
+                'verbose_name_plural': "Compteurs d'alertes",
+                'constraints': [models.UniqueConstraint(fields=('departement', 'severite'), name='compteur_alertes_unique')],
+            },
+        ),
+        migrations.RunPython(initialiser_compteurs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0011_compteur_alertes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alerte',
+            index=models.Index(fields=['reglementee', 'severite', 'date_creation', 'id'], name='alerte_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alerte',
+            index=models.Index(fields=['departement', 'reglementee', 'severite', 'date_creation', 'id'], name='alerte_keyset_dept_idx'),
+        ),
+    ]
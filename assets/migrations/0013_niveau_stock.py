@@ -0,0 +1,63 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+
+def initialiser_niveaux_stock(apps, schema_editor):
+    """Calculer les niveaux de stock initiaux depuis les matériels existants"""
+    Materiel = apps.get_model('assets', 'Materiel')
+    NiveauStock = apps.get_model('assets', 'NiveauStock')
+    maintenant = timezone.now()
+    lignes = Materiel.objects.order_by().values('departement_id', 'nom').annotate(
+        categorie_max=Max('categorie_id'),
+        nb_total=Count('id'),
+        nb_disponible=Count('id', filter=Q(statut_disponibilite='DISPONIBLE', etat_technique='FONCTIONNEL')),
+        nb_attribue=Count('id', filter=Q(statut_disponibilite='ATTRIBUE')),
+        nb_maintenance=Count('id', filter=Q(statut_disponibilite='MAINTENANCE')),
+        nb_hors_service=Count('id', filter=Q(statut_disponibilite='HORS_SERVICE')),
+        nb_defectueux=Count('id', filter=Q(etat_technique='DEFECTUEUX')),
+    )
+    NiveauStock.objects.bulk_create([
+        NiveauStock(
+            departement_id=ligne['departement_id'], nom=ligne['nom'], categorie_id=ligne['categorie_max'],
+            total=ligne['nb_total'], disponible=ligne['nb_disponible'], attribue=ligne['nb_attribue'],
+            maintenance=ligne['nb_maintenance'], hors_service=ligne['nb_hors_service'],
+            defectueux=ligne['nb_defectueux'], date_modification=maintenant,
+        )
+        for ligne in lignes
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0012_alerte_keyset_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NiveauStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nom', models.CharField(max_length=200)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('disponible', models.PositiveIntegerField(default=0, help_text='Disponibles et fonctionnels')),
+                ('attribue', models.PositiveIntegerField(default=0)),
+                ('maintenance', models.PositiveIntegerField(default=0)),
+                ('hors_service', models.PositiveIntegerField(default=0)),
+                ('defectueux', models.PositiveIntegerField(default=0)),
+                ('date_modification', models.DateTimeField(db_index=True)),
+                ('categorie', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='niveaux_stock', to='assets.categorie')),
+                ('departement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='niveaux_stock', to='assets.departement')),
+            ],
+            options={
+                'verbose_name': 'Niveau de stock',
+                'verbose_name_plural': 'Niveaux de stock',
+                'constraints': [models.UniqueConstraint(fields=('departement', 'nom'), name='niveau_stock_unique')],
+            },
+        ),
+        migrations.RunPython(initialiser_niveaux_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0013_niveau_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationlog',
+            name='alerte',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='assets.alerte'),
+        ),
+        migrations.AddField(
+            model_name='notificationlog',
+            name='date_verrou',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notificationlog',
+            name='lot',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='notificationlog',
+            name='attribution',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='assets.attribution'),
+        ),
+        migrations.AlterField(
+            model_name='notificationlog',
+            name='statut',
+            field=models.CharField(choices=[('EN_ATTENTE', 'En attente (outbox)'), ('EN_COURS', "En cours d'envoi"), ('ENVOYEE', 'Envoyée'), ('ECHEC', 'Échec (retry en cours)'), ('ECHEC_PERM', 'Échec définitif')], default='ENVOYEE', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='notificationlog',
+            name='type_notification',
+            field=models.CharField(choices=[('CREATION', 'Notification de création'), ('RAPPEL_2H', 'Rappel 2h avant'), ('RAPPEL_J_MOINS_2', 'Rappel J-2'), ('RAPPEL_J_MOINS_1', 'Rappel J-1'), ('RAPPEL_FINAL', 'Rappel jour retour'), ('RETARD', 'Alerte retard'), ('RESTITUTION', 'Confirmation restitution'), ('ALERTE_CRITIQUE', 'Alerte critique (managers)')], max_length=20),
+        ),
+    ]
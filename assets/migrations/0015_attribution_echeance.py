@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:10
+
+from datetime import datetime, time
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def initialiser_echeances(apps, schema_editor):
+    """Calculer l'échéance des attributions existantes"""
+    Attribution = apps.get_model('assets', 'Attribution')
+    lot = []
+    for attribution in Attribution.objects.only('id', 'date_retour_prevue', 'heure_retour_prevue').iterator(chunk_size=2000):
+        attribution.echeance = timezone.make_aware(
+            datetime.combine(attribution.date_retour_prevue, attribution.heure_retour_prevue or time.min)
+        )
+        lot.append(attribution)
+        if len(lot) >= 500:
+            Attribution.objects.bulk_update(lot, ['echeance'])
+            lot = []
+    if lot:
+        Attribution.objects.bulk_update(lot, ['echeance'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0014_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attribution',
+            name='echeance',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='attribution',
+            index=models.Index(condition=models.Q(('date_retour_effective__isnull', True)), fields=['echeance'], name='attribution_echeance_idx'),
+        ),
+        migrations.RunPython(initialiser_echeances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:12
+
+from datetime import datetime, time, timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def planifier_attributions_en_cours(apps, schema_editor):
+    """Écrire le plan des rappels des attributions en cours (règles de PlanificationService.calculer_plan)"""
+    Attribution = apps.get_model('assets', 'Attribution')
+    NotificationPlanifiee = apps.get_model('assets', 'NotificationPlanifiee')
+    maintenant = timezone.now()
+
+    def date_locale(jour, heure=time.min):
+        return timezone.make_aware(datetime.combine(jour, heure))
+
+    en_cours = Attribution.objects.filter(
+        date_retour_effective__isnull=True, date_retour_prevue__isnull=False,
+    ).only('id', 'date_retour_prevue', 'heure_retour_prevue', 'duree_emprunt', 'echeance')
+    lot = []
+    for attribution in en_cours.iterator(chunk_size=2000):
+        retour = attribution.date_retour_prevue
+        plan = {}
+        if attribution.duree_emprunt in ('COURT', 'MOYEN'):
+            if attribution.heure_retour_prevue and attribution.echeance and attribution.echeance > maintenant:
+                plan['RAPPEL_2H'] = max(attribution.echeance - timedelta(hours=2), maintenant)
+        else:
+            for jours, type_notification in ((2, 'RAPPEL_J_MOINS_2'), (1, 'RAPPEL_J_MOINS_1'), (0, 'RAPPEL_FINAL')):
+                date_prevue = date_locale(retour - timedelta(days=jours), time(8, 0))
+                if date_prevue >= maintenant:
+                    plan[type_notification] = date_prevue
+        plan['RETARD'] = max(date_locale(retour + timedelta(days=1)), maintenant)
+        lot.extend(
+            NotificationPlanifiee(attribution_id=attribution.pk, type_notification=type_notification, date_prevue=date_prevue)
+            for type_notification, date_prevue in plan.items()
+        )
+        if len(lot) >= 500:
+            NotificationPlanifiee.objects.bulk_create(lot)
+            lot = []
+    if lot:
+        NotificationPlanifiee.objects.bulk_create(lot)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0015_attribution_echeance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationPlanifiee',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type_notification', models.CharField(choices=[('CREATION', 'Notification de création'), ('RAPPEL_2H', 'Rappel 2h avant'), ('RAPPEL_J_MOINS_2', 'Rappel J-2'), ('RAPPEL_J_MOINS_1', 'Rappel J-1'), ('RAPPEL_FINAL', 'Rappel jour retour'), ('RETARD', 'Alerte retard'), ('RESTITUTION', 'Confirmation restitution'), ('ALERTE_CRITIQUE', 'Alerte critique (managers)')], max_length=20)),
+                ('date_prevue', models.DateTimeField()),
+                ('lot', models.CharField(blank=True, max_length=32, null=True)),
+                ('attribution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications_planifiees', to='assets.attribution')),
+            ],
+            options={
+                'verbose_name': 'Notification planifiée',
+                'verbose_name_plural': 'Notifications planifiées',
+                'indexes': [models.Index(fields=['date_prevue'], name='notif_planifiee_echeance_idx')],
+                'constraints': [models.UniqueConstraint(fields=('attribution', 'type_notification'), name='notification_planifiee_unique')],
+            },
+        ),
+        migrations.RunPython(planifier_attributions_en_cours, migrations.RunPython.noop),
+    ]
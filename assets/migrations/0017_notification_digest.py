@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0016_notification_planifiee'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationlog',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0018_auditlog_timestamp'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentAudit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fichier', models.CharField(max_length=255, unique=True)),
+                ('date_debut', models.DateTimeField()),
+                ('date_fin', models.DateTimeField()),
+                ('premier_id', models.BigIntegerField()),
+                ('dernier_id', models.BigIntegerField()),
+                ('nb_lignes', models.PositiveIntegerField()),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='contenttypes.contenttype')),
+            ],
+            options={
+                'verbose_name': "Segment d'archive d'audit",
+                'verbose_name_plural': "Segments d'archive d'audit",
+                'ordering': ['-date_fin'],
+                'indexes': [models.Index(fields=['content_type', 'date_fin', 'date_debut'], name='segment_audit_periode_idx'), models.Index(fields=['premier_id', 'dernier_id'], name='segment_audit_ids_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.utils import timezone
+
+
+def recalculer_niveaux_stock(apps, schema_editor):
+    """Recalculer les niveaux de stock par (département, nom, catégorie)"""
+    Materiel = apps.get_model('assets', 'Materiel')
+    NiveauStock = apps.get_model('assets', 'NiveauStock')
+    maintenant = timezone.now()
+    lignes = Materiel.objects.order_by().values('departement_id', 'nom', 'categorie_id').annotate(
+        nb_total=Count('id'),
+        nb_disponible=Count('id', filter=Q(statut_disponibilite='DISPONIBLE', etat_technique='FONCTIONNEL')),
+        nb_attribue=Count('id', filter=Q(statut_disponibilite='ATTRIBUE')),
+        nb_maintenance=Count('id', filter=Q(statut_disponibilite='MAINTENANCE')),
+        nb_hors_service=Count('id', filter=Q(statut_disponibilite='HORS_SERVICE')),
+        nb_defectueux=Count('id', filter=Q(etat_technique='DEFECTUEUX')),
+    )
+    NiveauStock.objects.all().delete()
+    NiveauStock.objects.bulk_create([
+        NiveauStock(
+            departement_id=ligne['departement_id'], nom=ligne['nom'], categorie_id=ligne['categorie_id'],
+            total=ligne['nb_total'], disponible=ligne['nb_disponible'], attribue=ligne['nb_attribue'],
+            maintenance=ligne['nb_maintenance'], hors_service=ligne['nb_hors_service'],
+            defectueux=ligne['nb_defectueux'], date_modification=maintenant,
+        )
+        for ligne in lignes
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0020_auditlog_index'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='niveaustock',
+            name='niveau_stock_unique',
+        ),
+        migrations.AlterField(
+            model_name='niveaustock',
+            name='categorie',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='niveaux_stock', to='assets.categorie'),
+        ),
+        migrations.AddConstraint(
+            model_name='niveaustock',
+            constraint=models.UniqueConstraint(fields=('departement', 'nom', 'categorie'), name='niveau_stock_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='niveaustock',
+            constraint=models.UniqueConstraint(condition=models.Q(('categorie__isnull', True)), fields=('departement', 'nom'), name='niveau_stock_unique_sans_categorie'),
+        ),
+        migrations.RunPython(recalculer_niveaux_stock, migrations.RunPython.noop),
+    ]
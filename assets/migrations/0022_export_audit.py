@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0021_niveau_stock_categorie'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportAudit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifiant', models.CharField(max_length=64, unique=True)),
+                ('debut', models.DateTimeField()),
+                ('fin', models.DateTimeField()),
+                ('filtres', models.JSONField(blank=True, default=dict)),
+                ('statut', models.CharField(choices=[('EN_ATTENTE', 'En attente'), ('EN_COURS', 'En cours'), ('TERMINE', 'Terminé'), ('ECHEC', 'Échec')], default='EN_ATTENTE', max_length=20)),
+                ('faits', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('fichier', models.CharField(blank=True, max_length=255)),
+                ('erreur', models.TextField(blank=True)),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+                ('date_maj', models.DateTimeField(auto_now_add=True)),
+                ('demandeur', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='exports_audit', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': "Export d'audit",
+                'verbose_name_plural': "Exports d'audit",
+                'ordering': ['-date_creation'],
+                'indexes': [models.Index(fields=['statut', 'date_creation'], name='export_audit_statut_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:06
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def compter_statut_disponible(apps, schema_editor):
+    """Compter les matériels au statut disponible de chaque niveau de stock existant"""
+    Materiel = apps.get_model('assets', 'Materiel')
+    NiveauStock = apps.get_model('assets', 'NiveauStock')
+    lignes = Materiel.objects.order_by().values('departement_id', 'nom', 'categorie_id').annotate(
+        nb=Count('id', filter=Q(statut_disponibilite='DISPONIBLE')),
+    ).filter(nb__gt=0)
+    for ligne in lignes:
+        NiveauStock.objects.filter(
+            departement_id=ligne['departement_id'], nom=ligne['nom'], categorie_id=ligne['categorie_id'],
+        ).update(statut_disponible=ligne['nb'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0022_export_audit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='niveaustock',
+            name='statut_disponible',
+            field=models.PositiveIntegerField(default=0, help_text="Au statut disponible, quel que soit l'état (tableau de bord)"),
+        ),
+        migrations.RunPython(compter_statut_disponible, migrations.RunPython.noop),
+    ]
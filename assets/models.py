@@ -4,6 +4,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from datetime import timedelta
+from django.utils import timezone
 from django.core.files.base import ContentFile
 import io
 import os
@@ -82,6 +83,9 @@ class Materiel(models.Model):
         verbose_name_plural = "Matériels"
         unique_together = ('asset_id', 'departement')
         ordering = ['-date_creation']
+        indexes = [
+            models.Index(fields=['date_modification']),
+        ]
 
     def __str__(self):
         return f"{self.asset_id} - {self.nom}"
@@ -109,6 +113,39 @@ class Materiel(models.Model):
         super().save(*args, **kwargs)
 
 
+class NiveauStock(models.Model):
+    """Niveau de stock par (département, nom d'équipement, catégorie), maintenu à chaque écriture de matériel"""
+
+    departement = models.ForeignKey(Departement, on_delete=models.CASCADE, related_name='niveaux_stock')
+    nom = models.CharField(max_length=200)
+    # Supprimer une catégorie supprime ses niveaux: ceux du département sont alors recalculés (signal)
+    categorie = models.ForeignKey(Categorie, on_delete=models.CASCADE, null=True, blank=True, related_name='niveaux_stock')
+    total = models.PositiveIntegerField(default=0)
+    disponible = models.PositiveIntegerField(default=0, help_text="Disponibles et fonctionnels")
+    statut_disponible = models.PositiveIntegerField(default=0, help_text="Au statut disponible, quel que soit l'état (tableau de bord)")
+    attribue = models.PositiveIntegerField(default=0)
+    maintenance = models.PositiveIntegerField(default=0)
+    hors_service = models.PositiveIntegerField(default=0)
+    defectueux = models.PositiveIntegerField(default=0)
+    date_modification = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = "Niveau de stock"
+        verbose_name_plural = "Niveaux de stock"
+        constraints = [
+            models.UniqueConstraint(fields=['departement', 'nom', 'categorie'], name='niveau_stock_unique'),
+            # NULL n'étant pas égal à NULL, les matériels sans catégorie ont leur propre contrainte
+            models.UniqueConstraint(
+                fields=['departement', 'nom'],
+                condition=models.Q(categorie__isnull=True),
+                name='niveau_stock_unique_sans_categorie',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.departement} - {self.nom}: {self.disponible}/{self.total}"
+
+
 class Client(models.Model):
     TYPE_HEBERGEMENT, TYPE_CONFERENCE, TYPE_INTERNE = 'HEBERGEMENT', 'CONFERENCE', 'INTERNE'
     # NOTE: Nous conservons la valeur technique 'CONFERENCE' pour compatibilité,
@@ -206,6 +243,9 @@ class Attribution(models.Model):
         blank=True,
         help_text="Heure effective de retour"
     )
+    # Date et heure de retour prévues combinées (minuit si pas d'heure), maintenue par save()
+    echeance = models.DateTimeField(null=True, blank=True, editable=False)
+    date_modification = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = "Attribution"
@@ -214,6 +254,13 @@ class Attribution(models.Model):
         indexes = [
             models.Index(fields=['duree_emprunt', 'date_retour_effective']),
             models.Index(fields=['date_retour_prevue', 'duree_emprunt']),
+            models.Index(fields=['date_modification']),
+            # Seuls les emprunts en cours sont interrogés par échéance (rappels, retards)
+            models.Index(
+                fields=['echeance'],
+                name='attribution_echeance_idx',
+                condition=models.Q(date_retour_effective__isnull=True),
+            ),
         ]
 
     def __str__(self):
@@ -236,7 +283,10 @@ class Attribution(models.Model):
             return self.DUREE_LONG_TERME
         
         # Conversion en datetime pour calcul précis
-        if isinstance(self.date_attribution, datetime):
+        # (date_attribution est vide avant le premier enregistrement: auto_now_add)
+        if self.date_attribution is None:
+            start = timezone.now()
+        elif isinstance(self.date_attribution, datetime):
             start = self.date_attribution
         else:
             start_naive = datetime.combine(self.date_attribution.date() if hasattr(self.date_attribution, 'date') else self.date_attribution, time.min)
@@ -258,6 +308,15 @@ class Attribution(models.Model):
             return self.DUREE_MOYEN_TERME
         else:
             return self.DUREE_LONG_TERME
+
+    def calculer_echeance(self):
+        """Date et heure de retour prévues (fuseau courant), minuit si l'heure n'est pas renseignée"""
+        from django.utils import timezone
+        from datetime import datetime, time
+
+        if not self.date_retour_prevue:
+            return None
+        return timezone.make_aware(datetime.combine(self.date_retour_prevue, self.heure_retour_prevue or time.min))
     
     def is_overdue(self):
         """Vérifier si l'attribution est en retard"""
@@ -297,8 +356,12 @@ class Attribution(models.Model):
         return int(delta.total_seconds() / 60)
 
     def save(self, *args, **kwargs):
-        # Auto-calculer la durée d'emprunt
+        # Auto-calculer la durée d'emprunt et l'échéance
         self.duree_emprunt = self.calculate_duree_emprunt()
+        self.echeance = self.calculer_echeance()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'date_retour_prevue', 'heure_retour_prevue'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'duree_emprunt', 'echeance'}
         
         if not self.pk:
             self.materiel.statut_disponibilite = Materiel.STATUT_ATTRIBUE
@@ -340,6 +403,8 @@ class Alerte(models.Model):
     attribution = models.ForeignKey(Attribution, on_delete=models.CASCADE, null=True, blank=True, related_name='alertes')
     departement = models.ForeignKey(Departement, on_delete=models.CASCADE, related_name='alertes')
     description = models.TextField()
+    # Clé structurée des alertes de stock critique (nom d'équipement du groupe)
+    nom_equipement = models.CharField(max_length=200, blank=True, null=True, help_text="Nom d'équipement concerné (stock critique)")
     reglementee = models.BooleanField(default=False)
     date_creation = models.DateTimeField(auto_now_add=True)
 
@@ -347,11 +412,68 @@ class Alerte(models.Model):
         verbose_name = "Alerte"
         verbose_name_plural = "Alertes"
         ordering = ['-date_creation']
+        indexes = [
+            models.Index(fields=['type_alerte', 'departement', 'nom_equipement', 'reglementee']),
+            # Pagination par clé de la liste des alertes ouvertes
+            models.Index(fields=['reglementee', 'severite', 'date_creation', 'id'], name='alerte_keyset_idx'),
+            models.Index(fields=['departement', 'reglementee', 'severite', 'date_creation', 'id'], name='alerte_keyset_dept_idx'),
+        ]
+        # Au plus une alerte ouverte par (type, objet surveillé, sévérité)
+        constraints = [
+            models.UniqueConstraint(
+                fields=['type_alerte', 'attribution', 'severite'],
+                condition=models.Q(reglementee=False, attribution__isnull=False),
+                name='alerte_ouverte_unique_attribution',
+            ),
+            models.UniqueConstraint(
+                fields=['type_alerte', 'materiel', 'severite'],
+                condition=models.Q(reglementee=False, attribution__isnull=True, materiel__isnull=False),
+                name='alerte_ouverte_unique_materiel',
+            ),
+            models.UniqueConstraint(
+                fields=['type_alerte', 'departement', 'nom_equipement', 'severite'],
+                condition=models.Q(reglementee=False, nom_equipement__isnull=False),
+                name='alerte_ouverte_unique_stock',
+            ),
+        ]
 
     def __str__(self):
         return f"[{self.get_severite_display()}] {self.get_type_alerte_display()}"
 
 
+class DetectionWatermark(models.Model):
+    """High-water mark par détecteur pour la détection incrémentale des alertes"""
+
+    detecteur = models.CharField(max_length=50, unique=True)
+    date_derniere_execution = models.DateTimeField(help_text="Début de la dernière exécution réussie")
+    date_dernier_balayage_complet = models.DateTimeField(null=True, blank=True, help_text="Début du dernier balayage complet")
+
+    class Meta:
+        verbose_name = "Watermark de détection"
+        verbose_name_plural = "Watermarks de détection"
+
+    def __str__(self):
+        return f"{self.detecteur} @ {self.date_derniere_execution:%Y-%m-%d %H:%M}"
+
+
+class CompteurAlertes(models.Model):
+    """Nombre d'alertes ouvertes par département et sévérité, maintenu à chaque écriture d'alerte"""
+
+    departement = models.ForeignKey(Departement, on_delete=models.CASCADE, related_name='compteurs_alertes')
+    severite = models.CharField(max_length=20, choices=Alerte.SEVERITE_CHOICES)
+    nombre = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Compteur d'alertes"
+        verbose_name_plural = "Compteurs d'alertes"
+        constraints = [
+            models.UniqueConstraint(fields=['departement', 'severite'], name='compteur_alertes_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.departement} - {self.severite}: {self.nombre}"
+
+
 class AuditLog(models.Model):
     ACTION_CREATE = 'CREATE'
     ACTION_UPDATE = 'UPDATE'
@@ -370,12 +492,25 @@ class AuditLog(models.Model):
     changes = models.JSONField(blank=True, null=True, help_text='Diff of changed fields (old->new)')
     ip_address = models.CharField(max_length=50, blank=True, null=True)
     metadata = models.JSONField(blank=True, null=True, help_text='Optional metadata')
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the change happens: entries are buffered and written at commit
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    # True on entries read back from an archive segment (see archive_audit_service)
+    archive = False
 
     class Meta:
         verbose_name = 'Rapport (Audit)'
         verbose_name_plural = 'Rapports (Audit)'
         ordering = ['-timestamp']
+        # Un index par filtre de report_list, chacun suivi de l'ordre de pagination (-timestamp, -id),
+        # et l'historique d'un objet
+        indexes = [
+            models.Index(fields=['-timestamp', '-id'], name='auditlog_timestamp_idx'),
+            models.Index(fields=['action', '-timestamp', '-id'], name='auditlog_action_idx'),
+            models.Index(fields=['content_type', '-timestamp', '-id'], name='auditlog_ct_idx'),
+            models.Index(fields=['user', '-timestamp', '-id'], name='auditlog_user_idx'),
+            models.Index(fields=['content_type', 'object_id', '-timestamp'], name='auditlog_objet_idx'),
+        ]
 
     def __str__(self):
         user = self.user.username if self.user else 'System'
@@ -383,6 +518,77 @@ class AuditLog(models.Model):
         return f"[{self.timestamp:%Y-%m-%d %H:%M}] {user} {self.action} {ct} ({self.object_repr or self.object_id})"
 
 
+class SegmentAudit(models.Model):
+    """
+    Fichier d'archive (JSONL compressé, jamais réécrit) de lignes d'AuditLog anciennes
+    d'un même type de contenu. Les segments sont indexés par période et par type de
+    contenu pour les listes, et par plage d'identifiants pour retrouver un rapport.
+    """
+    content_type = models.ForeignKey('contenttypes.ContentType', on_delete=models.SET_NULL, null=True, blank=True)
+    # Chemin relatif au répertoire d'archives (AUDIT_ARCHIVE_DIR)
+    fichier = models.CharField(max_length=255, unique=True)
+    date_debut = models.DateTimeField()
+    date_fin = models.DateTimeField()
+    premier_id = models.BigIntegerField()
+    dernier_id = models.BigIntegerField()
+    nb_lignes = models.PositiveIntegerField()
+    date_creation = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Segment d'archive d'audit"
+        verbose_name_plural = "Segments d'archive d'audit"
+        ordering = ['-date_fin']
+        indexes = [
+            models.Index(fields=['content_type', 'date_fin', 'date_debut'], name='segment_audit_periode_idx'),
+            models.Index(fields=['premier_id', 'dernier_id'], name='segment_audit_ids_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.fichier} ({self.nb_lignes} lignes, {self.date_debut:%Y-%m-%d} → {self.date_fin:%Y-%m-%d})"
+
+
+class ExportAudit(models.Model):
+    """
+    Demande d'export zip des rapports d'audit d'une période. La vue enregistre la demande,
+    le job du scheduler écrit l'archive sous AUDIT_EXPORT_DIR en publiant l'avancement sur
+    la ligne, puis la vue de téléchargement sert le fichier terminé.
+    """
+    STATUT_EN_ATTENTE, STATUT_EN_COURS, STATUT_TERMINE, STATUT_ECHEC = 'EN_ATTENTE', 'EN_COURS', 'TERMINE', 'ECHEC'
+    STATUT_CHOICES = [
+        (STATUT_EN_ATTENTE, 'En attente'),
+        (STATUT_EN_COURS, 'En cours'),
+        (STATUT_TERMINE, 'Terminé'),
+        (STATUT_ECHEC, 'Échec'),
+    ]
+
+    identifiant = models.CharField(max_length=64, unique=True)
+    demandeur = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='exports_audit')
+    debut = models.DateTimeField()
+    fin = models.DateTimeField()
+    # Filtres de ExportAuditService.rapports (action, content_type, user, departement)
+    filtres = models.JSONField(default=dict, blank=True)
+    statut = models.CharField(max_length=20, choices=STATUT_CHOICES, default=STATUT_EN_ATTENTE)
+    faits = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    # Chemin relatif au répertoire des exports (AUDIT_EXPORT_DIR)
+    fichier = models.CharField(max_length=255, blank=True)
+    erreur = models.TextField(blank=True)
+    date_creation = models.DateTimeField(auto_now_add=True)
+    # Dernier signe de vie du traitement (avancement publié)
+    date_maj = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Export d'audit"
+        verbose_name_plural = "Exports d'audit"
+        ordering = ['-date_creation']
+        indexes = [
+            models.Index(fields=['statut', 'date_creation'], name='export_audit_statut_idx'),
+        ]
+
+    def __str__(self):
+        return f"Export {self.identifiant} ({self.debut:%Y-%m-%d} → {self.fin:%Y-%m-%d}, {self.get_statut_display()})"
+
+
 # ============================================================================
 # MODÈLES DE NOTIFICATIONS
 # ============================================================================
@@ -398,6 +604,7 @@ class NotificationLog(models.Model):
     TYPE_RAPPEL_FINAL = 'RAPPEL_FINAL'
     TYPE_RETARD = 'RETARD'
     TYPE_RESTITUTION = 'RESTITUTION'
+    TYPE_ALERTE_CRITIQUE = 'ALERTE_CRITIQUE'
     TYPE_CHOICES = [
         (TYPE_CREATION, 'Notification de création'),
         (TYPE_RAPPEL_2H, 'Rappel 2h avant'),
@@ -406,6 +613,7 @@ class NotificationLog(models.Model):
         (TYPE_RAPPEL_FINAL, 'Rappel jour retour'),
         (TYPE_RETARD, 'Alerte retard'),
         (TYPE_RESTITUTION, 'Confirmation restitution'),
+        (TYPE_ALERTE_CRITIQUE, 'Alerte critique (managers)'),
     ]
     
     # Canaux de communication
@@ -417,16 +625,21 @@ class NotificationLog(models.Model):
     ]
     
     # États de la notification
+    STATUT_EN_ATTENTE = 'EN_ATTENTE'
+    STATUT_EN_COURS = 'EN_COURS'
     STATUT_ENVOYEE = 'ENVOYEE'
     STATUT_ECHEC = 'ECHEC'
     STATUT_ECHEC_PERMANENT = 'ECHEC_PERM'
     STATUT_CHOICES = [
+        (STATUT_EN_ATTENTE, 'En attente (outbox)'),
+        (STATUT_EN_COURS, "En cours d'envoi"),
         (STATUT_ENVOYEE, 'Envoyée'),
         (STATUT_ECHEC, 'Échec (retry en cours)'),
         (STATUT_ECHEC_PERMANENT, 'Échec définitif'),
     ]
     
-    attribution = models.ForeignKey(Attribution, on_delete=models.CASCADE, related_name='notifications')
+    attribution = models.ForeignKey(Attribution, on_delete=models.CASCADE, related_name='notifications', null=True, blank=True)
+    alerte = models.ForeignKey(Alerte, on_delete=models.CASCADE, related_name='notifications', null=True, blank=True)
     type_notification = models.CharField(max_length=20, choices=TYPE_CHOICES)
     canal = models.CharField(max_length=20, choices=CANAL_CHOICES)
     duree_emprunt = models.CharField(max_length=10, help_text="Snapshot de la durée au moment de l'envoi")
@@ -438,6 +651,11 @@ class NotificationLog(models.Model):
     date_tentative_prochaine = models.DateTimeField(null=True, blank=True, help_text="Prochaine tentative de retry")
     erreur_message = models.TextField(blank=True, null=True)
     nb_tentatives = models.IntegerField(default=1)
+    # Réservation par un worker de l'outbox (cf. NotificationOutboxService)
+    lot = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    date_verrou = models.DateTimeField(null=True, blank=True)
+    # Identifiant commun aux notifications envoyées ensemble dans un même message (digest)
+    digest = models.CharField(max_length=32, blank=True, null=True, db_index=True)
     
     class Meta:
         verbose_name = "Notification Log"
@@ -453,6 +671,32 @@ class NotificationLog(models.Model):
         return f"[{self.get_type_notification_display()}] {self.destinataire} - {self.get_statut_display()}"
 
 
+class NotificationPlanifiee(models.Model):
+    """
+    Rappel ou relance de retard planifié pour une attribution en cours.
+    Le plan complet est écrit à la création de l'attribution et recalculé quand sa date
+    de retour change; il est supprimé au retour du matériel.
+    """
+    attribution = models.ForeignKey(Attribution, on_delete=models.CASCADE, related_name='notifications_planifiees')
+    type_notification = models.CharField(max_length=20, choices=NotificationLog.TYPE_CHOICES)
+    date_prevue = models.DateTimeField()
+    # Réservation par le job qui dépile les notifications échues
+    lot = models.CharField(max_length=32, blank=True, null=True)
+
+    class Meta:
+        verbose_name = "Notification planifiée"
+        verbose_name_plural = "Notifications planifiées"
+        constraints = [
+            models.UniqueConstraint(fields=['attribution', 'type_notification'], name='notification_planifiee_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['date_prevue'], name='notif_planifiee_echeance_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_type_notification_display()} - attribution {self.attribution_id} le {self.date_prevue}"
+
+
 class NotificationPreferences(models.Model):
     """Préférences de notifications par utilisateur/client"""
     
@@ -0,0 +1,252 @@
+# assets/outbox_service.py
+"""
+Outbox transactionnelle des notifications
+
+Les notifications ne sont plus envoyées dans la requête: elles sont écrites comme
+NotificationLog en statut EN_ATTENTE dans la transaction qui les déclenche, et ne
+deviennent donc visibles qu'à sa validation. Le worker `manage.py traiter_notifications`
+réserve ensuite des lots et les envoie hors du chemin de la requête: les emails sur une
+connexion SMTP partagée par lot, les messages WhatsApp en parallèle à débit limité.
+Les envois en échec sont replanifiés puis relancés par le même worker (cf. retry_service).
+
+Mode digest: les notifications d'attribution d'un lot adressées au même destinataire,
+par le même canal et de même type, partent en un seul message listant chaque matériel.
+Chaque notification reste une ligne de NotificationLog, liée aux autres par `digest`.
+
+Paramètres (settings, optionnels):
+    NOTIFICATION_DIGEST_ACTIF    regrouper les notifications (défaut: True)
+    NOTIFICATION_DIGEST_FENETRE  attente en secondes avant l'envoi d'une notification
+                                 d'attribution, pour collecter les suivantes (défaut: 0)
+"""
+import uuid
+import logging
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import Alerte, NotificationLog
+from .retry_service import NotificationRetryService
+from users.models import ProfilUtilisateur
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationOutboxService:
+    """Écriture dans l'outbox et traitement des lots par le worker"""
+
+    # Au-delà, une réservation est considérée abandonnée (worker arrêté en cours d'envoi)
+    DELAI_VERROU = timedelta(minutes=10)
+
+    @staticmethod
+    def enfiler_alertes_critiques(alertes):
+        """
+        Ajoute à l'outbox un email par manager actif du département de chaque alerte critique.
+        Une requête pour les managers et un seul `bulk_create`, quelle que soit la taille du lot.
+        """
+        alertes = [a for a in alertes if a.severite == Alerte.SEVERITE_CRITICAL]
+        if not alertes:
+            return []
+        emails_par_departement = {}
+        managers = ProfilUtilisateur.objects.filter(
+            departement_id__in={a.departement_id for a in alertes},
+            role__in=['SUPER_ADMIN', 'DEPT_MANAGER'],
+            actif=True,
+        ).exclude(user__email='').values_list('departement_id', 'user__email')
+        for departement_id, email in managers:
+            emails_par_departement.setdefault(departement_id, set()).add(email)
+
+        notifications = [
+            NotificationLog(
+                alerte=alerte,
+                type_notification=NotificationLog.TYPE_ALERTE_CRITIQUE,
+                canal=NotificationLog.CANAL_EMAIL,
+                duree_emprunt='',
+                destinataire=email,
+                statut=NotificationLog.STATUT_EN_ATTENTE,
+            )
+            for alerte in alertes
+            for email in sorted(emails_par_departement.get(alerte.departement_id, ()))
+        ]
+        return NotificationLog.objects.bulk_create(notifications, batch_size=500)
+
+    @staticmethod
+    def digest_actif():
+        return getattr(settings, 'NOTIFICATION_DIGEST_ACTIF', True)
+
+    @staticmethod
+    def marquer(notifications, **champs):
+        """Applique les mêmes valeurs à un groupe de notifications, en base et sur les instances"""
+        for notification in notifications:
+            for champ, valeur in champs.items():
+                setattr(notification, champ, valeur)
+        NotificationLog.objects.filter(pk__in=[n.pk for n in notifications]).update(**champs)
+
+    @classmethod
+    def reserver_lot(cls, taille=50):
+        """
+        Réserve jusqu'à `taille` notifications pour ce worker: d'abord celles en attente,
+        puis les relances échues, puis (digest) les notifications qui rejoignent un groupe
+        du lot. Le lot ne dépasse jamais `taille`, pour être envoyé bien avant DELAI_VERROU.
+
+        La réservation est un UPDATE conditionnel sur le statut avec un jeton de lot:
+        deux workers concurrents ne peuvent pas réserver la même ligne, sans dépendre
+        de SELECT ... FOR UPDATE SKIP LOCKED (indisponible sous SQLite).
+        """
+        maintenant = timezone.now()
+        en_attente = Q(statut=NotificationLog.STATUT_EN_ATTENTE)
+        fenetre = getattr(settings, 'NOTIFICATION_DIGEST_FENETRE', 0)
+        if cls.digest_actif() and fenetre:
+            # Une notification d'attribution attend la fenêtre pour être regroupée avec les suivantes
+            en_attente &= Q(attribution__isnull=True) | Q(date_envoi__lte=maintenant - timedelta(seconds=fenetre))
+        disponibles = en_attente | Q(
+            statut=NotificationLog.STATUT_EN_COURS,
+            date_verrou__lt=maintenant - cls.DELAI_VERROU,
+        )
+        candidats = list(
+            NotificationLog.objects.filter(disponibles).order_by('id').values_list('id', flat=True)[:taille]
+        )
+        lot = uuid.uuid4().hex
+        reservees = 0
+        if candidats:
+            reservees = NotificationLog.objects.filter(disponibles, id__in=candidats).update(
+                statut=NotificationLog.STATUT_EN_COURS, lot=lot, date_verrou=maintenant,
+            )
+        reservees += NotificationRetryService.reserver(taille - reservees, lot)
+        if not reservees:
+            return []
+        if cls.digest_actif():
+            cls._reserver_groupes(lot, maintenant, taille - reservees)
+        return list(
+            NotificationLog.objects.filter(lot=lot, statut=NotificationLog.STATUT_EN_COURS)
+            .select_related('attribution__materiel', 'attribution__client', 'alerte__departement')
+            .order_by('id')
+        )
+
+    @staticmethod
+    def _reserver_groupes(lot, maintenant, limite):
+        """
+        Ajoute au lot, dans la limite de `limite` lignes et par ancienneté, les notifications
+        en attente qui rejoindront un digest du lot (même destinataire, canal et type), même
+        si leur fenêtre n'est pas écoulée. Les autres partiront dans un lot suivant.
+        Retourne le nombre de notifications ajoutées.
+        """
+        if limite <= 0:
+            return 0
+        cles = set(
+            NotificationLog.objects.filter(lot=lot, attribution__isnull=False)
+            .values_list('destinataire', 'canal', 'type_notification')
+        )
+        if not cles:
+            return 0
+        en_attente = Q(statut=NotificationLog.STATUT_EN_ATTENTE, attribution__isnull=False)
+        candidats = list(
+            NotificationLog.objects.filter(
+                en_attente,
+                reduce(or_, (Q(destinataire=d, canal=c, type_notification=t) for d, c, t in cles)),
+            ).order_by('id').values_list('id', flat=True)[:limite]
+        )
+        if not candidats:
+            return 0
+        return NotificationLog.objects.filter(en_attente, id__in=candidats).update(
+            statut=NotificationLog.STATUT_EN_COURS, lot=lot, date_verrou=maintenant,
+        )
+
+    @classmethod
+    def regrouper(cls, notifications):
+        """
+        Découpe un lot en unités d'envoi: une notification seule, ou la liste des notifications
+        d'attribution d'un même destinataire, canal et type (digest)
+        """
+        if not cls.digest_actif():
+            return list(notifications)
+        groupes = {}
+        unites = []
+        for notification in notifications:
+            if notification.attribution_id is None:
+                unites.append(notification)
+                continue
+            cle = (notification.destinataire, notification.canal, notification.type_notification)
+            if cle not in groupes:
+                groupes[cle] = []
+                unites.append(groupes[cle])
+            groupes[cle].append(notification)
+        return [u[0] if isinstance(u, list) and len(u) == 1 else u for u in unites]
+
+    @staticmethod
+    def envoyer(notification_log, connexion=None):
+        """
+        Envoie une notification réservée via le service de son canal; retourne True si envoyée.
+        Les emails passent par la connexion SMTP partagée du lot si elle est fournie.
+        """
+        from .email_service import EmailAlerteService, NotificationEmailService
+        from .whatsapp_service import WhatsAppNotificationService
+
+        try:
+            if notification_log.type_notification == NotificationLog.TYPE_ALERTE_CRITIQUE:
+                envoyee = EmailAlerteService.envoyer_notification_alerte(notification_log, connexion)
+            elif notification_log.canal == NotificationLog.CANAL_WHATSAPP:
+                envoyee = WhatsAppNotificationService.send_notification(notification_log)
+            else:
+                envoyee = NotificationEmailService.send_notification(notification_log, connexion)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'envoi de la notification {notification_log.id}: {e}", exc_info=True)
+            notification_log.erreur_message = str(e)
+            envoyee = False
+        return envoyee
+
+    @classmethod
+    def _envoyer_emails(cls, unites):
+        """Envoie les emails du lot (seuls ou en digest) sur une seule connexion SMTP; retourne les métriques"""
+        from .email_service import ConnexionEmailPartagee, NotificationEmailService
+
+        with ConnexionEmailPartagee() as connexion:
+            for unite in unites:
+                if isinstance(unite, list):
+                    NotificationEmailService.send_digest(unite, connexion)
+                else:
+                    cls.envoyer(unite, connexion)
+        metriques = connexion.metriques()
+        logger.info(
+            f"Lot email: {metriques['envoyes']} envoyé(s), {metriques['echecs']} échec(s), "
+            f"{metriques['reconnexions']} reconnexion(s) en {metriques['duree']}s ({metriques['debit']} msg/s)"
+        )
+        return metriques
+
+    @classmethod
+    def traiter_lot(cls, taille=50, concurrence=4):
+        """
+        Réserve puis envoie un lot: les emails sur une connexion SMTP partagée, les
+        messages WhatsApp par le dispatcher à débit limité, puis replanifie les échecs.
+        Retourne {'reservees', 'messages', 'envoyees', 'echecs', 'definitifs', 'email'}
+        où 'messages' compte les messages réellement émis (digests compris) et 'email'
+        contient les métriques de débit du lot d'emails.
+        """
+        from .whatsapp_service import WhatsAppNotificationService
+
+        notifications = cls.reserver_lot(taille)
+        unites = cls.regrouper(notifications)
+
+        def canal(unite):
+            return (unite[0] if isinstance(unite, list) else unite).canal
+
+        emails = [u for u in unites if canal(u) == NotificationLog.CANAL_EMAIL]
+        whatsapp = [u for u in unites if canal(u) == NotificationLog.CANAL_WHATSAPP]
+
+        metriques_email = None
+        if emails:
+            metriques_email = cls._envoyer_emails(emails)
+        if whatsapp:
+            # Pool borné + limiteur de débit partagé (token bucket, backoff sur 429)
+            WhatsAppNotificationService.dispatch(whatsapp, concurrence)
+
+        envoyees = sum(1 for n in notifications if n.statut == NotificationLog.STATUT_ENVOYEE)
+        return {
+            'reservees': len(notifications),
+            'messages': len(unites),
+            'envoyees': envoyees,
+            'echecs': len(notifications) - envoyees,
+            'definitifs': NotificationRetryService.planifier_echecs(notifications),
+            'email': metriques_email,
+        }
@@ -0,0 +1,130 @@
+# assets/planification_service.py
+"""
+Plan des rappels et relances de retard des attributions
+
+À la création d'une attribution, ou quand sa date de retour change, son plan complet
+(rappel 2h, J-2, J-1, jour du retour, retard) est écrit dans NotificationPlanifiee,
+indexé par date prévue; le retour du matériel supprime le plan. Le job
+`process_due_notifications` n'a plus qu'à dépiler chaque minute les lignes échues
+et à les mettre en file dans l'outbox: un passage sans échéance coûte une requête.
+"""
+import uuid
+import logging
+from datetime import datetime, time, timedelta
+from django.db import transaction
+from django.utils import timezone
+from .models import Attribution, NotificationLog, NotificationPlanifiee
+
+logger = logging.getLogger(__name__)
+
+
+class PlanificationService:
+    """Calcul, écriture et dépilement des plans de notifications"""
+
+    # Heure d'envoi des rappels long terme (J-2, J-1, jour du retour)
+    HEURE_RAPPELS = time(8, 0)
+    # Délai du rappel avant l'heure de retour (court et moyen terme)
+    AVANCE_RAPPEL_2H = timedelta(hours=2)
+    # Intervalle entre deux relances de retard
+    INTERVALLE_RETARD = timedelta(days=1)
+
+    @staticmethod
+    def _date_locale(jour, heure=time.min):
+        return timezone.make_aware(datetime.combine(jour, heure))
+
+    @classmethod
+    def calculer_plan(cls, attribution, maintenant=None):
+        """
+        Retourne {type_notification: date_prevue} pour une attribution en cours.
+        Les rappels dont l'heure est passée sont omis, sauf le rappel 2h qui part
+        immédiatement tant que le retour est à venir; un retard déjà constaté est
+        relancé immédiatement.
+        """
+        if attribution.date_retour_effective or not attribution.date_retour_prevue:
+            return {}
+        maintenant = maintenant or timezone.now()
+        retour = attribution.date_retour_prevue
+        plan = {}
+
+        if attribution.duree_emprunt in (Attribution.DUREE_COURT_TERME, Attribution.DUREE_MOYEN_TERME):
+            if attribution.heure_retour_prevue and attribution.echeance and attribution.echeance > maintenant:
+                plan[NotificationLog.TYPE_RAPPEL_2H] = max(attribution.echeance - cls.AVANCE_RAPPEL_2H, maintenant)
+        else:
+            for jours, type_notification in (
+                (2, NotificationLog.TYPE_RAPPEL_J_MOINS_2),
+                (1, NotificationLog.TYPE_RAPPEL_J_MOINS_1),
+                (0, NotificationLog.TYPE_RAPPEL_FINAL),
+            ):
+                date_prevue = cls._date_locale(retour - timedelta(days=jours), cls.HEURE_RAPPELS)
+                if date_prevue >= maintenant:
+                    plan[type_notification] = date_prevue
+
+        # En retard à partir du lendemain de la date de retour prévue
+        plan[NotificationLog.TYPE_RETARD] = max(cls._date_locale(retour + timedelta(days=1)), maintenant)
+        return plan
+
+    @classmethod
+    def planifier(cls, attribution):
+        """Remplace le plan de l'attribution (le supprime si elle est rendue)"""
+        with transaction.atomic():
+            NotificationPlanifiee.objects.filter(attribution=attribution).delete()
+            NotificationPlanifiee.objects.bulk_create([
+                NotificationPlanifiee(attribution=attribution, type_notification=type_notification, date_prevue=date_prevue)
+                for type_notification, date_prevue in cls.calculer_plan(attribution).items()
+            ])
+
+    @classmethod
+    def reconstruire(cls):
+        """Recalcule le plan de toutes les attributions en cours; retourne le nombre de lignes écrites"""
+        maintenant = timezone.now()
+        with transaction.atomic():
+            NotificationPlanifiee.objects.all().delete()
+            lignes = [
+                NotificationPlanifiee(attribution=attribution, type_notification=type_notification, date_prevue=date_prevue)
+                for attribution in Attribution.objects.filter(date_retour_effective__isnull=True).iterator(chunk_size=2000)
+                for type_notification, date_prevue in cls.calculer_plan(attribution, maintenant).items()
+            ]
+            NotificationPlanifiee.objects.bulk_create(lignes, batch_size=500)
+        return len(lignes)
+
+    @staticmethod
+    def echues(taille=500):
+        """Identifiants d'au plus `taille` notifications planifiées échues et libres, par date prévue"""
+        return list(
+            NotificationPlanifiee.objects.filter(date_prevue__lte=timezone.now(), lot__isnull=True)
+            .order_by('date_prevue')
+            .values_list('id', flat=True)[:taille]
+        )
+
+    @staticmethod
+    def reserver(candidats):
+        """
+        Réserve les notifications planifiées `candidats` encore libres et les retourne.
+        Les plans d'attributions rendues sans passer par save() (mise à jour en masse)
+        sont supprimés au lieu d'être réservés.
+        À appeler dans une transaction: la réservation n'est visible des autres
+        processus qu'une fois les lignes traitées et la transaction validée.
+        """
+        lot = uuid.uuid4().hex
+        libres = NotificationPlanifiee.objects.filter(id__in=candidats, lot__isnull=True)
+        libres.filter(attribution__date_retour_effective__isnull=False).delete()
+        libres.filter(attribution__date_retour_effective__isnull=True).update(lot=lot)
+        return list(
+            NotificationPlanifiee.objects.filter(lot=lot)
+            .select_related('attribution__client', 'attribution__materiel')
+            .order_by('date_prevue')
+        )
+
+    @classmethod
+    def terminer(cls, planifiees):
+        """Supprime les rappels traités et reporte d'un intervalle les relances de retard"""
+        maintenant = timezone.now()
+        retards = [p for p in planifiees if p.type_notification == NotificationLog.TYPE_RETARD]
+        for planifiee in retards:
+            while planifiee.date_prevue <= maintenant:
+                planifiee.date_prevue += cls.INTERVALLE_RETARD
+            planifiee.lot = None
+        NotificationPlanifiee.objects.bulk_update(retards, ['date_prevue', 'lot'])
+        NotificationPlanifiee.objects.filter(
+            pk__in=[p.pk for p in planifiees if p.type_notification != NotificationLog.TYPE_RETARD]
+        ).delete()
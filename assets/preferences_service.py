@@ -0,0 +1,76 @@
+# assets/preferences_service.py
+"""
+Résolution en lecture seule des préférences de notification des clients
+
+Un client sans préférences enregistrées reçoit les valeurs par défaut du modèle, sans
+qu'aucune ligne ne soit créée. Les préférences résolues sont mises en cache par client
+et invalidées par les signaux de NotificationPreferences; les lots de rappels les
+chargent en une seule lecture du cache et une seule requête pour les absents.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from .models import NotificationPreferences
+
+
+class PreferencesService:
+    """Préférences de notification effectives par client"""
+
+    CHAMPS = (
+        'notifications_email', 'notifications_whatsapp', 'phone_number',
+        'rappel_j_moins_2', 'rappel_j_moins_1', 'rappel_final', 'rappel_2h_avant',
+    )
+    DUREE_CACHE = 3600  # secondes, filet de sécurité en plus de l'invalidation par signaux
+
+    @staticmethod
+    def _cle(client_id):
+        return f"notification_preferences:client:{client_id}"
+
+    @classmethod
+    def _valeurs_par_defaut(cls):
+        defaut = NotificationPreferences()
+        return {champ: getattr(defaut, champ) for champ in cls.CHAMPS}
+
+    @classmethod
+    def pour_clients(cls, client_ids):
+        """
+        Retourne {client_id: NotificationPreferences} (instances non enregistrées pour les
+        clients sans préférences) en une lecture du cache et au plus une requête
+        """
+        client_ids = {client_id for client_id in client_ids if client_id is not None}
+        if not client_ids:
+            return {}
+        cles = {cls._cle(client_id): client_id for client_id in client_ids}
+        valeurs = {cles[cle]: v for cle, v in cache.get_many(cles).items()}
+
+        manquants = client_ids - valeurs.keys()
+        if manquants:
+            trouvees = {
+                ligne['client_id']: {champ: ligne[champ] for champ in cls.CHAMPS}
+                for ligne in NotificationPreferences.objects.filter(client_id__in=manquants)
+                .values('client_id', *cls.CHAMPS)
+            }
+            defaut = cls._valeurs_par_defaut()
+            nouvelles = {client_id: trouvees.get(client_id, defaut) for client_id in manquants}
+            cache.set_many({cls._cle(client_id): v for client_id, v in nouvelles.items()}, cls.DUREE_CACHE)
+            valeurs.update(nouvelles)
+
+        return {
+            client_id: NotificationPreferences(client_id=client_id, **v)
+            for client_id, v in valeurs.items()
+        }
+
+    @classmethod
+    def pour_client(cls, client):
+        """Préférences effectives d'un client (valeurs par défaut si aucune n'est enregistrée)"""
+        if client is None:
+            return NotificationPreferences(**cls._valeurs_par_defaut())
+        return cls.pour_clients([client.pk])[client.pk]
+
+    @classmethod
+    def invalider(cls, client_id):
+        """Retire les préférences du client du cache, maintenant et après la validation de la transaction"""
+        if client_id is None:
+            return
+        cle = cls._cle(client_id)
+        cache.delete(cle)
+        transaction.on_commit(lambda: cache.delete(cle))
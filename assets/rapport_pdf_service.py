@@ -0,0 +1,203 @@
+# assets/rapport_pdf_service.py
+"""
+Cache disque des rapports d'audit en PDF
+
+Une entrée d'audit ne change plus une fois écrite: son PDF est rendu une seule fois puis
+servi depuis le disque. Le fichier est adressé par le contenu qui le détermine, à savoir
+le pk du rapport et une empreinte du rendu: les sources de report_pdf.html et de tous
+les gabarits qu'il étend ou inclut, et VERSION_RENDU pour le contexte construit par les
+vues (phrases, libellés). Modifier un gabarit, ou incrémenter VERSION_RENDU quand les
+constructeurs de views.py changent, invalide les PDF déjà produits. Le job
+`pregenerate_report_pdfs` rend en arrière-plan les PDF des rapports récents, et les
+moteurs PDF disponibles (WeasyPrint, puis wkhtmltopdf via pdfkit) ne sont recherchés
+qu'une fois par processus.
+
+Le PDF est rendu sans la requête de l'utilisateur qui le demande, pour qu'un même
+fichier puisse être servi à tous: il reflète l'état du rapport (et de l'attribution
+qu'il décrit) à sa première génération.
+
+Paramètres (settings, optionnels):
+    REPORT_PDF_CACHE_DIR        répertoire du cache (défaut: BASE_DIR/cache/rapports_pdf)
+    REPORT_PDF_PREGENERATION    pré-générer les PDF des nouveaux rapports (défaut: True)
+"""
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from django.conf import settings
+from django.template import Context
+from django.template.loader import get_template, render_to_string
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+
+class RapportPdfService:
+    """Génération, cache et pré-génération des PDF des rapports d'audit"""
+
+    GABARIT = 'assets/report_pdf.html'
+    # À incrémenter à chaque changement du contexte du rapport (_report_context et ses phrases)
+    VERSION_RENDU = 1
+    # Nombre maximal de PDF pré-générés par passage du job
+    LIMITE_PREGENERATION = 200
+
+    _verrou = threading.Lock()
+    _moteurs = None
+    _empreinte = None
+
+    @staticmethod
+    def repertoire():
+        return str(getattr(settings, 'REPORT_PDF_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'rapports_pdf')))
+
+    @classmethod
+    def gabarits(cls):
+        """Gabarits du rendu: report_pdf.html et ceux qu'il étend ou inclut, récursivement"""
+        noms, a_lire = [], [cls.GABARIT]
+        while a_lire:
+            nom = a_lire.pop()
+            if nom in noms:
+                continue
+            noms.append(nom)
+            for node in get_template(nom).template.nodelist.get_nodes_by_type((ExtendsNode, IncludeNode)):
+                expression = node.parent_name if isinstance(node, ExtendsNode) else node.template
+                try:
+                    # Seuls les noms littéraux sont connus sans contexte de rendu
+                    inclus = expression.resolve(Context())
+                except Exception:
+                    continue
+                if inclus and isinstance(inclus, str):
+                    a_lire.append(inclus)
+        return noms
+
+    @classmethod
+    def empreinte_gabarits(cls):
+        """Empreinte du rendu (recalculée à chaque appel en DEBUG, où les gabarits peuvent changer)"""
+        if cls._empreinte is None or settings.DEBUG:
+            empreinte = hashlib.sha256(f"rendu:{cls.VERSION_RENDU}".encode('utf-8'))
+            for nom in sorted(cls.gabarits()):
+                empreinte.update(nom.encode('utf-8'))
+                empreinte.update(get_template(nom).template.source.encode('utf-8'))
+            cls._empreinte = empreinte.hexdigest()[:16]
+        return cls._empreinte
+
+    @classmethod
+    def chemin(cls, pk):
+        return os.path.join(cls.repertoire(), f"rapport_{pk}_{cls.empreinte_gabarits()}.pdf")
+
+    # ------------------------------------------------------------------
+    # Moteurs PDF
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def moteurs(cls):
+        """Liste [(nom, fonction(html, base_url) -> bytes)] des moteurs disponibles, recherchés une fois"""
+        if cls._moteurs is None:
+            with cls._verrou:
+                if cls._moteurs is None:
+                    cls._moteurs = cls._decouvrir_moteurs()
+                    logger.info(f"Moteurs PDF disponibles: {[nom for nom, _ in cls._moteurs] or 'aucun'}")
+        return cls._moteurs
+
+    @staticmethod
+    def _commande_wkhtmltopdf():
+        """Binaire wkhtmltopdf: variable WKHTMLTOPDF_CMD, PATH, puis copie locale sous <projet>/bin/"""
+        commande = os.environ.get('WKHTMLTOPDF_CMD') or shutil.which('wkhtmltopdf')
+        if commande:
+            return commande
+        bin_dir = os.path.join(getattr(settings, 'BASE_DIR', os.getcwd()), 'bin')
+        if os.path.isdir(bin_dir):
+            for root, dirs, files in os.walk(bin_dir):
+                for f in files:
+                    if f.lower().startswith('wkhtmltopdf'):
+                        return os.path.join(root, f)
+        return None
+
+    @classmethod
+    def _decouvrir_moteurs(cls):
+        moteurs = []
+        try:
+            from weasyprint import HTML
+
+            def weasyprint(html, base_url):
+                return HTML(string=html, base_url=base_url).write_pdf()
+            moteurs.append(('weasyprint', weasyprint))
+        except Exception:
+            # WeasyPrint absent, ou ses bibliothèques natives manquantes
+            pass
+
+        try:
+            import pdfkit
+            commande = cls._commande_wkhtmltopdf()
+            if commande:
+                configuration = pdfkit.configuration(wkhtmltopdf=commande)
+                # Allow local file access and ignore minor load errors so wkhtmltopdf
+                # can render templates referencing /static/... files when no HTTP server
+                # is available during headless requests.
+                options = {
+                    'enable-local-file-access': '',
+                    'load-error-handling': 'ignore',
+                    'encoding': 'UTF-8',
+                }
+
+                def wkhtmltopdf(html, base_url):
+                    return pdfkit.from_string(html, False, options=options, configuration=configuration)
+                moteurs.append(('wkhtmltopdf', wkhtmltopdf))
+        except Exception:
+            # pdfkit non installé
+            pass
+        return moteurs
+
+    # ------------------------------------------------------------------
+    # Génération et cache
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def generer(cls, report, base_url=None):
+        """Rend le PDF du rapport avec le premier moteur qui réussit et l'écrit dans le cache; retourne son chemin ou None"""
+        from .views import _report_context
+
+        moteurs = cls.moteurs()
+        if not moteurs:
+            return None
+        base_url = base_url or getattr(settings, 'SITE_URL', 'http://localhost:8000')
+        html = render_to_string(cls.GABARIT, _report_context(report))
+        for nom, moteur in moteurs:
+            try:
+                pdf = moteur(html, base_url)
+                break
+            except Exception as e:
+                logger.warning(f"Échec du rendu PDF du rapport {report.pk} avec {nom}: {e}")
+        else:
+            return None
+
+        chemin = cls.chemin(report.pk)
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+        # Fichier temporaire propre au thread puis renommage: un PDF en cache est toujours complet
+        temporaire = f"{chemin}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporaire, 'wb') as f:
+            f.write(pdf)
+        os.replace(temporaire, chemin)
+        return chemin
+
+    @classmethod
+    def obtenir(cls, report, base_url=None):
+        """Chemin du PDF du rapport, servi depuis le cache ou généré; None si aucun moteur n'a réussi"""
+        chemin = cls.chemin(report.pk)
+        if os.path.exists(chemin):
+            return chemin
+        return cls.generer(report, base_url)
+
+    @classmethod
+    def pregenerer(cls, depuis, limite=None):
+        """Génère les PDF absents du cache des rapports écrits depuis `depuis`; retourne leur nombre"""
+        if not getattr(settings, 'REPORT_PDF_PREGENERATION', True) or not cls.moteurs():
+            return 0
+        pks = AuditLog.objects.filter(timestamp__gte=depuis).order_by('-timestamp', '-id').values_list('pk', flat=True)
+        manquants = [pk for pk in pks[:limite or cls.LIMITE_PREGENERATION] if not os.path.exists(cls.chemin(pk))]
+        generes = 0
+        for report in AuditLog.objects.filter(pk__in=manquants).select_related('user', 'content_type'):
+            if cls.generer(report):
+                generes += 1
+        return generes
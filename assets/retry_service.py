@@ -0,0 +1,109 @@
+# assets/retry_service.py
+"""
+Relance des notifications en échec
+
+Un envoi en échec n'est plus définitif: la notification reste en statut ECHEC avec une
+date de prochaine tentative calculée par backoff exponentiel avec jitter. Le worker de
+l'outbox réserve les relances échues par lots via l'index (statut, date_tentative_prochaine),
+avec le même UPDATE conditionnel que pour les nouvelles notifications: une ligne ne peut
+être relancée que par un seul worker à la fois. Au-delà du nombre maximal de tentatives,
+la notification passe en ECHEC_PERM.
+
+Paramètres (settings, optionnels):
+    NOTIFICATION_RETRY_MAX_TENTATIVES   nombre total de tentatives (défaut: 5)
+    NOTIFICATION_RETRY_DELAI_BASE       délai avant la première relance, en secondes (défaut: 60)
+    NOTIFICATION_RETRY_DELAI_MAX        plafond du délai entre deux tentatives, en secondes (défaut: 3600)
+"""
+import random
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import NotificationLog
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationRetryService:
+    """Planification et réservation des relances de notifications"""
+
+    @staticmethod
+    def max_tentatives():
+        return getattr(settings, 'NOTIFICATION_RETRY_MAX_TENTATIVES', 5)
+
+    @staticmethod
+    def delai(nb_tentatives):
+        """
+        Délai avant la tentative suivante, après `nb_tentatives` tentatives.
+        Backoff exponentiel plafonné, dont la seconde moitié est tirée au hasard
+        ("equal jitter") pour étaler les relances d'un même lot en échec.
+        """
+        base = getattr(settings, 'NOTIFICATION_RETRY_DELAI_BASE', 60)
+        plafond = getattr(settings, 'NOTIFICATION_RETRY_DELAI_MAX', 3600)
+        secondes = min(plafond, base * 2 ** max(nb_tentatives - 1, 0))
+        return timedelta(seconds=secondes / 2 + random.uniform(0, secondes / 2))
+
+    @classmethod
+    def planifier_echecs(cls, notifications):
+        """
+        Planifie la relance des notifications du lot qui ont échoué, ou qu'un service a
+        laissées réservées sans statut final; passe en ECHEC_PERM celles qui ont épuisé
+        leurs tentatives. Chaque mise à jour est conditionnée au jeton de lot, pour ne pas
+        écraser une ligne dont la réservation a expiré et été reprise par un autre worker.
+        Retourne le nombre de notifications passées en échec définitif.
+        """
+        maintenant = timezone.now()
+        maximum = cls.max_tentatives()
+        definitifs = 0
+        for notification in notifications:
+            if notification.statut not in (NotificationLog.STATUT_ECHEC, NotificationLog.STATUT_EN_COURS):
+                continue
+            notification.erreur_message = notification.erreur_message or "Envoi abandonné par le service"
+            if notification.nb_tentatives >= maximum:
+                notification.statut = NotificationLog.STATUT_ECHEC_PERMANENT
+                notification.date_tentative_prochaine = None
+                definitifs += 1
+                logger.warning(
+                    f"Notification {notification.id} en échec définitif après "
+                    f"{notification.nb_tentatives} tentative(s): {notification.erreur_message}"
+                )
+            else:
+                notification.statut = NotificationLog.STATUT_ECHEC
+                notification.date_tentative_prochaine = maintenant + cls.delai(notification.nb_tentatives)
+            NotificationLog.objects.filter(pk=notification.pk, lot=notification.lot).update(
+                statut=notification.statut,
+                erreur_message=notification.erreur_message,
+                date_tentative_prochaine=notification.date_tentative_prochaine,
+            )
+        return definitifs
+
+    @staticmethod
+    def reserver(taille, lot):
+        """
+        Réserve jusqu'à `taille` relances échues sous le jeton `lot` et compte la tentative.
+
+        Les candidats sont lus dans l'ordre de l'index (statut, date_tentative_prochaine);
+        l'UPDATE reprend le filtre complet, donc une ligne déjà réservée par un autre worker
+        (statut passé à EN_COURS) n'est pas réservée une seconde fois.
+        """
+        if taille <= 0:
+            return 0
+        echues = {
+            'statut': NotificationLog.STATUT_ECHEC,
+            'date_tentative_prochaine__lte': timezone.now(),
+        }
+        candidats = list(
+            NotificationLog.objects.filter(**echues)
+            .order_by('date_tentative_prochaine')
+            .values_list('id', flat=True)[:taille]
+        )
+        if not candidats:
+            return 0
+        return NotificationLog.objects.filter(id__in=candidats, **echues).update(
+            statut=NotificationLog.STATUT_EN_COURS,
+            lot=lot,
+            date_verrou=timezone.now(),
+            date_tentative_prochaine=None,
+            nb_tentatives=F('nb_tentatives') + 1,
+        )
@@ -3,14 +3,76 @@ Notification scheduling jobs for APScheduler
 Handles automated reminders and monitoring for material loans
 """
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from django.db.models import Case, Exists, OuterRef, Q, Subquery, Value, When
 from django.utils import timezone
-from assets.models import Attribution, NotificationLog, NotificationPreferences
-from assets.email_service import NotificationEmailService
+from assets.models import Attribution, NotificationLog
+from assets.preferences_service import PreferencesService
 
 logger = logging.getLogger(__name__)
 
 
+# Reminder window before the expected return time (short and medium-term loans)
+REMINDER_WINDOW = timedelta(hours=2, minutes=30)
+
+# Outbox statuses of a notification that was already queued or handled: the jobs never
+# queue it again (ECHEC rows are retried by the worker, ECHEC_PERM is final)
+HANDLED_STATUSES = (
+    NotificationLog.STATUT_EN_ATTENTE, NotificationLog.STATUT_EN_COURS, NotificationLog.STATUT_ENVOYEE,
+    NotificationLog.STATUT_ECHEC, NotificationLog.STATUT_ECHEC_PERMANENT,
+)
+
+
+def _start_of_day(day):
+    """Aware datetime at local midnight of `day`, comparable with Attribution.echeance"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _handled_notifications(type_notification):
+    """Email notifications of a type already queued or handled for the outer attribution"""
+    return NotificationLog.objects.filter(
+        attribution=OuterRef('pk'),
+        type_notification=type_notification,
+        canal=NotificationLog.CANAL_EMAIL,
+        statut__in=HANDLED_STATUSES,
+    )
+
+
+def _open_attributions():
+    """Loans not returned yet; matches the condition of the partial echeance index"""
+    return Attribution.objects.filter(date_retour_effective__isnull=True).select_related('client', 'materiel')
+
+
+def _check_two_hour_reminders(duree_emprunt, label):
+    """
+    Queue the 2h reminder for loans of the given duration whose return falls in the
+    reminder window. Only rows inside the window are read, through the echeance index,
+    and loans already reminded are excluded by the same query.
+    """
+    now = timezone.now()
+    already_reminded = _handled_notifications(NotificationLog.TYPE_RAPPEL_2H)
+    attributions = _open_attributions().filter(
+        duree_emprunt=duree_emprunt,
+        heure_retour_prevue__isnull=False,
+        echeance__gte=now,
+        echeance__lte=now + REMINDER_WINDOW,
+    ).alias(already_reminded=Exists(already_reminded)).filter(already_reminded=False)
+
+    attributions = list(attributions)
+    preferences = PreferencesService.pour_clients(a.client_id for a in attributions)
+
+    reminder_sent_count = 0
+    for attribution in attributions:
+        _send_reminder_notification(
+            attribution,
+            NotificationLog.TYPE_RAPPEL_2H,
+            reason=f"{label} 2h before return",
+            preferences=preferences.get(attribution.client_id),
+        )
+        reminder_sent_count += 1
+    return reminder_sent_count
+
+
 def check_court_terme_reminders():
     """
     Check and send reminders for short-term loans (< 4 hours)
@@ -18,46 +80,7 @@ def check_court_terme_reminders():
     Called every 30 minutes
     """
     try:
-        now = timezone.now()
-        
-        # Find attributions with court terme loans that need reminders
-        # Not yet returned and within 2.5 hours of return time
-        attributions = Attribution.objects.filter(
-            duree_emprunt=Attribution.DUREE_COURT_TERME,
-            heure_retour_effective__isnull=True,  # Not returned yet
-        ).select_related('client', 'materiel')
-        
-        reminder_sent_count = 0
-        
-        for attribution in attributions:
-            if attribution.heure_retour_prevue is None:
-                continue
-            
-            # Calculate time until return
-            return_datetime = datetime.combine(
-                attribution.date_retour_prevue,
-                attribution.heure_retour_prevue
-            )
-            return_datetime = timezone.make_aware(return_datetime)
-            
-            time_until_return = return_datetime - now
-            
-            # Send reminder if within 2.5 hour window and not yet sent
-            if timedelta(minutes=0) <= time_until_return <= timedelta(hours=2, minutes=30):
-                if not NotificationLog.objects.filter(
-                    attribution=attribution,
-                    type_notification=NotificationLog.TYPE_RAPPEL_2H,
-                    canal=NotificationLog.CANAL_EMAIL,
-                    statut__in=[NotificationLog.STATUT_ENVOYEE, NotificationLog.STATUT_ECHEC],
-                ).exists():
-                    
-                    _send_reminder_notification(
-                        attribution,
-                        NotificationLog.TYPE_RAPPEL_2H,
-                        reason="Court terme 2h before return"
-                    )
-                    reminder_sent_count += 1
-        
+        reminder_sent_count = _check_two_hour_reminders(Attribution.DUREE_COURT_TERME, "Court terme")
         logger.info(f"Court terme reminders: {reminder_sent_count} sent")
         
     except Exception as e:
@@ -71,43 +94,7 @@ def check_moyen_terme_reminders():
     Called every 12 hours
     """
     try:
-        now = timezone.now()
-        
-        attributions = Attribution.objects.filter(
-            duree_emprunt=Attribution.DUREE_MOYEN_TERME,
-            heure_retour_effective__isnull=True,
-        ).select_related('client', 'materiel')
-        
-        reminder_sent_count = 0
-        
-        for attribution in attributions:
-            if attribution.heure_retour_prevue is None:
-                continue
-            
-            return_datetime = datetime.combine(
-                attribution.date_retour_prevue,
-                attribution.heure_retour_prevue
-            )
-            return_datetime = timezone.make_aware(return_datetime)
-            
-            time_until_return = return_datetime - now
-            
-            # Send reminder if within 2.5 hour window
-            if timedelta(minutes=0) <= time_until_return <= timedelta(hours=2, minutes=30):
-                if not NotificationLog.objects.filter(
-                    attribution=attribution,
-                    type_notification=NotificationLog.TYPE_RAPPEL_2H,
-                    canal=NotificationLog.CANAL_EMAIL,
-                    statut__in=[NotificationLog.STATUT_ENVOYEE, NotificationLog.STATUT_ECHEC],
-                ).exists():
-                    
-                    _send_reminder_notification(
-                        attribution,
-                        NotificationLog.TYPE_RAPPEL_2H,
-                        reason="Moyen terme 2h before return"
-                    )
-                    reminder_sent_count += 1
-        
+        reminder_sent_count = _check_two_hour_reminders(Attribution.DUREE_MOYEN_TERME, "Moyen terme")
         logger.info(f"Moyen terme reminders: {reminder_sent_count} sent")
         
     except Exception as e:
@@ -121,67 +108,51 @@ def check_long_terme_reminders():
     Called daily at 8:00 AM
     """
     try:
-        now = timezone.now()
-        today = now.date()
-        
-        attributions = Attribution.objects.filter(
-            duree_emprunt=Attribution.DUREE_LONG_TERME,
-            heure_retour_effective__isnull=True,
-        ).select_related('client', 'materiel')
+        today = timezone.localdate()
         
+        reminders = {
+            2: ('j_moins_2', NotificationLog.TYPE_RAPPEL_J_MOINS_2, "Long terme J-2"),
+            1: ('j_moins_1', NotificationLog.TYPE_RAPPEL_J_MOINS_1, "Long terme J-1"),
+            0: ('final', NotificationLog.TYPE_RAPPEL_FINAL, "Long terme final"),
+        }
+        reminders_by_type = {type_notification: (key, reason) for key, type_notification, reason in reminders.values()}
         reminder_counts = {
             'j_moins_2': 0,
             'j_moins_1': 0,
             'final': 0,
         }
         
+        # Only loans due today, tomorrow or the day after (one range query on echeance),
+        # annotated with the reminder they are due and excluded if it was already sent
+        reminder_type = Case(
+            *[
+                When(date_retour_prevue=today + timedelta(days=days), then=Value(type_notification))
+                for days, (_, type_notification, _) in reminders.items()
+            ],
+            default=Value(''),
+        )
+        # A stale echeance (written without save()) can disagree with date_retour_prevue:
+        # such loans get no reminder type and are left out
+        attributions = _open_attributions().filter(
+            duree_emprunt=Attribution.DUREE_LONG_TERME,
+            echeance__gte=_start_of_day(today),
+            echeance__lt=_start_of_day(today + timedelta(days=3)),
+        ).annotate(reminder_type=reminder_type).exclude(reminder_type='').alias(
+            already_reminded=Exists(_handled_notifications(OuterRef('reminder_type'))),
+        ).filter(already_reminded=False)
+        
+        attributions = list(attributions)
+        preferences = PreferencesService.pour_clients(a.client_id for a in attributions)
+        
         for attribution in attributions:
-            if attribution.date_retour_prevue is None:
-                continue
-            
-            days_until_return = (attribution.date_retour_prevue - today).days
-            
-            # J-2 reminder (2 days before)
-            if days_until_return == 2:
-                if not NotificationLog.objects.filter(
-                    attribution=attribution,
-                    type_notification=NotificationLog.TYPE_RAPPEL_J_MOINS_2,
-                ).exists():
-                    
-                    _send_reminder_notification(
-                        attribution,
-                        NotificationLog.TYPE_RAPPEL_J_MOINS_2,
-                        reason="Long terme J-2"
-                    )
-                    reminder_counts['j_moins_2'] += 1
-            
-            # J-1 reminder (1 day before)
-            elif days_until_return == 1:
-                if not NotificationLog.objects.filter(
-                    attribution=attribution,
-                    type_notification=NotificationLog.TYPE_RAPPEL_J_MOINS_1,
-                ).exists():
-                    
-                    _send_reminder_notification(
-                        attribution,
-                        NotificationLog.TYPE_RAPPEL_J_MOINS_1,
-                        reason="Long terme J-1"
-                    )
-                    reminder_counts['j_moins_1'] += 1
-            
-            # Final reminder (morning of return day)
-            elif days_until_return == 0:
-                if not NotificationLog.objects.filter(
-                    attribution=attribution,
-                    type_notification=NotificationLog.TYPE_RAPPEL_FINAL,
-                ).exists():
-                    
-                    _send_reminder_notification(
-                        attribution,
-                        NotificationLog.TYPE_RAPPEL_FINAL,
-                        reason="Long terme final"
-                    )
-                    reminder_counts['final'] += 1
+            key, reason = reminders_by_type[attribution.reminder_type]
+            _send_reminder_notification(
+                attribution,
+                attribution.reminder_type,
+                reason=reason,
+                preferences=preferences.get(attribution.client_id),
+            )
+            reminder_counts[key] += 1
         
         logger.info(f"Long terme reminders - J-2: {reminder_counts['j_moins_2']}, "
                    f"J-1: {reminder_counts['j_moins_1']}, "
@@ -194,41 +165,134 @@ def check_long_terme_reminders():
 def check_overdue_materials():
     """
     Check for overdue materials and send alert notifications
-    For materials not returned by expected return time
+    For materials not returned by expected return date
     Called every 15 minutes
     """
     try:
         now = timezone.now()
+        today = timezone.localdate()
+        
+        # Return date has passed (echeance before local midnight today) and no overdue
+        # alert was sent yet, or the last one is more than a day old
+        latest_alert = _handled_notifications(NotificationLog.TYPE_RETARD).order_by('-date_envoi').values('date_envoi')[:1]
+        attributions = _open_attributions().filter(
+            echeance__lt=_start_of_day(today),
+        ).alias(latest_alert=Subquery(latest_alert)).filter(
+            Q(latest_alert__isnull=True) | Q(latest_alert__lte=now - timedelta(days=1))
+        )
         
-        # Find attributions that are overdue
-        attributions = Attribution.objects.filter(
-            heure_retour_effective__isnull=True,  # Not returned yet
-            date_retour_prevue__lt=now.date(),  # Return date has passed
-        ).select_related('client', 'materiel')
+        for attribution in attributions:
+            days_late = (today - attribution.date_retour_prevue).days
+            _send_overdue_notification(attribution, days_late)
         
-        # Also check current day but past return time
-        attributions_today = Attribution.objects.filter(
-            heure_retour_effective__isnull=True,
-            date_retour_prevue=now.date(),
-        ).select_related('client', 'materiel')
+        logger.info("Overdue materials check completed")
         
-        for attribution in list(attributions) + list(attributions_today):
-            # Check if we've already sent an overdue alert
-            latest_alert = NotificationLog.objects.filter(
-                attribution=attribution,
-                type_notification=NotificationLog.TYPE_RETARD,
-            ).order_by('-date_envoi').first()
+    except Exception as e:
+        logger.error(f"Error in check_overdue_materials: {e}", exc_info=True)
+
+
+def process_due_notifications():
+    """
+    Pop due rows from the precomputed reminder plan (NotificationPlanifiee) and queue
+    them in the outbox. Reminders fire within a minute of their planned time; a tick
+    with nothing due costs one indexed query.
+    Called every minute
+    """
+    try:
+        from django.db import transaction
+        from assets.planification_service import PlanificationService
+
+        candidats = PlanificationService.echues()
+        if not candidats:
+            return
+        
+        with transaction.atomic():
+            planifiees = PlanificationService.reserver(candidats)
+            
+            now = timezone.now()
+            # Skip what the safety sweep (or a previous plan) already sent
+            already_sent = set(
+                NotificationLog.objects.filter(
+                    attribution_id__in={p.attribution_id for p in planifiees},
+                    canal=NotificationLog.CANAL_EMAIL,
+                    statut__in=HANDLED_STATUSES,
+                ).exclude(
+                    type_notification=NotificationLog.TYPE_RETARD,
+                    date_envoi__lt=now - timedelta(days=1),
+                ).values_list('attribution_id', 'type_notification')
+            )
             
-            if latest_alert is None or (now - latest_alert.date_envoi).days >= 1:
-                # Send overdue alert if no alert sent yet or last one was > 1 day ago
-                days_late = (now.date() - attribution.date_retour_prevue).days
-                if days_late > 0:  # Only if actually late
+            preferences = PreferencesService.pour_clients(p.attribution.client_id for p in planifiees)
+            
+            queued = 0
+            for planifiee in planifiees:
+                attribution = planifiee.attribution
+                if (attribution.id, planifiee.type_notification) in already_sent:
+                    continue
+                if planifiee.type_notification == NotificationLog.TYPE_RETARD:
+                    days_late = (timezone.localdate() - attribution.date_retour_prevue).days
                     _send_overdue_notification(attribution, days_late)
+                else:
+                    _send_reminder_notification(
+                        attribution,
+                        planifiee.type_notification,
+                        reason="Planned reminder",
+                        preferences=preferences.get(attribution.client_id),
+                    )
+                queued += 1
+            
+            PlanificationService.terminer(planifiees)
         
-        logger.info("Overdue materials check completed")
+        logger.info(f"Planned notifications: {len(planifiees)} due, {queued} queued")
         
     except Exception as e:
-        logger.error(f"Error in check_overdue_materials: {e}", exc_info=True)
+        logger.error(f"Error in process_due_notifications: {e}", exc_info=True)
+
+
+def reminder_safety_sweep():
+    """
+    Run the full reminder and overdue scans as a safety net behind the reminder plan
+    They only catch loans written without a plan; already-notified loans are skipped
+    Called daily at 8:30 AM
+    """
+    check_court_terme_reminders()
+    check_moyen_terme_reminders()
+    check_long_terme_reminders()
+    check_overdue_materials()
+
+
+def detect_alerts_incremental():
+    """
+    Run alert detection in incremental (watermark-based) mode
+    Only attributions/materials touched since the last run are re-evaluated;
+    a full sweep is forced once per AlerteService.INTERVALLE_BALAYAGE_COMPLET
+    Called every 15 minutes
+    """
+    try:
+        from assets.services import AlerteService
+
+        resultats = AlerteService.detecter_toutes_alertes(incremental=True)
+        logger.info(f"Incremental alert detection: {resultats['total']} created, "
+                    f"stats={resultats['stats']}, modes={resultats['modes']}")
+
+    except Exception as e:
+        logger.error(f"Error in detect_alerts_incremental: {e}", exc_info=True)
+
+
+def refresh_dashboard_snapshots():
+    """
+    Recompute the global dashboard snapshot and derive every department snapshot from it
+    Signals already invalidate snapshots on writes; this keeps the cache warm
+    Called every 5 minutes
+    """
+    try:
+        from assets.dashboard_service import DashboardService
+
+        count = DashboardService.rafraichir()
+        logger.info(f"Dashboard snapshots refreshed: {count}")
+
+    except Exception as e:
+        logger.error(f"Error in refresh_dashboard_snapshots: {e}", exc_info=True)
 
 
 def cleanup_old_notifications(days=90):
@@ -254,9 +318,62 @@ def cleanup_old_notifications(days=90):
         logger.error(f"Error in cleanup_old_notifications: {e}", exc_info=True)
 
 
-def _send_reminder_notification(attribution, reminder_type, reason=""):
+def archive_audit_logs():
+    """
+    Move audit rows older than AUDIT_ARCHIVE_APRES_JOURS into compressed segment files
+    Called daily at 2:30 AM
+    """
+    try:
+        from assets.archive_audit_service import ArchivageAuditService
+
+        segments, rows = ArchivageAuditService.archiver()
+        logger.info(f"Audit archival: {rows} rows moved into {segments} segments")
+
+    except Exception as e:
+        logger.error(f"Error in archive_audit_logs: {e}", exc_info=True)
+
+
+def pregenerate_report_pdfs():
+    """
+    Render into the PDF cache the reports written in the last 15 minutes
+    Runs every 5 minutes, so each new audit row is rendered before anyone asks for it
+    """
+    try:
+        from assets.rapport_pdf_service import RapportPdfService
+
+        count = RapportPdfService.pregenerer(timezone.now() - timedelta(minutes=15))
+        if count:
+            logger.info(f"Report PDFs pre-generated: {count}")
+
+    except Exception as e:
+        logger.error(f"Error in pregenerate_report_pdfs: {e}", exc_info=True)
+
+
+def process_audit_exports():
     """
-    Helper function to send reminder notifications
+    Write the zip archives of the audit exports requested from the report pages, then
+    drop the archives kept past AUDIT_EXPORT_CONSERVATION_JOURS
+    Runs every minute; one export at a time (max_instances=1)
+    """
+    try:
+        from assets.export_audit_service import ExportAuditService
+
+        count = ExportAuditService.traiter_demandes()
+        if count:
+            logger.info(f"Audit exports written: {count}")
+        purged = ExportAuditService.purger()
+        if purged:
+            logger.info(f"Old audit exports purged: {purged}")
+
+    except Exception as e:
+        logger.error(f"Error in process_audit_exports: {e}", exc_info=True)
+
+
+def _send_reminder_notification(attribution, reminder_type, reason="", preferences=None):
+    """
+    Helper function to queue reminder notifications in the outbox
+    `preferences` comes from a batch load (PreferencesService.pour_clients);
+    resolved from the cache when not given
     """
     try:
         # Get client email
@@ -265,17 +382,15 @@ def _send_reminder_notification(attribution, reminder_type, reason=""):
             logger.warning(f"No email for client in attribution {attribution.id}")
             return
         
-        # Check user preferences
-        try:
-            preferences = NotificationPreferences.objects.get(client=attribution.client)
-            if not preferences.notifications_email:
-                logger.info(f"Email notifications disabled for client {attribution.client.id}")
-                return
-        except NotificationPreferences.DoesNotExist:
-            pass  # Continue if no preferences set
+        # Check user preferences (read-only, defaults when none are set)
+        if preferences is None:
+            preferences = PreferencesService.pour_client(attribution.client)
+        if not preferences.notifications_email:
+            logger.info(f"Email notifications disabled for client {attribution.client.id}")
+            return
         
-        # Create notification log
-        notification = NotificationLog.objects.create(
+        # Queue notification in the outbox (sent by the traiter_notifications worker)
+        NotificationLog.objects.create(
             attribution=attribution,
             type_notification=reminder_type,
             canal=NotificationLog.CANAL_EMAIL,
@@ -284,10 +399,7 @@ def _send_reminder_notification(attribution, reminder_type, reason=""):
             statut=NotificationLog.STATUT_EN_ATTENTE,
         )
         
-        # Send email
-        NotificationEmailService.send_notification(notification)
-        
-        logger.info(f"Reminder sent for attribution {attribution.id}: {reason}")
+        logger.info(f"Reminder queued for attribution {attribution.id}: {reason}")
         
     except Exception as e:
         logger.error(f"Error sending reminder notification: {e}", exc_info=True)
@@ -295,7 +407,7 @@ def _send_reminder_notification(attribution, reminder_type, reason=""):
 
 def _send_overdue_notification(attribution, days_late):
     """
-    Helper function to send overdue alert notifications
+    Helper function to queue overdue alert notifications in the outbox
     """
     try:
         client_email = attribution.client.email if attribution.client else None
@@ -303,8 +415,8 @@ def _send_overdue_notification(attribution, days_late):
             logger.warning(f"No email for client in attribution {attribution.id}")
             return
         
-        # Create notification log
-        notification = NotificationLog.objects.create(
+        # Queue notification in the outbox (sent by the traiter_notifications worker)
+        NotificationLog.objects.create(
             attribution=attribution,
             type_notification=NotificationLog.TYPE_RETARD,
             canal=NotificationLog.CANAL_EMAIL,
@@ -313,10 +425,7 @@ def _send_overdue_notification(attribution, days_late):
             statut=NotificationLog.STATUT_EN_ATTENTE,
         )
         
-        # Send email
-        NotificationEmailService.send_notification(notification)
-        
-        logger.info(f"Overdue alert sent for attribution {attribution.id} ({days_late} days late)")
+        logger.info(f"Overdue alert queued for attribution {attribution.id} ({days_late} days late)")
         
     except Exception as e:
         logger.error(f"Error sending overdue notification: {e}", exc_info=True)
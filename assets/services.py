@@ -3,9 +3,13 @@
 Service de détection et gestion des alertes
 """
 from django.utils import timezone
-from django.db.models import Q, Count
-from datetime import timedelta
-from .models import Alerte, Materiel, Attribution, Departement, Categorie
+from django.db import IntegrityError, transaction
+from django.db.models import Q, F, Count, Max, Sum, Exists, OuterRef
+from django.db.models.functions import Greatest
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter
+from datetime import datetime, timedelta
+from .models import Alerte, Materiel, Attribution, DetectionWatermark, CompteurAlertes, NiveauStock
 
 
 class AlerteService:
@@ -16,237 +20,444 @@ class AlerteService:
     JOURS_AVANT_RAPPEL = 2  # Nombre de jours avant la date de retour pour envoyer un rappel (info)
     JOURS_AVANT_ALERTE_PERDU = 30  # Matériel considéré perdu après 30 jours
     SEUIL_STOCK_CRITIQUE = 2  # Moins de 2 unités disponibles = stock critique (par nom d'équipement)
+    # Mode incrémental: un balayage complet est forcé au-delà de cet intervalle
+    INTERVALLE_BALAYAGE_COMPLET = timedelta(hours=24)
     
     @staticmethod
-    def detecter_retards_retour():
-        """Détecte les attributions avec retard de retour"""
+    def _libelle_destinataire(attribution):
+        """Libellé du destinataire d'une attribution (client, salle ou inconnu)"""
+        if attribution.client:
+            return attribution.client.nom
+        return f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu'
+
+    @staticmethod
+    def _filtre_cle_alerte(alerte):
+        """Filtre correspondant à la clé d'unicité des alertes ouvertes (cf. Alerte.Meta.constraints)"""
+        filtre = {
+            'type_alerte': alerte.type_alerte,
+            'severite': alerte.severite,
+            'reglementee': False,
+        }
+        if alerte.attribution_id:
+            filtre['attribution_id'] = alerte.attribution_id
+        elif alerte.materiel_id:
+            filtre.update(materiel_id=alerte.materiel_id, attribution__isnull=True)
+        else:
+            filtre.update(departement_id=alerte.departement_id, nom_equipement=alerte.nom_equipement)
+        return filtre
+
+    @staticmethod
+    def inserer_alertes(alertes):
+        """
+        Insère un lot d'alertes de façon idempotente et retourne celles réellement créées.
+
+        Les contraintes d'unicité partielles sur les alertes ouvertes garantissent qu'aucun
+        doublon n'est inséré, même si plusieurs workers détectent en parallèle: le lot est
+        inséré en un seul `bulk_create`; si un autre worker a inséré une des alertes entre
+        temps, le lot est rejoué ligne par ligne (savepoint) en ignorant les conflits.
+        """
+        from .signals_audit import audit_bulk_create
+
+        if not alertes:
+            return []
+        try:
+            with transaction.atomic():
+                alertes_creees = Alerte.objects.bulk_create(alertes, batch_size=500)
+        except IntegrityError:
+            alertes_creees = []
+            for alerte in alertes:
+                alerte.pk = None
+                alerte._state.adding = True
+                try:
+                    with transaction.atomic():
+                        Alerte.objects.bulk_create([alerte])
+                except IntegrityError:
+                    continue
+                alertes_creees.append(alerte)
+        # bulk_create n'émet pas post_save: les compteurs sont ajustés ici
+        CompteurAlertesService.appliquer(Counter(
+            (alerte.departement_id, alerte.severite) for alerte in alertes_creees if not alerte.reglementee
+        ))
+        audit_bulk_create(Alerte, alertes_creees)
+        return alertes_creees
+
+    @staticmethod
+    def upsert_alerte(champs_mis_a_jour=('description',), **valeurs):
+        """
+        Crée une alerte ouverte, ou met à jour celle qui existe déjà pour la même clé.
+
+        Aucune lecture préalable: l'insertion est tentée directement et ce n'est qu'en cas
+        de violation de la contrainte d'unicité que l'alerte existante est relue puis mise
+        à jour avec `champs_mis_a_jour`. Retourne (alerte, created).
+        """
+        alerte = Alerte(**valeurs)
+        try:
+            with transaction.atomic():
+                alerte.save(force_insert=True)
+            return alerte, True
+        except IntegrityError:
+            existante = Alerte.objects.filter(**AlerteService._filtre_cle_alerte(alerte)).first()
+            if existante is None:
+                raise
+            for champ in champs_mis_a_jour:
+                setattr(existante, champ, getattr(alerte, champ))
+            if champs_mis_a_jour:
+                existante.save(update_fields=list(champs_mis_a_jour))
+            return existante, False
+
+    @staticmethod
+    def _inserer_alertes_manquantes(cle, candidats, alertes_existantes, construire, stats=None):
+        """
+        Moteur de détection ensembliste.
+
+        `candidats` est le queryset des objets à surveiller, `alertes_existantes` un
+        queryset d'alertes corrélé (OuterRef('pk')) qui, s'il n'est pas vide, signifie
+        qu'une alerte ouverte existe déjà. Une seule requête agrégée compte les lignes
+        scannées et celles sans alerte (anti-jointure), puis les alertes manquantes sont
+        construites par `construire(objet)` et insérées avec un unique `bulk_create`.
+        """
+        candidats = candidats.annotate(_alerte_ouverte=Exists(alertes_existantes))
+        compteurs = candidats.aggregate(
+            scannees=Count('pk'),
+            manquantes=Count('pk', filter=Q(_alerte_ouverte=False)),
+        )
+
+        alertes_creees = []
+        if compteurs['manquantes']:
+            nouvelles = [construire(obj) for obj in candidats.filter(_alerte_ouverte=False)]
+            alertes_creees = AlerteService.inserer_alertes(nouvelles)
+
+        if stats is not None:
+            stats[cle] = {'scannees': compteurs['scannees'], 'inserees': len(alertes_creees)}
+        return alertes_creees
+
+    @staticmethod
+    def detecter_retards_retour(stats=None, depuis=None):
+        """Détecte les attributions avec retard de retour
+
+        Si `depuis` est fourni (mode incrémental), seules les attributions modifiées
+        depuis cette date ou passées en retard depuis sont réévaluées.
+        """
         aujourdhui = timezone.now().date()
         attributions_en_retard = Attribution.objects.filter(
             date_retour_prevue__lt=aujourdhui,
             date_retour_effective__isnull=True
         ).select_related('materiel', 'client', 'departement', 'salle')
-        
-        alertes_creees = []
-        for attribution in attributions_en_retard:
-            # Vérifier si une alerte existe déjà
-            alerte_existante = Alerte.objects.filter(
+        if depuis is not None:
+            attributions_en_retard = attributions_en_retard.filter(
+                Q(date_modification__gte=depuis) | Q(date_retour_prevue__gte=depuis.date())
+            )
+
+        # Les alertes INFO (mouvements, rappels) ne masquent pas une alerte de retard
+        alertes_existantes = Alerte.objects.filter(
+            type_alerte=Alerte.TYPE_RETARD,
+            attribution=OuterRef('pk'),
+            severite__in=[Alerte.SEVERITE_WARNING, Alerte.SEVERITE_CRITICAL],
+            reglementee=False
+        )
+
+        def construire(attribution):
+            jours_retard = (aujourdhui - attribution.date_retour_prevue).days
+            severite = Alerte.SEVERITE_CRITICAL if jours_retard > 7 else Alerte.SEVERITE_WARNING
+            dest_label = AlerteService._libelle_destinataire(attribution)
+            return Alerte(
                 type_alerte=Alerte.TYPE_RETARD,
+                severite=severite,
+                materiel=attribution.materiel,
                 attribution=attribution,
-                reglementee=False
-            ).first()
-            
-            if not alerte_existante:
-                jours_retard = (aujourdhui - attribution.date_retour_prevue).days
-                severite = Alerte.SEVERITE_CRITICAL if jours_retard > 7 else Alerte.SEVERITE_WARNING
-                
-                dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
-
-                alerte = Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_RETARD,
-                    severite=severite,
-                    materiel=attribution.materiel,
-                    attribution=attribution,
-                    departement=attribution.departement,
-                    description=f"Retard de retour: {jours_retard} jour(s) de retard. "
-                               f"Date retour prévue: {attribution.date_retour_prevue}. "
-                               f"Destinataire: {dest_label}"
-                )
-                alertes_creees.append(alerte)
-        
-        return alertes_creees
+                departement=attribution.departement,
+                description=f"Retard de retour: {jours_retard} jour(s) de retard. "
+                           f"Date retour prévue: {attribution.date_retour_prevue}. "
+                           f"Destinataire: {dest_label}"
+            )
+
+        return AlerteService._inserer_alertes_manquantes(
+            'retards', attributions_en_retard, alertes_existantes, construire, stats
+        )
     
     @staticmethod
-    def detecter_materiel_defectueux():
-        """Détecte les matériels défectueux nécessitant attention"""
+    def detecter_materiel_defectueux(stats=None, depuis=None):
+        """Détecte les matériels défectueux nécessitant attention
+
+        Si `depuis` est fourni (mode incrémental), seuls les matériels modifiés depuis
+        cette date sont réévalués.
+        """
         materiels_defectueux = Materiel.objects.filter(
             etat_technique=Materiel.ETAT_DEFECTUEUX,
             statut_disponibilite__in=[Materiel.STATUT_DISPONIBLE, Materiel.STATUT_ATTRIBUE]
         ).select_related('departement')
-        
-        alertes_creees = []
-        for materiel in materiels_defectueux:
-            # Vérifier si une alerte existe déjà
-            alerte_existante = Alerte.objects.filter(
+        if depuis is not None:
+            materiels_defectueux = materiels_defectueux.filter(date_modification__gte=depuis)
+
+        alertes_existantes = Alerte.objects.filter(
+            type_alerte=Alerte.TYPE_DEFECTUEUX,
+            materiel=OuterRef('pk'),
+            reglementee=False
+        )
+
+        def construire(materiel):
+            # Pour coller à la règle métier: matériel défectueux doit être traité
+            # comme critique (ex: panne/défaut nécessitant action immédiate).
+            return Alerte(
                 type_alerte=Alerte.TYPE_DEFECTUEUX,
+                severite=Alerte.SEVERITE_CRITICAL,
                 materiel=materiel,
-                reglementee=False
-            ).first()
-            
-            if not alerte_existante:
-                # Pour coller à la règle métier: matériel défectueux doit être traité
-                # comme critique (ex: panne/défaut nécessitant action immédiate).
-                alerte = Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_DEFECTUEUX,
-                    severite=Alerte.SEVERITE_CRITICAL,
-                    materiel=materiel,
-                    departement=materiel.departement,
-                    description=f"Matériel défectueux nécessitant intervention: {materiel.nom} "
-                               f"({materiel.asset_id}). Statut: {materiel.get_statut_disponibilite_display()}"
-                )
-                alertes_creees.append(alerte)
-        
-        return alertes_creees
+                departement=materiel.departement,
+                description=f"Matériel défectueux nécessitant intervention: {materiel.nom} "
+                           f"({materiel.asset_id}). Statut: {materiel.get_statut_disponibilite_display()}"
+            )
+
+        return AlerteService._inserer_alertes_manquantes(
+            'defectueux', materiels_defectueux, alertes_existantes, construire, stats
+        )
     
     @staticmethod
-    def detecter_stock_critique():
+    def detecter_stock_critique(stats=None, depuis=None):
         """
         Détecte les stocks critiques par nom d'équipement.
         Ex: Si on a 7 projecteurs vidéo et qu'il n'en reste que 2 disponibles, alerte.
+
+        Une seule requête sur la table NiveauStock ne garde que les groupes sous le seuil
+        et indique si une alerte ouverte existe déjà (égalité indexée sur `nom_equipement`).
+        Si `depuis` est fourni (mode incrémental), seuls les niveaux modifiés depuis cette
+        date sont réévalués.
         """
-        alertes_creees = []
-        
-        # Grouper par nom d'équipement et département
-        # On compte tous les matériels (disponibles, attribués, etc.) avec le même nom
-        stocks_par_nom = Materiel.objects.values('nom', 'departement').annotate(
-            total_materiels=Count('id')
+        alertes_existantes = Alerte.objects.filter(
+            type_alerte=Alerte.TYPE_STOCK_CRITIQUE,
+            departement=OuterRef('departement'),
+            nom_equipement=OuterRef('nom'),
+            reglementee=False
         )
-        
-        for stock_info in stocks_par_nom:
-            nom_equipement = stock_info['nom']
-            departement_id = stock_info['departement']
-            total_materiels = stock_info['total_materiels']
-            
-            try:
-                departement = Departement.objects.get(id=departement_id)
-            except Departement.DoesNotExist:
+
+        # Lecture de la table NiveauStock maintenue, sommée par nom et département (toutes catégories)
+        groupes_critiques = NiveauStock.objects.order_by().values('departement_id', 'nom').annotate(
+            nb_total=Sum('total'),
+            nb_disponible=Sum('disponible'),
+            derniere_modification=Max('date_modification'),
+        ).filter(
+            nb_total__gt=0,
+            nb_disponible__lte=AlerteService.SEUIL_STOCK_CRITIQUE
+        ).annotate(
+            _alerte_ouverte=Exists(alertes_existantes)
+        ).values('departement_id', 'nom', 'nb_total', 'nb_disponible', '_alerte_ouverte')
+        if depuis is not None:
+            groupes_critiques = groupes_critiques.filter(derniere_modification__gte=depuis)
+
+        scannees = 0
+        nouvelles = []
+        for stock_info in groupes_critiques:
+            scannees += 1
+            if stock_info['_alerte_ouverte']:
                 continue
-            
-            # Compter les matériels disponibles (fonctionnels et disponibles)
-            materiels_disponibles = Materiel.objects.filter(
-                nom=nom_equipement,
-                departement=departement,
-                statut_disponibilite=Materiel.STATUT_DISPONIBLE,
-                etat_technique=Materiel.ETAT_FONCTIONNEL
-            ).count()
-            
-            # Vérifier si le stock disponible est critique (<= seuil)
-            if materiels_disponibles <= AlerteService.SEUIL_STOCK_CRITIQUE:
-                # Vérifier si une alerte existe déjà pour cet équipement/département
-                alerte_existante = Alerte.objects.filter(
-                    type_alerte=Alerte.TYPE_STOCK_CRITIQUE,
-                    departement=departement,
-                    reglementee=False,
-                    description__icontains=nom_equipement
-                ).first()
-                
-                if not alerte_existante:
-                    alerte = Alerte.objects.create(
-                        type_alerte=Alerte.TYPE_STOCK_CRITIQUE,
-                        severite=Alerte.SEVERITE_WARNING,
-                        departement=departement,
-                        description=f"Stock critique pour l'équipement '{nom_equipement}': "
-                                   f"{materiels_disponibles} unité(s) disponible(s) sur {total_materiels} total. "
-                                   f"Seuil d'alerte: {AlerteService.SEUIL_STOCK_CRITIQUE} unité(s)"
-                    )
-                    alertes_creees.append(alerte)
-        
+            nom_equipement = stock_info['nom']
+            nouvelles.append(Alerte(
+                type_alerte=Alerte.TYPE_STOCK_CRITIQUE,
+                severite=Alerte.SEVERITE_WARNING,
+                departement_id=stock_info['departement_id'],
+                nom_equipement=nom_equipement,
+                description=f"Stock critique pour l'équipement '{nom_equipement}': "
+                           f"{stock_info['nb_disponible']} unité(s) disponible(s) sur {stock_info['nb_total']} total. "
+                           f"Seuil d'alerte: {AlerteService.SEUIL_STOCK_CRITIQUE} unité(s)"
+            ))
+
+        alertes_creees = AlerteService.inserer_alertes(nouvelles)
+
+        if stats is not None:
+            stats['stock_critique'] = {'scannees': scannees, 'inserees': len(alertes_creees)}
         return alertes_creees
     
     @staticmethod
-    def detecter_materiel_perdu():
-        """Détecte les matériels perdus (non retournés après X jours)"""
+    def detecter_materiel_perdu(stats=None, depuis=None):
+        """Détecte les matériels perdus (non retournés après X jours)
+
+        Si `depuis` est fourni (mode incrémental), seules les attributions modifiées
+        depuis cette date ou ayant dépassé le délai de perte depuis sont réévaluées.
+        """
         aujourdhui = timezone.now().date()
-        date_limite = aujourdhui - timedelta(days=AlerteService.JOURS_AVANT_ALERTE_PERDU)
+        delai_perte = timedelta(days=AlerteService.JOURS_AVANT_ALERTE_PERDU)
+        date_limite = aujourdhui - delai_perte
         
         attributions_perdues = Attribution.objects.filter(
             date_retour_prevue__lt=date_limite,
             date_retour_effective__isnull=True
         ).select_related('materiel', 'client', 'departement', 'salle')
-        
-        alertes_creees = []
-        for attribution in attributions_perdues:
-            # Vérifier si une alerte existe déjà
-            alerte_existante = Alerte.objects.filter(
+        if depuis is not None:
+            attributions_perdues = attributions_perdues.filter(
+                Q(date_modification__gte=depuis) | Q(date_retour_prevue__gte=depuis.date() - delai_perte)
+            )
+
+        alertes_existantes = Alerte.objects.filter(
+            type_alerte=Alerte.TYPE_PERDU,
+            attribution=OuterRef('pk'),
+            reglementee=False
+        )
+
+        def construire(attribution):
+            jours_ecoules = (aujourdhui - attribution.date_retour_prevue).days
+            dest_label = AlerteService._libelle_destinataire(attribution)
+            return Alerte(
                 type_alerte=Alerte.TYPE_PERDU,
+                severite=Alerte.SEVERITE_CRITICAL,
+                materiel=attribution.materiel,
                 attribution=attribution,
-                reglementee=False
-            ).first()
-            
-            if not alerte_existante:
-                jours_ecoules = (aujourdhui - attribution.date_retour_prevue).days
-                dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
-
-                alerte = Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_PERDU,
-                    severite=Alerte.SEVERITE_CRITICAL,
-                    materiel=attribution.materiel,
-                    attribution=attribution,
-                    departement=attribution.departement,
-                    description=f"Matériel considéré comme perdu: {attribution.materiel.nom} "
-                               f"({attribution.materiel.asset_id}). "
-                               f"Non retourné depuis {jours_ecoules} jour(s). "
-                               f"Destinataire: {dest_label}. "
-                               f"Date retour prévue: {attribution.date_retour_prevue}"
-                )
-                alertes_creees.append(alerte)
-        
-        return alertes_creees
+                departement=attribution.departement,
+                description=f"Matériel considéré comme perdu: {attribution.materiel.nom} "
+                           f"({attribution.materiel.asset_id}). "
+                           f"Non retourné depuis {jours_ecoules} jour(s). "
+                           f"Destinataire: {dest_label}. "
+                           f"Date retour prévue: {attribution.date_retour_prevue}"
+            )
+
+        return AlerteService._inserer_alertes_manquantes(
+            'perdus', attributions_perdues, alertes_existantes, construire, stats
+        )
 
     @staticmethod
-    def detecter_rappels_retour():
+    def detecter_rappels_retour(stats=None, depuis=None):
         """Détecte les attributions dont la date de retour prévue approche et crée des rappels (INFO).
 
         Créera une alerte de type RETARD mais de sévérité INFO pour indiquer un rappel avant la date de retour.
+        Si `depuis` est fourni (mode incrémental), seules les attributions modifiées depuis
+        cette date ou entrées depuis dans la fenêtre de rappel sont réévaluées.
         """
         aujourdhui = timezone.now().date()
-        date_limite = aujourdhui + timedelta(days=AlerteService.JOURS_AVANT_RAPPEL)
+        fenetre_rappel = timedelta(days=AlerteService.JOURS_AVANT_RAPPEL)
+        date_limite = aujourdhui + fenetre_rappel
 
         attributions_a_reminder = Attribution.objects.filter(
             date_retour_prevue__gte=aujourdhui,
             date_retour_prevue__lte=date_limite,
             date_retour_effective__isnull=True
         ).select_related('materiel', 'client', 'departement', 'salle')
+        if depuis is not None:
+            attributions_a_reminder = attributions_a_reminder.filter(
+                Q(date_modification__gte=depuis) | Q(date_retour_prevue__gt=depuis.date() + fenetre_rappel)
+            )
 
-        alertes_creees = []
-        for attribution in attributions_a_reminder:
-            # Ne pas dupliquer un rappel déjà créé
-            alerte_existante = Alerte.objects.filter(
+        # Ne pas dupliquer un rappel déjà créé
+        alertes_existantes = Alerte.objects.filter(
+            type_alerte=Alerte.TYPE_RETARD,
+            attribution=OuterRef('pk'),
+            severite=Alerte.SEVERITE_INFO,
+            reglementee=False
+        )
+
+        def construire(attribution):
+            jours_restants = (attribution.date_retour_prevue - aujourdhui).days
+            dest_label = AlerteService._libelle_destinataire(attribution)
+            return Alerte(
                 type_alerte=Alerte.TYPE_RETARD,
-                attribution=attribution,
                 severite=Alerte.SEVERITE_INFO,
-                reglementee=False
-            ).first()
-
-            if not alerte_existante:
-                jours_restants = (attribution.date_retour_prevue - aujourdhui).days
-                dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
-
-                alerte = Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_RETARD,
-                    severite=Alerte.SEVERITE_INFO,
-                    materiel=attribution.materiel,
-                    attribution=attribution,
-                    departement=attribution.departement,
-                    description=f"Rappel: date de retour prévue dans {jours_restants} jour(s) ({attribution.date_retour_prevue}). "
-                                f"Destinataire: {dest_label}"
-                )
-                alertes_creees.append(alerte)
+                materiel=attribution.materiel,
+                attribution=attribution,
+                departement=attribution.departement,
+                description=f"Rappel: date de retour prévue dans {jours_restants} jour(s) ({attribution.date_retour_prevue}). "
+                            f"Destinataire: {dest_label}"
+            )
 
-        return alertes_creees
+        return AlerteService._inserer_alertes_manquantes(
+            'rappels', attributions_a_reminder, alertes_existantes, construire, stats
+        )
     
     @classmethod
-    def detecter_toutes_alertes(cls, envoyer_emails=True):
-        """Détecte toutes les alertes et retourne un résumé"""
-        from .email_service import EmailAlerteService
+    def detecter_toutes_alertes(cls, envoyer_emails=True, incremental=False):
+        """Détecte toutes les alertes et retourne un résumé
+
+        En plus des listes d'alertes créées par type, `resultats['stats']` indique pour
+        chaque type le nombre de lignes scannées et d'alertes insérées.
+
+        En mode incrémental, chaque détecteur ne réévalue que ce qui a changé depuis son
+        watermark (voir `DetectionWatermark`). Un balayage complet est fait pour un
+        détecteur sans watermark ou dont le dernier balayage complet date de plus de
+        `INTERVALLE_BALAYAGE_COMPLET`. `resultats['modes']` indique le mode utilisé.
+        """
+        from .outbox_service import NotificationOutboxService
         
-        resultats = {
-            'retards': cls.detecter_retards_retour(),
-            'defectueux': cls.detecter_materiel_defectueux(),
-            'stock_critique': cls.detecter_stock_critique(),
-            'perdus': cls.detecter_materiel_perdu(),
-            'rappels': cls.detecter_rappels_retour(),
+        debut = timezone.now()
+        detecteurs = {
+            'retards': cls.detecter_retards_retour,
+            'defectueux': cls.detecter_materiel_defectueux,
+            'stock_critique': cls.detecter_stock_critique,
+            'perdus': cls.detecter_materiel_perdu,
+            'rappels': cls.detecter_rappels_retour,
         }
+
+        watermarks = {}
+        depuis_par_detecteur = dict.fromkeys(detecteurs)
+        if incremental:
+            watermarks = {w.detecteur: w for w in DetectionWatermark.objects.filter(detecteur__in=detecteurs)}
+            for cle in detecteurs:
+                watermark = watermarks.get(cle)
+                if (watermark and watermark.date_dernier_balayage_complet
+                        and debut - watermark.date_dernier_balayage_complet < cls.INTERVALLE_BALAYAGE_COMPLET):
+                    depuis_par_detecteur[cle] = watermark.date_derniere_execution
+
+        stats = {}
+        resultats = {}
+        if cls._rien_a_reevaluer(depuis_par_detecteur, debut):
+            for cle in detecteurs:
+                resultats[cle] = []
+                stats[cle] = {'scannees': 0, 'inserees': 0}
+        else:
+            for cle, detecteur in detecteurs.items():
+                resultats[cle] = detecteur(stats, depuis=depuis_par_detecteur[cle])
         
         total = sum(len(v) for v in resultats.values())
         resultats['total'] = total
+        resultats['stats'] = stats
+        resultats['modes'] = {
+            cle: 'incremental' if depuis else 'complet' for cle, depuis in depuis_par_detecteur.items()
+        }
+
+        if incremental:
+            cls._enregistrer_watermarks(watermarks, depuis_par_detecteur, debut)
         
-        # Envoyer des emails pour les alertes critiques
+        # Mettre en file les emails des alertes critiques
+        # (bulk_create ne déclenche pas le signal post_save de mise en file automatique)
         if envoyer_emails:
-            for alerte in resultats['retards'] + resultats['perdus']:
-                if alerte.severite == Alerte.SEVERITE_CRITICAL:
-                    EmailAlerteService.envoyer_alerte_critique(alerte)
+            NotificationOutboxService.enfiler_alertes_critiques(
+                resultats['retards'] + resultats['perdus'] + resultats['defectueux']
+            )
         
         return resultats
+
+    @staticmethod
+    def _rien_a_reevaluer(depuis_par_detecteur, debut):
+        """Vrai si tous les détecteurs sont incrémentaux et que rien n'a changé.
+
+        Les seuils de date sont à la journée: tant que le dernier passage date du même
+        jour, seules les lignes modifiées peuvent produire une nouvelle alerte.
+        """
+        if any(depuis is None for depuis in depuis_par_detecteur.values()):
+            return False
+        depuis = min(depuis_par_detecteur.values())
+        if depuis.date() != debut.date():
+            return False
+        return not (
+            Attribution.objects.filter(date_modification__gte=depuis).exists()
+            or Materiel.objects.filter(date_modification__gte=depuis).exists()
+        )
+
+    @staticmethod
+    def _enregistrer_watermarks(watermarks, depuis_par_detecteur, debut):
+        """Avance le watermark de chaque détecteur au début de l'exécution courante"""
+        a_creer = []
+        for cle, depuis in depuis_par_detecteur.items():
+            watermark = watermarks.get(cle)
+            if watermark is None:
+                a_creer.append(DetectionWatermark(
+                    detecteur=cle, date_derniere_execution=debut, date_dernier_balayage_complet=debut
+                ))
+                continue
+            watermark.date_derniere_execution = debut
+            if depuis is None:
+                watermark.date_dernier_balayage_complet = debut
+        if watermarks:
+            DetectionWatermark.objects.bulk_update(
+                watermarks.values(), ['date_derniere_execution', 'date_dernier_balayage_complet']
+            )
+        if a_creer:
+            DetectionWatermark.objects.bulk_create(a_creer, ignore_conflicts=True)
     
     @staticmethod
     def get_alertes_non_reglementees(departement=None):
@@ -258,7 +469,62 @@ class AlerteService:
         if departement:
             queryset = queryset.filter(departement=departement)
         
-        return queryset.order_by('-severite', '-date_creation')
+        return queryset.order_by('-severite', '-date_creation', '-id')
+
+    @staticmethod
+    def statistiques_alertes(queryset):
+        """Calcule toutes les statistiques de la liste des alertes en une seule requête agrégée"""
+        return queryset.order_by().aggregate(
+            total=Count('pk'),
+            critique=Count('pk', filter=Q(severite=Alerte.SEVERITE_CRITICAL)),
+            warning=Count('pk', filter=Q(severite=Alerte.SEVERITE_WARNING)),
+            info=Count('pk', filter=Q(severite=Alerte.SEVERITE_INFO)),
+            retard=Count('pk', filter=Q(type_alerte=Alerte.TYPE_RETARD)),
+            defectueux=Count('pk', filter=Q(type_alerte=Alerte.TYPE_DEFECTUEUX)),
+            stock_critique=Count('pk', filter=Q(type_alerte=Alerte.TYPE_STOCK_CRITIQUE)),
+            perdu=Count('pk', filter=Q(type_alerte=Alerte.TYPE_PERDU)),
+        )
+
+    @staticmethod
+    def encoder_curseur(alerte):
+        """Curseur de pagination opaque positionné après `alerte`"""
+        brut = f"{alerte.severite}|{alerte.date_creation.isoformat()}|{alerte.pk}"
+        return urlsafe_b64encode(brut.encode()).decode()
+
+    @staticmethod
+    def decoder_curseur(curseur):
+        """Retourne (severite, date_creation, id) ou None si le curseur est absent ou invalide"""
+        if not curseur:
+            return None
+        try:
+            severite, date_creation, pk = urlsafe_b64decode(curseur.encode()).decode().split('|')
+            return severite, datetime.fromisoformat(date_creation), int(pk)
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    @staticmethod
+    def page_alertes(queryset, curseur=None, taille=50):
+        """
+        Pagination par clé (keyset) sur (severite, date_creation, id) décroissants.
+
+        Contrairement à OFFSET, le coût d'une page ne dépend pas de sa position: la
+        requête reprend directement après la dernière alerte affichée grâce à l'index
+        composite sur ces colonnes. Retourne (alertes, curseur de la page suivante ou None).
+        """
+        position = AlerteService.decoder_curseur(curseur)
+        if position:
+            severite, date_creation, pk = position
+            queryset = queryset.filter(
+                Q(severite__lt=severite)
+                | Q(severite=severite, date_creation__lt=date_creation)
+                | Q(severite=severite, date_creation=date_creation, pk__lt=pk)
+            )
+        alertes = list(queryset.order_by('-severite', '-date_creation', '-id')[:taille + 1])
+        curseur_suivant = None
+        if len(alertes) > taille:
+            alertes = alertes[:taille]
+            curseur_suivant = AlerteService.encoder_curseur(alertes[-1])
+        return alertes, curseur_suivant
     
     @staticmethod
     def get_nombre_alertes_critiques(departement=None):
@@ -273,3 +539,236 @@ class AlerteService:
         
         return queryset.count()
 
+
+class CompteurAlertesService:
+    """
+    Maintenance des compteurs d'alertes ouvertes par (département, sévérité).
+
+    Les compteurs sont ajustés dans la transaction qui écrit les alertes: par les signaux
+    pour les sauvegardes et suppressions unitaires, explicitement pour les écritures en
+    masse (`bulk_create`, `regler`). `reconstruire` les recalcule depuis la table Alerte.
+    """
+
+    @staticmethod
+    def appliquer(deltas):
+        """Applique des deltas {(departement_id, severite): delta} par mises à jour atomiques"""
+        from .dashboard_service import DashboardService
+
+        if any(deltas.values()):
+            DashboardService.invalider()
+        for (departement_id, severite), delta in deltas.items():
+            if not delta:
+                continue
+            compteurs = CompteurAlertes.objects.filter(departement_id=departement_id, severite=severite)
+            # Un delta négatif sur un compteur absent (département en cours de suppression) est ignoré
+            if not compteurs.update(nombre=Greatest(F('nombre') + delta, 0)) and delta > 0:
+                CompteurAlertes.objects.bulk_create(
+                    [CompteurAlertes(departement_id=departement_id, severite=severite)],
+                    ignore_conflicts=True,
+                )
+                compteurs.update(nombre=Greatest(F('nombre') + delta, 0))
+
+    CHAMPS_UNICITE = ('pk', 'departement_id', 'severite', 'type_alerte', 'attribution_id', 'materiel_id', 'nom_equipement')
+
+    @staticmethod
+    def _cles_unicite(alerte):
+        """Clés des contraintes d'unicité des alertes ouvertes qui s'appliquent à l'alerte (valeurs de CHAMPS_UNICITE)"""
+        cles = []
+        if alerte['attribution_id'] is not None:
+            cles.append(('attribution', alerte['type_alerte'], alerte['attribution_id'], alerte['severite']))
+        elif alerte['materiel_id'] is not None:
+            cles.append(('materiel', alerte['type_alerte'], alerte['materiel_id'], alerte['severite']))
+        if alerte['nom_equipement'] is not None:
+            cles.append(('stock', alerte['type_alerte'], alerte['departement_id'], alerte['nom_equipement'], alerte['severite']))
+        return cles
+
+    @staticmethod
+    def _rouvrables(lignes):
+        """
+        Alertes réglées qui peuvent être rouvertes sans violer les contraintes d'unicité: celles
+        dont une clé a déjà une alerte ouverte, ou une alerte plus récente de la sélection, sont écartées.
+        """
+        ouvertes = Alerte.objects.filter(reglementee=False).filter(
+            Q(attribution_id__in={l['attribution_id'] for l in lignes if l['attribution_id'] is not None})
+            | Q(attribution__isnull=True, materiel_id__in={l['materiel_id'] for l in lignes if l['materiel_id'] is not None})
+            | Q(
+                departement_id__in={l['departement_id'] for l in lignes if l['nom_equipement'] is not None},
+                nom_equipement__in={l['nom_equipement'] for l in lignes if l['nom_equipement'] is not None},
+            )
+        ).values(*CompteurAlertesService.CHAMPS_UNICITE)
+        prises = {cle for alerte in ouvertes for cle in CompteurAlertesService._cles_unicite(alerte)}
+        rouvrables = []
+        for ligne in lignes:
+            cles = CompteurAlertesService._cles_unicite(ligne)
+            if prises.isdisjoint(cles):
+                prises.update(cles)
+                rouvrables.append(ligne)
+        return rouvrables
+
+    @staticmethod
+    def regler(queryset, reglementee=True):
+        """
+        Marque les alertes du queryset comme réglées (ou les réouvre) en ajustant les compteurs.
+        Une alerte dont la réouverture doublerait une alerte ouverte reste réglée.
+        Retourne le nombre d'alertes modifiées.
+        """
+        signe = -1 if reglementee else 1
+        with transaction.atomic():
+            lignes = list(
+                queryset.exclude(reglementee=reglementee)
+                .select_for_update()
+                .order_by('-date_creation', '-pk')
+                .values(*CompteurAlertesService.CHAMPS_UNICITE)
+            )
+            if not reglementee:
+                lignes = CompteurAlertesService._rouvrables(lignes)
+            if not lignes:
+                return 0
+            updated = Alerte.objects.filter(pk__in=[ligne['pk'] for ligne in lignes]).update(reglementee=reglementee)
+            deltas = Counter()
+            for ligne in lignes:
+                deltas[(ligne['departement_id'], ligne['severite'])] += signe
+            CompteurAlertesService.appliquer(deltas)
+        return updated
+
+    @staticmethod
+    def compter(departement=None):
+        """Retourne (nombre d'alertes ouvertes, nombre d'alertes critiques ouvertes)"""
+        compteurs = CompteurAlertes.objects.all()
+        if departement:
+            compteurs = compteurs.filter(departement=departement)
+        totaux = compteurs.aggregate(
+            total=Sum('nombre'),
+            critiques=Sum('nombre', filter=Q(severite=Alerte.SEVERITE_CRITICAL)),
+        )
+        return totaux['total'] or 0, totaux['critiques'] or 0
+
+    @staticmethod
+    def reconstruire():
+        """Recalcule tous les compteurs depuis la table Alerte; retourne le nombre de compteurs corrigés"""
+        with transaction.atomic():
+            attendus = {
+                (ligne['departement_id'], ligne['severite']): ligne['nombre']
+                for ligne in Alerte.objects.filter(reglementee=False)
+                .values('departement_id', 'severite')
+                .annotate(nombre=Count('pk'))
+            }
+            actuels = {
+                (c.departement_id, c.severite): c
+                for c in CompteurAlertes.objects.select_for_update()
+            }
+            a_modifier = []
+            for cle, compteur in actuels.items():
+                nombre = attendus.get(cle, 0)
+                if compteur.nombre != nombre:
+                    compteur.nombre = nombre
+                    a_modifier.append(compteur)
+            a_creer = [
+                CompteurAlertes(departement_id=departement_id, severite=severite, nombre=nombre)
+                for (departement_id, severite), nombre in attendus.items()
+                if (departement_id, severite) not in actuels
+            ]
+            CompteurAlertes.objects.bulk_update(a_modifier, ['nombre'], batch_size=500)
+            CompteurAlertes.objects.bulk_create(a_creer, batch_size=500)
+        return len(a_modifier) + len(a_creer)
+
+
+class NiveauStockService:
+    """
+    Maintenance de la table NiveauStock (comptages par département, nom d'équipement et
+    catégorie, le regroupement de la liste des matériels).
+
+    Chaque matériel contribue à une ligne selon son statut et son état; les signaux
+    appliquent la différence entre l'ancienne et la nouvelle contribution dans la
+    transaction de la sauvegarde. `reconstruire` recalcule la table depuis Materiel.
+    """
+
+    CHAMPS = ('total', 'disponible', 'statut_disponible', 'attribue', 'maintenance', 'hors_service', 'defectueux')
+
+    @staticmethod
+    def contribution(materiel):
+        """Retourne ((departement_id, nom, categorie_id), {champ: 0|1}) pour un matériel"""
+        statut = materiel.statut_disponibilite
+        return (materiel.departement_id, materiel.nom, materiel.categorie_id), {
+            'total': 1,
+            'disponible': int(statut == Materiel.STATUT_DISPONIBLE and materiel.etat_technique == Materiel.ETAT_FONCTIONNEL),
+            'statut_disponible': int(statut == Materiel.STATUT_DISPONIBLE),
+            'attribue': int(statut == Materiel.STATUT_ATTRIBUE),
+            'maintenance': int(statut == Materiel.STATUT_MAINTENANCE),
+            'hors_service': int(statut == Materiel.STATUT_HORS_SERVICE),
+            'defectueux': int(materiel.etat_technique == Materiel.ETAT_DEFECTUEUX),
+        }
+
+    @staticmethod
+    def appliquer(cle, deltas):
+        """Applique des deltas {champ: delta} à la ligne `cle` par une mise à jour atomique"""
+        departement_id, nom, categorie_id = cle
+        maj = {champ: Greatest(F(champ) + delta, 0) for champ, delta in deltas.items() if delta}
+        maj['date_modification'] = timezone.now()
+        niveaux = NiveauStock.objects.filter(departement_id=departement_id, nom=nom, categorie_id=categorie_id)
+        if not niveaux.update(**maj) and deltas.get('total', 0) > 0:
+            NiveauStock.objects.bulk_create(
+                [NiveauStock(
+                    departement_id=departement_id, nom=nom, categorie_id=categorie_id,
+                    date_modification=maj['date_modification'],
+                )],
+                ignore_conflicts=True,
+            )
+            niveaux.update(**maj)
+
+    @staticmethod
+    def ajuster(ancienne, nouvelle):
+        """
+        Applique le passage d'une contribution à une autre (None: matériel absent).
+        Un changement de nom, de catégorie ou de département déplace la contribution d'une ligne à l'autre.
+        """
+        if ancienne and nouvelle and ancienne[0] == nouvelle[0]:
+            deltas = {champ: nouvelle[1][champ] - ancienne[1][champ] for champ in NiveauStockService.CHAMPS}
+            NiveauStockService.appliquer(nouvelle[0], deltas)
+            return
+        if ancienne:
+            NiveauStockService.appliquer(ancienne[0], {champ: -v for champ, v in ancienne[1].items()})
+        if nouvelle:
+            NiveauStockService.appliquer(nouvelle[0], nouvelle[1])
+
+    @staticmethod
+    def reconstruire(departement_id=None):
+        """Recalcule la table (ou les lignes d'un département) depuis Materiel; retourne le nombre de lignes"""
+        maintenant = timezone.now()
+        materiels = Materiel.objects.order_by()
+        niveaux_actuels = NiveauStock.objects.all()
+        if departement_id is not None:
+            materiels = materiels.filter(departement_id=departement_id)
+            niveaux_actuels = niveaux_actuels.filter(departement_id=departement_id)
+        lignes = materiels.values('departement_id', 'nom', 'categorie_id').annotate(
+            nb_total=Count('id'),
+            nb_disponible=Count('id', filter=Q(
+                statut_disponibilite=Materiel.STATUT_DISPONIBLE,
+                etat_technique=Materiel.ETAT_FONCTIONNEL
+            )),
+            nb_statut_disponible=Count('id', filter=Q(statut_disponibilite=Materiel.STATUT_DISPONIBLE)),
+            nb_attribue=Count('id', filter=Q(statut_disponibilite=Materiel.STATUT_ATTRIBUE)),
+            nb_maintenance=Count('id', filter=Q(statut_disponibilite=Materiel.STATUT_MAINTENANCE)),
+            nb_hors_service=Count('id', filter=Q(statut_disponibilite=Materiel.STATUT_HORS_SERVICE)),
+            nb_defectueux=Count('id', filter=Q(etat_technique=Materiel.ETAT_DEFECTUEUX)),
+        )
+        with transaction.atomic():
+            niveaux = [
+                NiveauStock(
+                    departement_id=ligne['departement_id'],
+                    nom=ligne['nom'],
+                    categorie_id=ligne['categorie_id'],
+                    total=ligne['nb_total'],
+                    disponible=ligne['nb_disponible'],
+                    statut_disponible=ligne['nb_statut_disponible'],
+                    attribue=ligne['nb_attribue'],
+                    maintenance=ligne['nb_maintenance'],
+                    hors_service=ligne['nb_hors_service'],
+                    defectueux=ligne['nb_defectueux'],
+                    date_modification=maintenant,
+                )
+                for ligne in lignes
+            ]
+            niveaux_actuels.delete()
+            NiveauStock.objects.bulk_create(niveaux, batch_size=500)
+        return len(niveaux)
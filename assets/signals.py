@@ -2,20 +2,63 @@
 """
 Signaux Django pour les alertes et notifications d'attribution
 
-Ce module gère l'envoi automatique de notifications lors de:
+Ce module met en file (outbox) les notifications lors de:
 - Création d'une attribution → Notification de création
 - Retour de matériel → Confirmation de restitution
 - Alertes critiques → Email d'alerte
+- Écriture d'une alerte → Mise à jour des compteurs d'alertes ouvertes
+- Écriture d'un matériel, suppression d'une catégorie → Mise à jour des niveaux de stock
+- Écriture d'un matériel ou d'un département → Invalidation du tableau de bord
+- Création, changement d'échéance ou retour d'une attribution → Plan des rappels
+- Écriture de préférences de notification → Invalidation de leur cache
+
+Les envois sont faits par le worker `manage.py traiter_notifications`.
 """
 import logging
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete, pre_save
+from django.db.models import QuerySet
 from django.dispatch import receiver
-from .models import Alerte, Attribution, NotificationPreferences
-from .email_service import EmailAlerteService, NotificationEmailService
-from .whatsapp_service import WhatsAppNotificationService
+from .models import Alerte, Attribution, Categorie, Departement, Materiel, NotificationLog, NotificationPreferences
+from .outbox_service import NotificationOutboxService
+from .services import CompteurAlertesService, NiveauStockService
+from .dashboard_service import DashboardService
+from .planification_service import PlanificationService
+from .preferences_service import PreferencesService
 
 logger = logging.getLogger(__name__)
 
+# État initial non mémorisé: des champs qu'il lit étaient différés au chargement (.only/.defer)
+_INCONNU = object()
+
+
+def _champs_differes(instance, champs):
+    """
+    Champs de `champs` non chargés. Un receiver post_init ne doit pas les lire: chaque lecture
+    passe par refresh_from_db, qui crée une instance et relance post_init (récursion).
+    """
+    differes = instance.get_deferred_fields()
+    return [nom for nom in champs if instance._meta.get_field(nom).attname in differes]
+
+
+def _charger_champs(instance, champs):
+    """Charge en une requête les champs différés de `champs` avant de les lire"""
+    differes = _champs_differes(instance, champs)
+    if differes:
+        instance.refresh_from_db(fields=differes)
+
+
+def _relire_etat_initial(instance, attribut, champs, absent=None):
+    """
+    Remplace un état initial inconnu par celui de la ligne en base, lue avec les seuls `champs`
+    (avant l'écriture: c'est encore l'ancienne ligne). `absent` si la ligne n'existe pas.
+    """
+    if getattr(instance, attribut) is not _INCONNU:
+        return
+    ancienne = None
+    if instance.pk is not None:
+        ancienne = type(instance)._base_manager.filter(pk=instance.pk).only(*champs).first()
+    setattr(instance, attribut, getattr(ancienne, attribut) if ancienne is not None else absent)
+
 
 # ============================================================================
 # SIGNAUX POUR LES ALERTES CRITIQUES
@@ -23,14 +66,183 @@ logger = logging.getLogger(__name__)
 
 @receiver(post_save, sender=Alerte)
 def envoyer_email_alerte_critique(sender, instance, created, **kwargs):
-    """Envoie un email automatiquement lorsqu'une alerte critique est créée"""
+    """Met en file un email par manager lorsqu'une alerte critique est créée"""
     if created and instance.severite == Alerte.SEVERITE_CRITICAL:
-        # Envoyer l'email de manière asynchrone (ou synchrone en développement)
         try:
-            EmailAlerteService.envoyer_alerte_critique(instance)
+            NotificationOutboxService.enfiler_alertes_critiques([instance])
         except Exception as e:
             # Logger l'erreur mais ne pas bloquer la création de l'alerte
-            logger.error(f"Erreur lors de l'envoi de l'email d'alerte: {e}", exc_info=True)
+            logger.error(f"Erreur lors de la mise en file de l'email d'alerte: {e}", exc_info=True)
+
+
+# ============================================================================
+# SIGNAUX POUR LES COMPTEURS D'ALERTES
+# ============================================================================
+
+CHAMPS_COMPTEUR = ('reglementee', 'departement', 'severite')
+
+
+def _cle_compteur(alerte):
+    """Compteur auquel l'alerte contribue, ou None si elle est réglée"""
+    if alerte.reglementee:
+        return None
+    return (alerte.departement_id, alerte.severite)
+
+
+@receiver(post_init, sender=Alerte)
+def memoriser_etat_compteur(sender, instance, **kwargs):
+    """Mémorise l'état chargé de l'alerte pour calculer le delta des compteurs à la sauvegarde"""
+    if _champs_differes(instance, CHAMPS_COMPTEUR):
+        instance._cle_compteur_initiale = _INCONNU
+    else:
+        instance._cle_compteur_initiale = _cle_compteur(instance)
+
+
+@receiver(pre_save, sender=Alerte)
+@receiver(pre_delete, sender=Alerte)
+def relire_etat_compteur(sender, instance, raw=False, **kwargs):
+    """Relit l'état initial d'une alerte chargée sans les champs du compteur"""
+    if not raw:
+        _relire_etat_initial(instance, '_cle_compteur_initiale', CHAMPS_COMPTEUR)
+
+
+@receiver(post_save, sender=Alerte)
+def mettre_a_jour_compteurs_alertes(sender, instance, created, raw=False, **kwargs):
+    """Ajuste les compteurs dans la transaction de la sauvegarde"""
+    if raw:
+        return
+    ancienne = None if created else instance._cle_compteur_initiale
+    _charger_champs(instance, CHAMPS_COMPTEUR)
+    nouvelle = _cle_compteur(instance)
+    if ancienne != nouvelle:
+        deltas = {}
+        if ancienne:
+            deltas[ancienne] = -1
+        if nouvelle:
+            deltas[nouvelle] = deltas.get(nouvelle, 0) + 1
+        CompteurAlertesService.appliquer(deltas)
+    instance._cle_compteur_initiale = nouvelle
+
+
+@receiver(post_delete, sender=Alerte)
+def decrementer_compteurs_alertes(sender, instance, **kwargs):
+    """Retire une alerte ouverte supprimée des compteurs"""
+    cle = instance._cle_compteur_initiale
+    if cle:
+        CompteurAlertesService.appliquer({cle: -1})
+
+
+# ============================================================================
+# SIGNAUX POUR LES NIVEAUX DE STOCK
+# ============================================================================
+
+CHAMPS_STOCK = ('departement', 'nom', 'categorie', 'statut_disponibilite', 'etat_technique')
+
+
+@receiver(post_init, sender=Materiel)
+def memoriser_contribution_stock(sender, instance, **kwargs):
+    """Mémorise la contribution chargée du matériel à son niveau de stock"""
+    if _champs_differes(instance, CHAMPS_STOCK):
+        instance._contribution_stock_initiale = _INCONNU
+    else:
+        instance._contribution_stock_initiale = NiveauStockService.contribution(instance)
+
+
+@receiver(pre_save, sender=Materiel)
+@receiver(pre_delete, sender=Materiel)
+def relire_contribution_stock(sender, instance, raw=False, **kwargs):
+    """Relit la contribution initiale d'un matériel chargé sans les champs du niveau de stock"""
+    if not raw:
+        _relire_etat_initial(instance, '_contribution_stock_initiale', CHAMPS_STOCK)
+
+
+@receiver(post_save, sender=Materiel)
+def mettre_a_jour_niveau_stock(sender, instance, created, raw=False, **kwargs):
+    """Ajuste le niveau de stock dans la transaction de la sauvegarde"""
+    if raw:
+        return
+    ancienne = None if created else instance._contribution_stock_initiale
+    _charger_champs(instance, CHAMPS_STOCK)
+    nouvelle = NiveauStockService.contribution(instance)
+    NiveauStockService.ajuster(ancienne, nouvelle)
+    instance._contribution_stock_initiale = nouvelle
+
+
+@receiver(post_delete, sender=Materiel)
+def retirer_du_niveau_stock(sender, instance, **kwargs):
+    """Retire un matériel supprimé de son niveau de stock"""
+    NiveauStockService.ajuster(instance._contribution_stock_initiale, None)
+
+
+@receiver(post_delete, sender=Categorie)
+def recalculer_niveaux_stock_categorie(sender, instance, origin=None, **kwargs):
+    """
+    Les matériels d'une catégorie supprimée passent sans catégorie (mise à jour SQL, sans
+    signal): les niveaux du département sont recalculés. Inutile quand la catégorie part
+    avec son département.
+    """
+    modele_origine = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if modele_origine is Categorie:
+        NiveauStockService.reconstruire(instance.departement_id)
+
+
+# ============================================================================
+# SIGNAUX POUR LE TABLEAU DE BORD
+# ============================================================================
+
+@receiver(post_save, sender=Materiel)
+@receiver(post_delete, sender=Materiel)
+@receiver(post_save, sender=Departement)
+@receiver(post_delete, sender=Departement)
+def invalider_tableau_de_bord(sender, **kwargs):
+    """Invalide les instantanés du tableau de bord (les alertes passent par les compteurs)"""
+    DashboardService.invalider()
+
+
+# ============================================================================
+# SIGNAUX POUR LE PLAN DES RAPPELS
+# ============================================================================
+
+CHAMPS_PLAN = ('echeance', 'date_retour_effective')
+
+
+@receiver(post_init, sender=Attribution)
+def memoriser_etat_plan(sender, instance, **kwargs):
+    """Mémorise l'échéance et l'état de retour chargés pour ne recalculer le plan qu'en cas de changement"""
+    if _champs_differes(instance, CHAMPS_PLAN):
+        instance._etat_plan_initial = _INCONNU
+    else:
+        instance._etat_plan_initial = (instance.echeance, instance.date_retour_effective)
+
+
+@receiver(pre_save, sender=Attribution)
+def relire_etat_plan(sender, instance, raw=False, **kwargs):
+    """Relit l'état initial d'une attribution chargée sans l'échéance ou la date de retour"""
+    if not raw:
+        _relire_etat_initial(instance, '_etat_plan_initial', CHAMPS_PLAN, absent=(None, None))
+
+
+@receiver(post_save, sender=Attribution)
+def mettre_a_jour_plan_notifications(sender, instance, created, raw=False, **kwargs):
+    """Écrit, recalcule ou supprime le plan des rappels dans la transaction de la sauvegarde"""
+    if raw:
+        return
+    _charger_champs(instance, CHAMPS_PLAN)
+    etat = (instance.echeance, instance.date_retour_effective)
+    if created or etat != instance._etat_plan_initial:
+        PlanificationService.planifier(instance)
+    instance._etat_plan_initial = etat
+
+
+# ============================================================================
+# SIGNAUX POUR LE CACHE DES PRÉFÉRENCES
+# ============================================================================
+
+@receiver(post_save, sender=NotificationPreferences)
+@receiver(post_delete, sender=NotificationPreferences)
+def invalider_cache_preferences(sender, instance, **kwargs):
+    """Invalide les préférences mises en cache du client concerné"""
+    PreferencesService.invalider(instance.client_id)
 
 
 # ============================================================================
@@ -44,15 +256,14 @@ def detecter_retour_materiel(sender, instance, **kwargs):
     et marque l'instance pour envoi de notification dans post_save
     """
     if instance.pk:  # L'attribution existe déjà
-        try:
-            old_instance = Attribution.objects.get(pk=instance.pk)
-            # Si date_retour_effective vient d'être définie
-            if not old_instance.date_retour_effective and instance.date_retour_effective:
-                instance._notification_restitution_required = True
-            else:
-                instance._notification_restitution_required = False
-        except Attribution.DoesNotExist:
-            instance._notification_restitution_required = False
+        # État de retour mémorisé au chargement (memoriser_etat_plan), relu seulement si
+        # la date de retour était différée
+        _relire_etat_initial(instance, '_etat_plan_initial', CHAMPS_PLAN, absent=(None, None))
+        _, retour_initial = instance._etat_plan_initial
+        # Si date_retour_effective vient d'être définie
+        instance._notification_restitution_required = bool(
+            not retour_initial and instance.date_retour_effective
+        )
     else:
         instance._notification_restitution_required = False
 
@@ -60,113 +271,96 @@ def detecter_retour_materiel(sender, instance, **kwargs):
 @receiver(post_save, sender=Attribution)
 def envoyer_notifications_attribution(sender, instance, created, **kwargs):
     """
-    Envoie automatiquement les notifications lors de:
+    Met en file (outbox) les notifications lors de:
     1. Création d'une attribution → Notification de création
     2. Retour de matériel → Confirmation de restitution
     
-    Les notifications sont envoyées selon les préférences de l'utilisateur:
+    Les notifications sont écrites dans la transaction de la sauvegarde et envoyées
+    par le worker après validation, selon les préférences de l'utilisateur:
     - Email (par défaut activé)
     - WhatsApp (si activé et numéro configuré)
     """
-    # Récupérer les préférences du client
-    try:
-        preferences, _ = NotificationPreferences.objects.get_or_create(
-            client=instance.client
-        )
-    except Exception as e:
-        logger.error(f"Impossible de récupérer les préférences pour {instance.client}: {e}")
-        # Créer des préférences par défaut (email activé)
-        preferences = type('obj', (object,), {
-            'notifications_email': True,
-            'notifications_whatsapp': False,
-            'phone_number': None
-        })()
+    # Rien à envoyer pour une simple modification, ni sans client (attribution à une salle)
+    restitution = getattr(instance, '_notification_restitution_required', False)
+    if not (created or restitution) or instance.client_id is None:
+        return
+
+    # Préférences du client, en lecture seule (valeurs par défaut si aucune n'est enregistrée)
+    preferences = PreferencesService.pour_client(instance.client)
 
     # ========================================
     # 1. NOTIFICATION DE CRÉATION
     # ========================================
     if created:
-        logger.info(f"📧 Nouvelle attribution créée: {instance.id} - Envoi des notifications...")
+        logger.info(f"📧 Nouvelle attribution créée: {instance.id} - Mise en file des notifications...")
         
         # Email de création (si activé)
         if preferences.notifications_email and instance.client.email:
             try:
-                # Créer le log de notification
-                from .models import NotificationLog
-                log = NotificationLog.objects.create(
+                # Mettre en file dans l'outbox (envoi par le worker après validation)
+                NotificationLog.objects.create(
                     attribution=instance,
                     type_notification=NotificationLog.TYPE_CREATION,
                     canal='EMAIL',
                     duree_emprunt=instance.duree_emprunt,
                     destinataire=instance.client.email,
-                    statut='EN_ATTENTE'
+                    statut=NotificationLog.STATUT_EN_ATTENTE
                 )
-                # Envoyer via le service
-                NotificationEmailService.send_notification(log)
-                logger.info(f"✅ Email de création envoyé à {instance.client.email}")
+                logger.info(f"✅ Email de création mis en file pour {instance.client.email}")
             except Exception as e:
                 logger.error(f"❌ Erreur email création: {e}", exc_info=True)
         
         # WhatsApp de création (si activé)
         if preferences.notifications_whatsapp and preferences.phone_number:
             try:
-                # Créer le log de notification
-                from .models import NotificationLog
-                log = NotificationLog.objects.create(
+                # Mettre en file dans l'outbox (envoi par le worker après validation)
+                NotificationLog.objects.create(
                     attribution=instance,
                     type_notification=NotificationLog.TYPE_CREATION,
                     canal='WHATSAPP',
                     duree_emprunt=instance.duree_emprunt,
                     destinataire=preferences.phone_number,
-                    statut='EN_ATTENTE'
+                    statut=NotificationLog.STATUT_EN_ATTENTE
                 )
-                # Envoyer via le service
-                WhatsAppNotificationService.send_notification(log)
-                logger.info(f"✅ WhatsApp de création envoyé à {preferences.phone_number}")
+                logger.info(f"✅ WhatsApp de création mis en file pour {preferences.phone_number}")
             except Exception as e:
                 logger.error(f"❌ Erreur WhatsApp création: {e}", exc_info=True)
 
     # ========================================
     # 2. CONFIRMATION DE RESTITUTION
     # ========================================
-    elif hasattr(instance, '_notification_restitution_required') and instance._notification_restitution_required:
-        logger.info(f"📦 Matériel retourné pour attribution {instance.id} - Envoi des confirmations...")
+    elif restitution:
+        logger.info(f"📦 Matériel retourné pour attribution {instance.id} - Mise en file des confirmations...")
         
         # Email de restitution (si activé)
         if preferences.notifications_email and instance.client.email:
             try:
-                # Créer le log de notification
-                from .models import NotificationLog
-                log = NotificationLog.objects.create(
+                # Mettre en file dans l'outbox (envoi par le worker après validation)
+                NotificationLog.objects.create(
                     attribution=instance,
                     type_notification=NotificationLog.TYPE_RESTITUTION,
                     canal='EMAIL',
                     duree_emprunt=instance.duree_emprunt,
                     destinataire=instance.client.email,
-                    statut='EN_ATTENTE'
+                    statut=NotificationLog.STATUT_EN_ATTENTE
                 )
-                # Envoyer via le service
-                NotificationEmailService.send_notification(log)
-                logger.info(f"✅ Email de restitution envoyé à {instance.client.email}")
+                logger.info(f"✅ Email de restitution mis en file pour {instance.client.email}")
             except Exception as e:
                 logger.error(f"❌ Erreur email restitution: {e}", exc_info=True)
         
         # WhatsApp de restitution (si activé)
         if preferences.notifications_whatsapp and preferences.phone_number:
             try:
-                # Créer le log de notification
-                from .models import NotificationLog
-                log = NotificationLog.objects.create(
+                # Mettre en file dans l'outbox (envoi par le worker après validation)
+                NotificationLog.objects.create(
                     attribution=instance,
                     type_notification=NotificationLog.TYPE_RESTITUTION,
                     canal='WHATSAPP',
                     duree_emprunt=instance.duree_emprunt,
                     destinataire=preferences.phone_number,
-                    statut='EN_ATTENTE'
+                    statut=NotificationLog.STATUT_EN_ATTENTE
                 )
-                # Envoyer via le service
-                WhatsAppNotificationService.send_notification(log)
-                logger.info(f"✅ WhatsApp de restitution envoyé à {preferences.phone_number}")
+                logger.info(f"✅ WhatsApp de restitution mis en file pour {preferences.phone_number}")
             except Exception as e:
                 logger.error(f"❌ Erreur WhatsApp restitution: {e}", exc_info=True)
         
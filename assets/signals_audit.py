@@ -1,12 +1,21 @@
-from django.db.models.signals import pre_save, post_save, post_delete
+import copy
+import logging
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.contenttypes.models import ContentType
-from django.forms.models import model_to_dict
 from django.utils.timezone import now
 
 from .models import AuditLog
 from .middleware import get_current_user, get_current_request
 
+logger = logging.getLogger(__name__)
+
 
 def _safe_repr(obj):
     try:
@@ -53,90 +62,190 @@ def _safe_jsonify(value):
     return _safe_repr(value)
 
 
-def _diff_instance(old, new):
-    """Return a dict of changed fields: {field: [old, new]}"""
+def _field_values(instance, fields=None):
+    """Values of the instance's editable concrete fields, keyed by field name.
+
+    Values are read from the instance ``__dict__``: deferred fields are skipped
+    instead of being loaded, so this never queries the database (unlike
+    ``model_to_dict``, which also fetches many-to-many relations).
+    ``fields`` optionally restricts the result (e.g. to ``update_fields``).
+    """
+    values = {}
+    for f in instance._meta.concrete_fields:
+        if not f.editable or f.attname not in instance.__dict__:
+            continue
+        if fields is not None and f.name not in fields and f.attname not in fields:
+            continue
+        value = instance.__dict__[f.attname]
+        if isinstance(value, (dict, list)):
+            # JSON values can be mutated in place; keep an independent copy
+            value = copy.deepcopy(value)
+        values[f.name] = value
+    return values
+
+
+def _diff_values(old_values, new_values):
+    """Return a dict of changed fields: {field: [old, new]}.
+
+    With ``old_values`` None (creation, or original state unknown) every
+    non-null new value is recorded against a null old value.
+    """
     changes = {}
-    old_dict = model_to_dict(old) if old is not None else {}
-    new_dict = model_to_dict(new)
-    # Compare keys present in new
-    for k, new_val in new_dict.items():
-        old_val = old_dict.get(k)
-        if old is None:
-            # creation: record initial values
+    for k, new_val in new_values.items():
+        if old_values is None:
             if new_val is not None:
-                changes[k] = [_safe_jsonify(old_val), _safe_jsonify(new_val)]
-        else:
-            if old_val != new_val:
-                changes[k] = [_safe_jsonify(old_val), _safe_jsonify(new_val)]
+                changes[k] = [None, _safe_jsonify(new_val)]
+        elif k in old_values and old_values[k] != new_val:
+            changes[k] = [_safe_jsonify(old_values[k]), _safe_jsonify(new_val)]
     return changes
 
 
-@receiver(post_save)
-def audit_post_save(sender, instance, created, **kwargs):
-    # Skip AuditLog itself to avoid recursion
-    if sender.__name__ == 'AuditLog':
+def _diff_instance(old, new):
+    """Return a dict of changed fields between two instances: {field: [old, new]}"""
+    return _diff_values(_field_values(old) if old is not None else None, _field_values(new))
+
+
+def _is_audited(sender):
+    # Skip AuditLog itself (and its archive segments) to avoid recursion, and Django's
+    # migration recorder (its rows are saved while the contenttypes table may not be migrated yet)
+    if sender.__name__ in ('AuditLog', 'SegmentAudit'):
+        return False
+    if sender._meta.app_label == 'migrations':
+        return False
+    # High-churn models can be left out of the audit trail entirely
+    excluded = getattr(settings, 'AUDIT_EXCLUDED_MODELS', ())
+    return sender._meta.label_lower not in {label.lower() for label in excluded}
+
+
+# ---------------------------------------------------------------------------
+# Buffered writing
+#
+# Entries created inside a transaction are held in an on_commit hook until it
+# commits; nothing is written if it (or the savepoint they were created in)
+# rolls back. Inside ``audit_buffer()`` - every request, via
+# CurrentUserMiddleware - committed entries and those created in autocommit
+# mode are further held until the end of the unit of work, so a request costs
+# one audit INSERT however many objects it touches.
+# ---------------------------------------------------------------------------
+
+_buffer = threading.local()
+
+
+def _write(entries):
+    if entries:
+        AuditLog.objects.bulk_create(entries, batch_size=500)
+
+
+@contextmanager
+def audit_buffer():
+    """Hold the audit entries of a unit of work and write them in one INSERT at its end."""
+    if getattr(_buffer, 'entries', None) is not None:
+        # Nested unit: the outermost one writes
+        yield
         return
+    _buffer.entries = []
+    try:
+        yield
+    finally:
+        entries, _buffer.entries = _buffer.entries, None
+        try:
+            _write(entries)
+        except Exception:
+            # Never mask the exception of the unit of work (or fail it) because of its audit trail
+            logger.exception(f"Could not write {len(entries)} buffered audit entries")
+
+
+def _committed(entries):
+    """on_commit hook: hand the entries to the unit of work or write them"""
+    if getattr(_buffer, 'entries', None) is not None:
+        _buffer.entries.extend(entries)
+    else:
+        _write(entries)
+
 
-    user = get_current_user()
+def _queue(entries):
+    """Buffer audit entries until the current transaction commits (or the unit of work ends)."""
+    if not transaction.get_connection().in_atomic_block:
+        _committed(entries)
+        return
+    # Django drops the hooks of a savepoint that rolls back, and with them its entries
+    transaction.on_commit(partial(_committed, entries), robust=True)
+
+
+def _entry(sender, instance, action, changes):
+    """Unsaved AuditLog for ``instance``, attributed to the current request"""
     request = get_current_request()
-    ct = ContentType.objects.get_for_model(sender)
-    object_repr = _safe_repr(instance)
-    obj_id = getattr(instance, 'pk', None)
+    return AuditLog(
+        user=get_current_user(),
+        action=action,
+        content_type=ContentType.objects.get_for_model(sender),
+        object_id=str(instance.pk) if instance.pk is not None else None,
+        object_repr=_safe_repr(instance),
+        changes=changes or None,
+        ip_address=getattr(request, 'META', {}).get('REMOTE_ADDR') if request else None,
+        metadata=_safe_jsonify({'path': getattr(request, 'path', None)}) if request else None,
+        timestamp=now(),
+    )
+
+
+def audit_bulk_create(sender, instances):
+    """Record CREATE audit entries for objects inserted with ``bulk_create``.
+
+    ``bulk_create`` does not send ``post_save``; callers use this helper so bulk
+    inserts stay in the audit trail. The entries are buffered like the others.
+    """
+    if not instances or not _is_audited(sender):
+        return []
+    entries = [
+        _entry(sender, instance, AuditLog.ACTION_CREATE, _diff_values(None, _field_values(instance)))
+        for instance in instances
+    ]
+    _queue(entries)
+    return entries
+
+
+@receiver(post_init)
+def audit_track_original(sender, instance, **kwargs):
+    """Remember the field values an instance was loaded with.
+
+    ``audit_post_save`` diffs against this snapshot in memory instead of
+    re-reading the row, which would cost a query and, being run after the
+    save, return the values just written.
+    """
+    if instance.pk is not None and _is_audited(sender):
+        instance._audit_original = _field_values(instance)
+
+
+@receiver(post_save)
+def audit_post_save(sender, instance, created, update_fields=None, **kwargs):
+    if not _is_audited(sender):
+        return
 
     if created:
-        changes = _diff_instance(None, instance)
-        AuditLog.objects.create(
-            user=user,
-            action=AuditLog.ACTION_CREATE,
-            content_type=ct,
-            object_id=str(obj_id) if obj_id is not None else None,
-            object_repr=object_repr,
-            changes=changes or None,
-            ip_address=getattr(request, 'META', {}).get('REMOTE_ADDR') if request else None,
-            metadata=_safe_jsonify({'path': getattr(request, 'path', None)}) if request else None,
-        )
+        _queue([_entry(sender, instance, AuditLog.ACTION_CREATE, _diff_values(None, _field_values(instance)))])
     else:
-        # For update, we try to get previous state by fetching fresh from DB
-        try:
-            old = sender.objects.get(pk=instance.pk)
-        except Exception:
-            old = None
-        # If old is equal to instance as fetched (unlikely), record diffs by comparing field values
-        changes = _diff_instance(old, instance)
+        # Diff against the values captured at load time (or after the previous save);
+        # only the saved fields when update_fields restricts the UPDATE
+        original = getattr(instance, '_audit_original', None)
+        changes = _diff_values(original, _field_values(instance, update_fields))
         if changes:
-            AuditLog.objects.create(
-                user=user,
-                action=AuditLog.ACTION_UPDATE,
-                content_type=ct,
-                object_id=str(obj_id) if obj_id is not None else None,
-                object_repr=object_repr,
-                changes=changes,
-                ip_address=getattr(request, 'META', {}).get('REMOTE_ADDR') if request else None,
-                metadata=_safe_jsonify({'path': getattr(request, 'path', None)}) if request else None,
-            )
+            _queue([_entry(sender, instance, AuditLog.ACTION_UPDATE, changes)])
+
+    # The saved values become the reference for the next save of this instance
+    saved = _field_values(instance, None if created else update_fields)
+    if created or update_fields is None or not hasattr(instance, '_audit_original'):
+        instance._audit_original = saved
+    else:
+        instance._audit_original.update(saved)
 
 
 @receiver(post_delete)
 def audit_post_delete(sender, instance, **kwargs):
-    if sender.__name__ == 'AuditLog':
+    if not _is_audited(sender):
         return
-    user = get_current_user()
-    request = get_current_request()
-    ct = ContentType.objects.get_for_model(sender)
-    object_repr = _safe_repr(instance)
-    obj_id = getattr(instance, 'pk', None)
     # Capture a snapshot of the instance fields
     try:
-        snapshot = {k: _safe_jsonify(v) for k, v in model_to_dict(instance).items()}
+        snapshot = {k: _safe_jsonify(v) for k, v in _field_values(instance).items()}
     except Exception:
         snapshot = None
-    AuditLog.objects.create(
-        user=user,
-        action=AuditLog.ACTION_DELETE,
-        content_type=ct,
-        object_id=str(obj_id) if obj_id is not None else None,
-        object_repr=object_repr,
-        changes={'snapshot': snapshot} if snapshot else None,
-        ip_address=getattr(request, 'META', {}).get('REMOTE_ADDR') if request else None,
-        metadata=_safe_jsonify({'path': getattr(request, 'path', None)}) if request else None,
-    )
+    _queue([_entry(sender, instance, AuditLog.ACTION_DELETE, {'snapshot': snapshot} if snapshot else None)])
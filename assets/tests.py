@@ -1,9 +1,9 @@
 from django.test import TestCase, Client as DjangoTestClient
 from django.contrib.auth.models import User
 from .models import Departement, Categorie, Materiel
-from .models import Client, Attribution
+from .models import Client, Attribution, Alerte
 from django.urls import reverse
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
 class MaterielViewsTest(TestCase):
     """Tests des vues de gestion du matériel"""
@@ -62,6 +62,60 @@ class MaterielViewsTest(TestCase):
         # Vérifier que la page charge correctement sans erreur
         self.assertEqual(response.status_code, 200)
     
+    def test_materiel_list_nombre_de_requetes_constant(self):
+        """Le nombre de requêtes de la liste groupée ne dépend pas du nombre de groupes"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.client.login(username='test', password='testpass123')
+        defaut, _ = Departement.objects.get_or_create(code='DEF', defaults={'nom': 'Département par défaut'})
+
+        def compter_requetes():
+            with CaptureQueriesContext(connection) as requetes:
+                response = self.client.get('/materiel/', {'tri': '-quantite'})
+            self.assertEqual(response.status_code, 200)
+            return len(requetes), response.context['groupes_materiels']
+
+        Materiel.objects.create(asset_id='GRP000', numero_inventaire='INV-GRP-000', nom='Groupe 0', departement=defaut)
+        avant, _ = compter_requetes()
+        for i in range(1, 11):
+            for j in range(i % 3 + 1):
+                Materiel.objects.create(
+                    asset_id=f'GRP{i:02d}{j}', numero_inventaire=f'INV-GRP-{i:02d}{j}',
+                    nom=f'Groupe {i}', departement=defaut,
+                )
+        apres, groupes = compter_requetes()
+
+        self.assertEqual(avant, apres)
+        self.assertEqual(len(groupes), 11)
+        self.assertEqual(groupes[0]['quantite'], 3)
+
+    def test_materiel_list_groupes_par_categorie(self):
+        """Avec ou sans recherche, un même nom est groupé par catégorie; supprimer une catégorie regroupe ses matériels"""
+        from .models import NiveauStock
+
+        self.client.login(username='test', password='testpass123')
+        defaut, _ = Departement.objects.get_or_create(code='DEF', defaults={'nom': 'Département par défaut'})
+        cables = Categorie.objects.create(nom='Câbles', departement=defaut)
+        audio = Categorie.objects.create(nom='Audio', departement=defaut)
+        for i, categorie in enumerate([cables, cables, audio, None]):
+            Materiel.objects.create(
+                asset_id=f'XLR{i}', numero_inventaire=f'INV-XLR-{i}', nom='XLR', categorie=categorie, departement=defaut,
+            )
+
+        def groupes(**params):
+            response = self.client.get('/materiel/', params)
+            return sorted((g['categorie']['nom'] if g['categorie'] else '', g['quantite']) for g in response.context['groupes_materiels'])
+
+        self.assertEqual(groupes(), [('', 1), ('Audio', 1), ('Câbles', 2)])
+        self.assertEqual(groupes(q='XLR'), groupes())
+        self.assertEqual(groupes(categorie=cables.pk), [('Câbles', 2)])
+        self.assertEqual(groupes(categorie=cables.pk, q='XLR'), [('Câbles', 2)])
+
+        cables.delete()
+        self.assertEqual(groupes(), [('', 3), ('Audio', 1)])
+        self.assertEqual(NiveauStock.objects.get(departement=defaut, nom='XLR', categorie=None).total, 3)
+
     def test_create_materiel_get(self):
         """Le formulaire de création s'affiche"""
         self.client.login(username='test', password='testpass123')
@@ -84,6 +138,7 @@ class MaterielViewsTest(TestCase):
         retour_prevu = date.today() + timedelta(days=3)
         resp = self.client.post(url_checkout, data={
             'materiel': self.materiel.pk,
+            'destination_type': 'client',
             'client': client.pk,
             'date_retour_prevue': retour_prevu,
             'notes': 'Prêt test'
@@ -117,3 +172,1086 @@ class MaterielViewsTest(TestCase):
         self.materiel.refresh_from_db()
         self.assertEqual(self.materiel.statut_disponibilite, 'DISPONIBLE')
 
+        # Le mouvement de retour n'écrase pas celui du check-out
+        mouvements = Alerte.objects.filter(attribution=attribution, severite=Alerte.SEVERITE_INFO).order_by('pk')
+        self.assertEqual(len(mouvements), 2)
+        self.assertTrue(mouvements[0].description.startswith('Matériel attribué à'))
+        self.assertFalse(mouvements[0].reglementee)
+        self.assertTrue(mouvements[1].description.startswith('Matériel retourné par'))
+        self.assertTrue(mouvements[1].reglementee)
+
+    def test_checkout_echoue_sans_notification(self):
+        """Un check-out interrompu après l'enregistrement de l'attribution ne laisse aucune notification en file"""
+        from unittest import mock
+        from .models import HistoriqueAttribution, NotificationLog
+
+        self.client.login(username='test', password='testpass123')
+        client = Client.objects.create(nom='Client Test', email='client@example.com', departement=self.dept)
+        url_checkout = reverse('assets:materiel_checkout', args=[self.materiel.asset_id])
+        donnees = {
+            'materiel': self.materiel.pk,
+            'destination_type': 'client',
+            'client': client.pk,
+            'date_retour_prevue': date.today() + timedelta(days=3),
+        }
+
+        with mock.patch.object(HistoriqueAttribution.objects, 'create', side_effect=RuntimeError('panne')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(url_checkout, data=donnees)
+        self.assertFalse(Attribution.objects.exists())
+        self.assertFalse(NotificationLog.objects.exists())
+        self.materiel.refresh_from_db()
+        self.assertEqual(self.materiel.statut_disponibilite, 'DISPONIBLE')
+
+        self.assertEqual(self.client.post(url_checkout, data=donnees).status_code, 302)
+        self.assertTrue(NotificationLog.objects.exists())
+
+
+
+class AlerteDetectionTest(TestCase):
+    """Tests du moteur de détection ensembliste des alertes"""
+
+    def setUp(self):
+        self.dept = Departement.objects.create(code='DET', nom='Détection')
+        self.client_obj = Client.objects.create(nom='Client Retard', departement=self.dept)
+        self.attributions = []
+        for i in range(3):
+            materiel = Materiel.objects.create(
+                asset_id=f'DET{i:03d}',
+                numero_inventaire=f'INV-DET-{i:03d}',
+                nom='Projecteur',
+                departement=self.dept,
+            )
+            self.attributions.append(Attribution.objects.create(
+                materiel=materiel,
+                client=self.client_obj,
+                departement=self.dept,
+                date_retour_prevue=date.today() - timedelta(days=3),
+            ))
+
+    def test_detection_cree_une_alerte_par_attribution_en_retard(self):
+        """Une alerte de retard par attribution, avec statistiques par type"""
+        from .services import AlerteService
+
+        resultats = AlerteService.detecter_toutes_alertes(envoyer_emails=False)
+
+        self.assertEqual(len(resultats['retards']), 3)
+        self.assertEqual(resultats['stats']['retards'], {'scannees': 3, 'inserees': 3})
+        self.assertEqual(
+            Alerte.objects.filter(type_alerte=Alerte.TYPE_RETARD, reglementee=False).count(), 3
+        )
+
+    def test_detection_idempotente(self):
+        """Une seconde détection ne duplique pas les alertes ouvertes"""
+        from .services import AlerteService
+
+        AlerteService.detecter_retards_retour()
+        stats = {}
+        with self.assertNumQueries(1):
+            nouvelles = AlerteService.detecter_retards_retour(stats)
+
+        self.assertEqual(nouvelles, [])
+        self.assertEqual(stats['retards'], {'scannees': 3, 'inserees': 0})
+
+    def test_stock_critique_cle_structuree(self):
+        """Un nom contenu dans un autre ne masque pas son alerte de stock critique"""
+        from .services import AlerteService
+
+        Materiel.objects.create(
+            asset_id='DET100', numero_inventaire='INV-DET-100',
+            nom='Projecteur HD', departement=self.dept,
+        )
+
+        creees = AlerteService.detecter_stock_critique()
+        self.assertEqual(
+            sorted(a.nom_equipement for a in creees), ['Projecteur', 'Projecteur HD']
+        )
+
+        stats = {}
+        with self.assertNumQueries(1):
+            self.assertEqual(AlerteService.detecter_stock_critique(stats), [])
+        self.assertEqual(stats['stock_critique'], {'scannees': 2, 'inserees': 0})
+
+    def test_detection_incrementale(self):
+        """Le mode incrémental ne réévalue que les lignes modifiées depuis le watermark"""
+        from .services import AlerteService
+
+        premier = AlerteService.detecter_toutes_alertes(envoyer_emails=False, incremental=True)
+        self.assertEqual(premier['modes']['retards'], 'complet')
+        self.assertEqual(len(premier['retards']), 3)
+
+        # Rien n'a changé: lecture des watermarks, deux EXISTS, mise à jour des watermarks
+        with self.assertNumQueries(4):
+            second = AlerteService.detecter_toutes_alertes(envoyer_emails=False, incremental=True)
+        self.assertEqual(second['total'], 0)
+        self.assertEqual(second['modes']['retards'], 'incremental')
+
+        # Une alerte réglée puis une modification de l'attribution: seule celle-ci est réévaluée
+        attribution = self.attributions[0]
+        Alerte.objects.filter(attribution=attribution).update(reglementee=True)
+        attribution.notes = 'Relance client'
+        attribution.save()
+        troisieme = AlerteService.detecter_toutes_alertes(envoyer_emails=False, incremental=True)
+        self.assertEqual([a.attribution_id for a in troisieme['retards']], [attribution.pk])
+        self.assertEqual(troisieme['stats']['retards'], {'scannees': 1, 'inserees': 1})
+
+    def test_alerte_ouverte_unique(self):
+        """Les alertes ouvertes sont uniques par clé: pas de doublon même sans anti-join préalable, ni à la réouverture"""
+        from .services import AlerteService, CompteurAlertesService
+
+        attribution = self.attributions[0]
+        alerte = Alerte(
+            type_alerte=Alerte.TYPE_RETARD,
+            severite=Alerte.SEVERITE_WARNING,
+            materiel=attribution.materiel,
+            attribution=attribution,
+            departement=self.dept,
+            description='Retard',
+        )
+        self.assertEqual(len(AlerteService.inserer_alertes([alerte])), 1)
+
+        # Un détecteur concurrent qui n'a pas vu l'alerte ne crée pas de doublon
+        concurrente = Alerte(
+            type_alerte=Alerte.TYPE_RETARD,
+            severite=Alerte.SEVERITE_WARNING,
+            materiel=attribution.materiel,
+            attribution=attribution,
+            departement=self.dept,
+            description='Retard (bis)',
+        )
+        self.assertEqual(AlerteService.inserer_alertes([concurrente]), [])
+
+        existante, created = AlerteService.upsert_alerte(
+            type_alerte=Alerte.TYPE_RETARD,
+            severite=Alerte.SEVERITE_WARNING,
+            materiel=attribution.materiel,
+            attribution=attribution,
+            departement=self.dept,
+            description='Retard mis à jour',
+        )
+        self.assertFalse(created)
+        self.assertEqual(existante.pk, alerte.pk)
+        self.assertEqual(
+            list(Alerte.objects.filter(attribution=attribution).values_list('description', flat=True)),
+            ['Retard mis à jour'],
+        )
+
+        # Rouvrir une alerte réglée dont la clé a déjà une alerte ouverte la laisse réglée
+        CompteurAlertesService.regler(Alerte.objects.filter(pk=alerte.pk))
+        rouverte = Alerte.objects.create(
+            type_alerte=Alerte.TYPE_RETARD,
+            severite=Alerte.SEVERITE_WARNING,
+            materiel=attribution.materiel,
+            attribution=attribution,
+            departement=self.dept,
+            description='Nouveau retard',
+        )
+        CompteurAlertesService.regler(Alerte.objects.filter(pk=rouverte.pk))
+        autre = Alerte.objects.create(
+            type_alerte=Alerte.TYPE_DEFECTUEUX,
+            severite=Alerte.SEVERITE_WARNING,
+            materiel=attribution.materiel,
+            departement=self.dept,
+            description='Défectueux',
+            reglementee=True,
+        )
+        self.assertEqual(CompteurAlertesService.regler(Alerte.objects.all(), reglementee=False), 2)
+        self.assertEqual(
+            sorted(Alerte.objects.filter(reglementee=False).values_list('pk', flat=True)),
+            [rouverte.pk, autre.pk],
+        )
+        self.assertEqual(CompteurAlertesService.regler(Alerte.objects.all(), reglementee=False), 0)
+        self.assertEqual(CompteurAlertesService.compter(self.dept), (2, 0))
+
+    def test_compteurs_alertes(self):
+        """Les compteurs suivent créations (unitaires et en masse), règlements et suppressions"""
+        from .services import AlerteService, CompteurAlertesService
+
+        AlerteService.detecter_retards_retour()
+        alerte = Alerte.objects.create(
+            type_alerte=Alerte.TYPE_DEFECTUEUX,
+            severite=Alerte.SEVERITE_CRITICAL,
+            materiel=self.attributions[0].materiel,
+            departement=self.dept,
+            description='Écran cassé',
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(CompteurAlertesService.compter(self.dept), (4, 1))
+
+        CompteurAlertesService.regler(Alerte.objects.filter(type_alerte=Alerte.TYPE_RETARD))
+        self.assertEqual(CompteurAlertesService.compter(self.dept), (1, 1))
+
+        alerte.reglementee = True
+        alerte.save()
+        self.assertEqual(CompteurAlertesService.compter(self.dept), (0, 0))
+
+        alerte.reglementee = False
+        alerte.save()
+        self.assertEqual(CompteurAlertesService.compter(self.dept), (1, 1))
+
+        # Chargée sans les champs du compteur: pas de récursion, l'état initial est relu en base
+        partielle = Alerte.objects.only('id').get(pk=alerte.pk)
+        self.assertEqual(partielle.severite, Alerte.SEVERITE_CRITICAL)
+        partielle = Alerte.objects.only('id', 'reglementee').get(pk=alerte.pk)
+        partielle.reglementee = True
+        partielle.save()
+        self.assertEqual(CompteurAlertesService.compter(self.dept), (0, 0))
+        alerte.refresh_from_db()
+        alerte.reglementee = False
+        alerte.save()
+
+        # type et sévérité servent au libellé de l'audit, écrit après la suppression
+        Alerte.objects.only('id', 'type_alerte', 'severite').get(pk=alerte.pk).delete()
+        self.assertEqual(CompteurAlertesService.compter(), (0, 0))
+        self.assertEqual(CompteurAlertesService.reconstruire(), 0)
+
+    def test_liste_alertes_pagination_par_cle(self):
+        """Statistiques en une requête et pagination par clé sans doublon ni trou"""
+        from .services import AlerteService
+
+        AlerteService.detecter_retards_retour()
+        Alerte.objects.create(
+            type_alerte=Alerte.TYPE_DEFECTUEUX,
+            severite=Alerte.SEVERITE_CRITICAL,
+            materiel=self.attributions[0].materiel,
+            departement=self.dept,
+            description='Écran cassé',
+        )
+        alertes = AlerteService.get_alertes_non_reglementees(self.dept)
+
+        with self.assertNumQueries(1):
+            stats = AlerteService.statistiques_alertes(alertes)
+        self.assertEqual((stats['total'], stats['critique'], stats['retard']), (4, 1, 3))
+
+        vues, curseur = [], None
+        while True:
+            page, curseur = AlerteService.page_alertes(alertes, curseur, taille=3)
+            vues.extend(page)
+            if not curseur:
+                break
+        self.assertEqual(vues, list(alertes))
+
+
+class DashboardSnapshotTest(TestCase):
+    """Tests de l'instantané du tableau de bord"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.depts = [Departement.objects.create(code=f'D{i}', nom=f'Département {i}') for i in range(3)]
+        for i, dept in enumerate(self.depts):
+            for j in range(i + 1):
+                Materiel.objects.create(
+                    asset_id=f'SNAP{i}{j}', numero_inventaire=f'INV-SNAP-{i}{j}',
+                    nom='Écran', departement=dept,
+                    statut_disponibilite='ATTRIBUE' if j else 'DISPONIBLE',
+                )
+
+    def test_snapshot_groupe_et_cache(self):
+        """Tous les départements en deux requêtes, puis lecture depuis le cache jusqu'à invalidation"""
+        from .dashboard_service import DashboardService
+
+        with self.assertNumQueries(2):
+            snapshot = DashboardService.get_snapshot()
+        self.assertEqual(snapshot['total_materiel'], 6)
+        self.assertEqual(snapshot['materiel_attribue'], 3)
+        self.assertEqual(snapshot['materiel_disponible'], 3)
+        self.assertEqual([d['total'] for d in snapshot['departements']], [1, 2, 3])
+
+        with self.assertNumQueries(0):
+            DashboardService.get_snapshot()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Materiel.objects.create(
+                asset_id='SNAP99', numero_inventaire='INV-SNAP-99', nom='Écran', departement=self.depts[0],
+                statut_disponibilite='DISPONIBLE', etat_technique='DEFECTUEUX',
+            )
+        self.assertEqual(DashboardService.get_snapshot(self.depts[0])['total_materiel'], 2)
+        snapshot = DashboardService.get_snapshot()
+        self.assertEqual(snapshot['total_materiel'], 7)
+        # Le tableau de bord compte le statut disponible, quel que soit l'état technique
+        self.assertEqual(snapshot['materiel_disponible'], 4)
+        self.assertEqual(snapshot['materiel_defectueux'], 1)
+
+    def test_niveaux_stock_maintenus(self):
+        """Les niveaux de stock suivent les changements de statut, de nom et les suppressions"""
+        from .models import NiveauStock
+        from .services import NiveauStockService
+
+        dept = self.depts[2]
+        ecran = Materiel.objects.filter(departement=dept, statut_disponibilite='ATTRIBUE').first()
+        ecran.statut_disponibilite = 'DISPONIBLE'
+        ecran.save()
+        niveau = NiveauStock.objects.get(departement=dept, nom='Écran')
+        self.assertEqual((niveau.total, niveau.disponible, niveau.attribue), (3, 2, 1))
+
+        ecran.nom = 'Moniteur'
+        ecran.save()
+        ecran.delete()
+        niveau.refresh_from_db()
+        self.assertEqual((niveau.total, niveau.disponible), (2, 1))
+        self.assertEqual(NiveauStock.objects.get(departement=dept, nom='Moniteur').total, 0)
+
+        attendus = sorted(NiveauStock.objects.filter(total__gt=0).values_list('departement', 'nom', 'total', 'disponible'))
+        NiveauStockService.reconstruire()
+        self.assertEqual(sorted(NiveauStock.objects.values_list('departement', 'nom', 'total', 'disponible')), attendus)
+
+    def test_niveaux_stock_materiel_charge_partiellement(self):
+        """Un matériel chargé avec .only() se lit sans récursion et garde les niveaux justes"""
+        from .models import NiveauStock
+
+        dept = self.depts[2]
+        pk = Materiel.objects.filter(departement=dept, statut_disponibilite='ATTRIBUE').values_list('pk', flat=True).first()
+        ecran = Materiel.objects.only('id').get(pk=pk)
+        self.assertEqual(ecran.nom, 'Écran')
+
+        ecran = Materiel.objects.only('id', 'statut_disponibilite').get(pk=pk)
+        ecran.statut_disponibilite = 'DISPONIBLE'
+        ecran.save()
+        niveau = NiveauStock.objects.get(departement=dept, nom='Écran')
+        self.assertEqual((niveau.total, niveau.disponible, niveau.attribue), (3, 2, 1))
+
+        # asset_id et nom servent au libellé de l'audit, écrit après la suppression
+        Materiel.objects.only('id', 'asset_id', 'nom').get(pk=pk).delete()
+        niveau.refresh_from_db()
+        self.assertEqual((niveau.total, niveau.disponible, niveau.attribue), (2, 1, 1))
+
+
+class NotificationOutboxTest(TestCase):
+    """Tests de l'outbox des notifications"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()  # préférences et instantanés en cache survivent au rollback des tests
+        self.dept = Departement.objects.create(code='OUT', nom='Outbox')
+        self.client_obj = Client.objects.create(nom='Client Outbox', email='client@example.com', departement=self.dept)
+        self.materiel = Materiel.objects.create(
+            asset_id='OUT001', numero_inventaire='INV-OUT-001', nom='Caméra', departement=self.dept,
+        )
+
+    def test_notification_mise_en_file_puis_envoyee_par_le_worker(self):
+        """L'attribution n'envoie rien elle-même: le worker envoie chaque notification une seule fois"""
+        from django.core import mail
+        from .models import NotificationLog
+        from .outbox_service import NotificationOutboxService
+
+        Attribution.objects.create(
+            materiel=self.materiel, client=self.client_obj, departement=self.dept,
+            date_retour_prevue=date.today() + timedelta(days=2),
+        )
+        log = NotificationLog.objects.get(type_notification=NotificationLog.TYPE_CREATION)
+        self.assertEqual(log.statut, NotificationLog.STATUT_EN_ATTENTE)
+        self.assertEqual(len(mail.outbox), 0)
+        mise_en_file = log.date_envoi
+
+        resultat = NotificationOutboxService.traiter_lot(concurrence=1)
+        self.assertEqual((resultat['reservees'], resultat['envoyees'], resultat['echecs']), (1, 1, 0))
+        self.assertEqual(resultat['email']['envoyes'], 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['client@example.com'])
+        log.refresh_from_db()
+        self.assertEqual(log.statut, NotificationLog.STATUT_ENVOYEE)
+        # La date d'envoi est celle de l'envoi, pas de la mise en file
+        self.assertGreater(log.date_envoi, mise_en_file)
+
+        self.assertEqual(NotificationOutboxService.traiter_lot(concurrence=1)['reservees'], 0)
+
+    def test_connexion_email_partagee_reconnecte(self):
+        """Une déconnexion du serveur en cours de lot rouvre la connexion et renvoie le message"""
+        import smtplib
+        from django.core.mail import EmailMessage
+        from .email_service import ConnexionEmailPartagee
+
+        class ConnexionInstable:
+            ouvertures = 0
+            envois = 0
+
+            def open(self):
+                self.ouvertures += 1
+
+            def close(self):
+                pass
+
+            def send_messages(self, messages):
+                self.envois += 1
+                if self.envois == 2:
+                    raise smtplib.SMTPServerDisconnected('connexion perdue')
+                return len(messages)
+
+        instable = ConnexionInstable()
+        with ConnexionEmailPartagee(instable) as connexion:
+            for i in range(3):
+                connexion.envoyer(EmailMessage(f'Test {i}', 'Corps', 'noreply@example.com', ['dest@example.com']))
+
+        metriques = connexion.metriques()
+        self.assertEqual((metriques['envoyes'], metriques['echecs'], metriques['reconnexions']), (3, 0, 1))
+        self.assertEqual(instable.ouvertures, 2)
+
+    def test_dispatcher_whatsapp_contre_api_locale(self):
+        """Le dispatcher attend après un 429, renvoie le message et enregistre le SID Twilio"""
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from django.test import override_settings
+        from .models import NotificationLog
+        from .whatsapp_service import WhatsAppNotificationService
+
+        requetes = []
+
+        class FausseApiTwilio(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                requetes.append(self.path)
+                if len(requetes) == 1:
+                    statut, corps = 429, {'code': 20429, 'message': 'Too Many Requests', 'status': 429}
+                else:
+                    statut, corps = 201, {'sid': f'SM{len(requetes):032d}', 'status': 'queued'}
+                contenu = json.dumps(corps).encode()
+                self.send_response(statut)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(contenu)))
+                self.end_headers()
+                self.wfile.write(contenu)
+
+        serveur = ThreadingHTTPServer(('127.0.0.1', 0), FausseApiTwilio)
+        threading.Thread(target=serveur.serve_forever, daemon=True).start()
+        self.addCleanup(serveur.shutdown)
+        self.addCleanup(setattr, WhatsAppNotificationService, '_twilio_client', None)
+        self.addCleanup(setattr, WhatsAppNotificationService, '_rate_limiter', None)
+        WhatsAppNotificationService._twilio_client = None
+        WhatsAppNotificationService._rate_limiter = None
+
+        attribution = Attribution.objects.create(
+            materiel=self.materiel, client=self.client_obj, departement=self.dept,
+            date_retour_prevue=date.today() + timedelta(days=2),
+        )
+        logs = [
+            NotificationLog.objects.create(
+                attribution=attribution, type_notification=NotificationLog.TYPE_RAPPEL_J_MOINS_1,
+                canal=NotificationLog.CANAL_WHATSAPP, duree_emprunt=attribution.duree_emprunt,
+                destinataire=f'+3361234567{i}', statut=NotificationLog.STATUT_EN_COURS,
+            )
+            for i in range(2)
+        ]
+
+        with override_settings(
+            TWILIO_ACCOUNT_SID='AC' + '0' * 32, TWILIO_AUTH_TOKEN='jeton',
+            TWILIO_WHATSAPP_FROM='whatsapp:+14155238886',
+            TWILIO_API_BASE_URL=f'http://127.0.0.1:{serveur.server_address[1]}',
+            WHATSAPP_RATE_LIMIT=100, WHATSAPP_429_BACKOFF=0.01,
+        ):
+            resultats = WhatsAppNotificationService.dispatch(logs, concurrency=1)
+
+        self.assertEqual(resultats, [True, True])
+        self.assertEqual(len(requetes), 3)
+        self.assertTrue(requetes[0].endswith(f"/Accounts/AC{'0' * 32}/Messages.json"))
+        self.assertEqual(
+            sorted(NotificationLog.objects.filter(pk__in=[l.pk for l in logs]).values_list('message_id', flat=True)),
+            [f'SM{2:032d}', f'SM{3:032d}'],
+        )
+
+    def test_relance_avec_backoff_puis_echec_definitif(self):
+        """Un échec est replanifié avec backoff, relancé une seule fois par lot, puis passe en ECHEC_PERM"""
+        from django.test import override_settings
+        from django.utils import timezone
+        from .models import NotificationLog
+        from .outbox_service import NotificationOutboxService
+        from .retry_service import NotificationRetryService
+
+        Attribution.objects.create(
+            materiel=self.materiel, client=self.client_obj, departement=self.dept,
+            date_retour_prevue=date.today() + timedelta(days=2),
+        )
+        log = NotificationLog.objects.get(type_notification=NotificationLog.TYPE_CREATION)
+
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1', EMAIL_PORT=9,
+            NOTIFICATION_RETRY_MAX_TENTATIVES=2, NOTIFICATION_RETRY_DELAI_BASE=60,
+        ):
+            avant = timezone.now()
+            resultat = NotificationOutboxService.traiter_lot(concurrence=1)
+            self.assertEqual((resultat['envoyees'], resultat['echecs'], resultat['definitifs']), (0, 1, 0))
+            log.refresh_from_db()
+            self.assertEqual((log.statut, log.nb_tentatives), (NotificationLog.STATUT_ECHEC, 1))
+            self.assertGreaterEqual(log.date_tentative_prochaine, avant + timedelta(seconds=30))
+            self.assertLessEqual(log.date_tentative_prochaine, timezone.now() + timedelta(seconds=60))
+
+            # Pas encore échue: rien à réserver
+            self.assertEqual(NotificationOutboxService.traiter_lot(concurrence=1)['reservees'], 0)
+
+            # Échue: un seul des deux workers la réserve
+            NotificationLog.objects.filter(pk=log.pk).update(date_tentative_prochaine=timezone.now())
+            self.assertEqual(NotificationRetryService.reserver(10, 'a' * 32), 1)
+            self.assertEqual(NotificationRetryService.reserver(10, 'b' * 32), 0)
+
+            NotificationLog.objects.filter(pk=log.pk).update(
+                statut=NotificationLog.STATUT_ECHEC, date_tentative_prochaine=timezone.now(), nb_tentatives=1,
+            )
+            resultat = NotificationOutboxService.traiter_lot(concurrence=1)
+            self.assertEqual((resultat['reservees'], resultat['definitifs']), (1, 1))
+            log.refresh_from_db()
+            self.assertEqual((log.statut, log.nb_tentatives), (NotificationLog.STATUT_ECHEC_PERMANENT, 2))
+            self.assertIsNone(log.date_tentative_prochaine)
+
+    def test_rappels_selectionnes_par_echeance(self):
+        """Les jobs de rappel ne lisent que les emprunts en cours dont l'échéance tombe dans leur fenêtre"""
+        from django.utils import timezone
+        from .models import NotificationLog
+        from .scheduler_jobs import check_court_terme_reminders, check_long_terme_reminders, check_overdue_materials
+
+        def emprunter(numero, retour):
+            materiel = Materiel.objects.create(
+                asset_id=f'ECH{numero}', numero_inventaire=f'INV-ECH-{numero}', nom='Micro', departement=self.dept,
+            )
+            return Attribution.objects.create(
+                materiel=materiel, client=self.client_obj, departement=self.dept,
+                date_retour_prevue=retour.date(), heure_retour_prevue=retour.time().replace(microsecond=0),
+            )
+
+        maintenant = timezone.localtime()
+        dans_1h = emprunter(1, maintenant + timedelta(hours=1))
+        dans_3h = emprunter(2, maintenant + timedelta(hours=3))
+        rendu = emprunter(3, maintenant + timedelta(hours=1))
+        rendu.date_retour_effective = maintenant.date()
+        rendu.save()
+        apres_demain = emprunter(4, maintenant + timedelta(days=2))
+        en_retard = Attribution.objects.create(
+            materiel=Materiel.objects.create(
+                asset_id='ECH5', numero_inventaire='INV-ECH-5', nom='Micro', departement=self.dept,
+            ),
+            client=self.client_obj, departement=self.dept, date_retour_prevue=date.today() - timedelta(days=3),
+        )
+        # Date de retour changée sans save(): l'échéance périmée ne correspond à aucun rappel
+        perime = emprunter(6, maintenant + timedelta(days=2, hours=1))
+        Attribution.objects.filter(pk=perime.pk).update(date_retour_prevue=date.today() + timedelta(days=10))
+        self.assertEqual(dans_1h.echeance, timezone.make_aware(
+            datetime.combine(dans_1h.date_retour_prevue, dans_1h.heure_retour_prevue)
+        ))
+        NotificationLog.objects.all().delete()
+
+        check_court_terme_reminders()
+        check_long_terme_reminders()
+        check_overdue_materials()
+        notifications = set(NotificationLog.objects.values_list('attribution_id', 'type_notification'))
+        self.assertEqual(notifications, {
+            (dans_1h.pk, NotificationLog.TYPE_RAPPEL_2H),
+            (apres_demain.pk, NotificationLog.TYPE_RAPPEL_J_MOINS_2),
+            (en_retard.pk, NotificationLog.TYPE_RETARD),
+        })
+        self.assertNotIn(dans_3h.pk, {a for a, _ in notifications})
+
+        # Un échec définitif compte comme traité: les balayages ne remettent rien en file
+        NotificationLog.objects.update(statut=NotificationLog.STATUT_ECHEC_PERMANENT)
+        NotificationLog.objects.filter(type_notification=NotificationLog.TYPE_RETARD).update(date_envoi=timezone.now())
+        check_court_terme_reminders()
+        check_long_terme_reminders()
+        check_overdue_materials()
+        self.assertEqual(NotificationLog.objects.count(), 3)
+
+    def test_plan_des_rappels(self):
+        """Le plan est écrit à la création, recalculé si l'échéance change, dépilé à l'heure et supprimé au retour"""
+        from django.utils import timezone
+        from .models import NotificationLog, NotificationPlanifiee
+        from .scheduler_jobs import process_due_notifications
+
+        attribution = Attribution.objects.create(
+            materiel=self.materiel, client=self.client_obj, departement=self.dept,
+            date_retour_prevue=date.today() + timedelta(days=5),
+        )
+        plan = dict(attribution.notifications_planifiees.values_list('type_notification', 'date_prevue'))
+        self.assertEqual(set(plan), {
+            NotificationLog.TYPE_RAPPEL_J_MOINS_2, NotificationLog.TYPE_RAPPEL_J_MOINS_1,
+            NotificationLog.TYPE_RAPPEL_FINAL, NotificationLog.TYPE_RETARD,
+        })
+        self.assertEqual(timezone.localtime(plan[NotificationLog.TYPE_RAPPEL_J_MOINS_1]).date(),
+                         date.today() + timedelta(days=4))
+
+        attribution.date_retour_prevue = date.today() + timedelta(days=6)
+        attribution.save()
+        j_moins_1 = attribution.notifications_planifiees.get(type_notification=NotificationLog.TYPE_RAPPEL_J_MOINS_1)
+        self.assertEqual(timezone.localtime(j_moins_1.date_prevue).date(), date.today() + timedelta(days=5))
+
+        # Rien d'échu: une seule requête
+        with self.assertNumQueries(1):
+            process_due_notifications()
+
+        NotificationPlanifiee.objects.filter(pk=j_moins_1.pk).update(date_prevue=timezone.now())
+        process_due_notifications()
+        self.assertTrue(NotificationLog.objects.filter(
+            attribution=attribution, type_notification=NotificationLog.TYPE_RAPPEL_J_MOINS_1,
+            statut=NotificationLog.STATUT_EN_ATTENTE,
+        ).exists())
+        self.assertFalse(NotificationPlanifiee.objects.filter(pk=j_moins_1.pk).exists())
+
+        # Chargée sans l'état du plan: pas de récursion, le retour est détecté sur la ligne relue
+        partielle = Attribution.objects.defer('echeance', 'date_retour_effective').get(pk=attribution.pk)
+        self.assertIsNone(partielle.date_retour_effective)
+        partielle = Attribution.objects.defer('echeance', 'date_retour_effective').get(pk=attribution.pk)
+        partielle.date_retour_effective = date.today()
+        partielle.save()
+        self.assertFalse(attribution.notifications_planifiees.exists())
+        self.assertTrue(NotificationLog.objects.filter(
+            attribution=attribution, type_notification=NotificationLog.TYPE_RESTITUTION,
+        ).exists())
+        attribution = Attribution.objects.get(pk=attribution.pk)
+
+        # Retour écrit sans save(): le plan resté en place est supprimé à l'échéance, sans relance
+        attribution.date_retour_effective = None
+        attribution.save()
+        Attribution.objects.filter(pk=attribution.pk).update(date_retour_effective=date.today())
+        attribution.notifications_planifiees.update(date_prevue=timezone.now())
+        NotificationLog.objects.all().delete()
+        process_due_notifications()
+        self.assertFalse(attribution.notifications_planifiees.exists())
+        self.assertFalse(NotificationLog.objects.exists())
+
+    def test_balayage_nombre_de_requetes_constant(self):
+        """Le balayage de secours exclut en SQL les emprunts déjà notifiés: requêtes constantes quel que soit leur nombre"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .scheduler_jobs import reminder_safety_sweep
+
+        def emprunter(n):
+            for i in range(n):
+                numero = Materiel.objects.count()
+                materiel = Materiel.objects.create(
+                    asset_id=f'BAL{numero}', numero_inventaire=f'INV-BAL-{numero}', nom='Micro', departement=self.dept,
+                )
+                Attribution.objects.create(
+                    materiel=materiel, client=self.client_obj, departement=self.dept,
+                    date_retour_prevue=date.today() + timedelta(days=2 if i % 2 else -2),
+                )
+
+        def requetes():
+            with CaptureQueriesContext(connection) as contexte:
+                reminder_safety_sweep()
+            return len(contexte.captured_queries)
+
+        from .models import NotificationLog
+
+        emprunter(2)
+        reminder_safety_sweep()  # notifie tous les emprunts une première fois
+        self.assertEqual(
+            set(NotificationLog.objects.exclude(type_notification=NotificationLog.TYPE_CREATION)
+                .values_list('type_notification', flat=True)),
+            {NotificationLog.TYPE_RETARD, NotificationLog.TYPE_RAPPEL_J_MOINS_2},
+        )
+        deja_notifies = requetes()
+        emprunter(8)
+        reminder_safety_sweep()
+        self.assertEqual(requetes(), deja_notifies)
+
+    def test_digest_par_destinataire(self):
+        """Les notifications d'un même client, canal et type partent en un seul email listant chaque matériel"""
+        from django.core import mail
+        from django.test import override_settings
+        from .models import NotificationLog
+        from .outbox_service import NotificationOutboxService
+
+        for i in range(3):
+            materiel = Materiel.objects.create(
+                asset_id=f'DIG{i}', numero_inventaire=f'INV-DIG-{i}', nom=f'Projecteur {i}', departement=self.dept,
+            )
+            Attribution.objects.create(
+                materiel=materiel, client=self.client_obj, departement=self.dept,
+                date_retour_prevue=date.today() + timedelta(days=3),
+            )
+
+        # Pendant la fenêtre de regroupement, rien ne part
+        with override_settings(NOTIFICATION_DIGEST_FENETRE=300):
+            self.assertEqual(NotificationOutboxService.traiter_lot(concurrence=1)['reservees'], 0)
+
+        resultat = NotificationOutboxService.traiter_lot(concurrence=1)
+        self.assertEqual((resultat['reservees'], resultat['messages'], resultat['envoyees']), (3, 1, 3))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('3 matériels', mail.outbox[0].subject)
+        for i in range(3):
+            self.assertIn(f'Projecteur {i}', mail.outbox[0].body)
+        logs = NotificationLog.objects.filter(type_notification=NotificationLog.TYPE_CREATION)
+        self.assertEqual(logs.count(), 3)
+        self.assertEqual(set(logs.values_list('statut', flat=True)), {NotificationLog.STATUT_ENVOYEE})
+        self.assertEqual(len(set(logs.values_list('digest', flat=True))), 1)
+        self.assertIsNotNone(logs.first().digest)
+        self.assertEqual(len(set(logs.values_list('date_envoi', flat=True))), 1)
+
+    def test_digest_lot_borne(self):
+        """Les notifications qui rejoignent un digest comptent dans la taille du lot"""
+        from django.test import override_settings
+        from django.utils import timezone
+        from .models import NotificationLog
+        from .outbox_service import NotificationOutboxService
+
+        attribution = Attribution.objects.create(
+            materiel=self.materiel, client=self.client_obj, departement=self.dept,
+            date_retour_prevue=date.today() + timedelta(days=3),
+        )
+        NotificationLog.objects.all().delete()
+        NotificationLog.objects.bulk_create([
+            NotificationLog(
+                attribution=attribution, type_notification=NotificationLog.TYPE_CREATION,
+                canal=NotificationLog.CANAL_EMAIL, destinataire='client@example.com',
+                statut=NotificationLog.STATUT_EN_ATTENTE,
+            )
+            for _ in range(12)
+        ])
+        # Seule la plus ancienne a passé la fenêtre: les autres ne partent qu'en rejoignant son digest
+        ancienne = NotificationLog.objects.order_by('id').first()
+        NotificationLog.objects.filter(pk=ancienne.pk).update(date_envoi=timezone.now() - timedelta(minutes=10))
+
+        with override_settings(NOTIFICATION_DIGEST_FENETRE=300):
+            lot = NotificationOutboxService.reserver_lot(taille=5)
+        self.assertEqual(len(lot), 5)
+        self.assertEqual(lot[0].pk, ancienne.pk)
+        self.assertEqual(NotificationLog.objects.filter(statut=NotificationLog.STATUT_EN_ATTENTE).count(), 7)
+
+    def test_preferences_resolues_sans_ecriture(self):
+        """Les préférences par défaut ne créent aucune ligne; le cache est invalidé à l'enregistrement"""
+        from .models import NotificationLog, NotificationPreferences
+        from .preferences_service import PreferencesService
+        from .scheduler_jobs import _send_reminder_notification
+
+        attribution = Attribution.objects.create(
+            materiel=self.materiel, client=self.client_obj, departement=self.dept,
+            date_retour_prevue=date.today() + timedelta(days=3),
+        )
+        attribution.notes = 'Modification sans rapport'
+        attribution.save()
+        self.assertFalse(NotificationPreferences.objects.exists())
+        self.assertTrue(PreferencesService.pour_client(self.client_obj).notifications_email)
+
+        # Lots: une seule requête pour les clients absents du cache, aucune ensuite
+        autre = Client.objects.create(nom='Autre client', departement=self.dept)
+        with self.assertNumQueries(1):
+            PreferencesService.pour_clients([self.client_obj.pk, autre.pk])
+        with self.assertNumQueries(0):
+            PreferencesService.pour_clients([self.client_obj.pk, autre.pk])
+
+        NotificationPreferences.objects.create(client=self.client_obj, notifications_email=False)
+        self.assertFalse(PreferencesService.pour_client(self.client_obj).notifications_email)
+        NotificationLog.objects.all().delete()
+        _send_reminder_notification(attribution, NotificationLog.TYPE_RAPPEL_J_MOINS_2)
+        self.assertFalse(NotificationLog.objects.exists())
+
+
+def _rendu_export_lent(pk):
+    """Rendu factice pour le pool de l'export (module importable par ses processus)"""
+    import os
+    import time
+    time.sleep(0.1)
+    return pk, None, f'pid {os.getpid()}'
+
+
+class AuditSignalTest(TestCase):
+    """Tests du journal d'audit alimenté par les signaux"""
+
+    def test_modification_diff_sans_relecture(self):
+        """La modification est comparée aux valeurs chargées, sans relire la ligne"""
+        from django.contrib.contenttypes.models import ContentType
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import AuditLog
+
+        ContentType.objects.get_for_model(Departement)
+        with self.captureOnCommitCallbacks(execute=True):
+            Departement.objects.create(code='AUD', nom='Audit')
+        dept = Departement.objects.get(code='AUD')
+        dept.nom = 'Audit modifié'
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as requetes:
+                dept.save()
+        self.assertFalse([q for q in requetes.captured_queries if q['sql'].startswith('SELECT')])
+
+        log = AuditLog.objects.filter(action=AuditLog.ACTION_UPDATE, object_id=str(dept.pk)).get()
+        self.assertEqual(log.changes, {'nom': ['Audit', 'Audit modifié']})
+
+        # Les valeurs enregistrées servent de référence à la sauvegarde suivante
+        dept.description = 'Nouvelle description'
+        with self.captureOnCommitCallbacks(execute=True):
+            dept.save(update_fields=['description'])
+        dernier = AuditLog.objects.filter(action=AuditLog.ACTION_UPDATE).order_by('-id').first()
+        self.assertEqual(list(dernier.changes), ['description'])
+
+    def test_ecriture_groupee_a_la_validation(self):
+        """Les entrées d'une unité de travail partent en un INSERT après validation, rien en cas de rollback"""
+        from unittest import mock
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        from .models import AuditLog, NotificationLog
+        from .signals_audit import audit_buffer
+
+        with CaptureQueriesContext(connection) as requetes:
+            with audit_buffer(), self.captureOnCommitCallbacks(execute=True):
+                dept = Departement.objects.create(code='BUF', nom='Buffer')
+                categorie = Categorie.objects.create(nom='Cat buffer', departement=dept)
+                categorie.nom = 'Cat buffer modifiée'
+                categorie.save()
+                try:
+                    with transaction.atomic():
+                        Categorie.objects.create(nom='Annulée', departement=dept)
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+                # Modèle exclu du journal par AUDIT_EXCLUDED_MODELS
+                NotificationLog.objects.create(
+                    type_notification=NotificationLog.TYPE_CREATION, canal=NotificationLog.CANAL_EMAIL,
+                    destinataire='a@example.com',
+                )
+                self.assertFalse(AuditLog.objects.exists())
+        inserts = [q for q in requetes.captured_queries if 'INSERT INTO "assets_auditlog"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(
+            list(AuditLog.objects.order_by('timestamp', 'id').values_list('object_repr', 'action')),
+            [('BUF - Buffer', AuditLog.ACTION_CREATE), ('Cat buffer (BUF)', AuditLog.ACTION_CREATE),
+             ('Cat buffer modifiée (BUF)', AuditLog.ACTION_UPDATE)],
+        )
+
+        # Un échec d'écriture du journal ne masque pas l'exception de l'unité de travail
+        with mock.patch.object(AuditLog.objects, 'bulk_create', side_effect=RuntimeError('audit')):
+            with self.assertRaisesMessage(ValueError, 'vue'):
+                with audit_buffer():
+                    Departement.objects.create(code='ERR', nom='Erreur')
+                    raise ValueError('vue')
+
+    def test_archivage_lu_par_les_rapports(self):
+        """Les lignes archivées quittent la table et restent consultables depuis les rapports"""
+        import tempfile
+        from django.contrib.contenttypes.models import ContentType
+        from django.test import override_settings
+        from django.utils import timezone
+        from .archive_audit_service import ArchivageAuditService
+        from .models import AuditLog, SegmentAudit
+
+        user = User.objects.create_user(username='auditeur', password='testpass123')
+        ct = ContentType.objects.get_for_model(Departement)
+        ancienne = AuditLog.objects.create(
+            user=user, action=AuditLog.ACTION_UPDATE, content_type=ct, object_id='1',
+            object_repr='ANC - Ancien', changes={'nom': ['Avant', 'Après']},
+            timestamp=timezone.now() - timedelta(days=400),
+        )
+        recente = AuditLog.objects.create(action=AuditLog.ACTION_CREATE, content_type=ct, object_repr='Récent')
+
+        with tempfile.TemporaryDirectory() as repertoire, override_settings(AUDIT_ARCHIVE_DIR=repertoire):
+            self.assertEqual(ArchivageAuditService.archiver(), (1, 1))
+            self.assertEqual(list(AuditLog.objects.values_list('pk', flat=True)), [recente.pk])
+            segment = SegmentAudit.objects.get()
+            self.assertEqual((segment.premier_id, segment.dernier_id, segment.content_type), (ancienne.pk, ancienne.pk, ct))
+
+            self.client.login(username='auditeur', password='testpass123')
+            response = self.client.get(reverse('assets:report_detail', args=[ancienne.pk]))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['report'].changes, {'nom': ['Avant', 'Après']})
+            self.assertEqual(response.context['report'].user, user)
+
+            # La liste ne lit les segments que sur demande
+            response = self.client.get(reverse('assets:report_list'))
+            self.assertEqual([r.pk for r in response.context['reports']], [recente.pk])
+            self.assertEqual(response.context['lien_archives'], 'archives=1')
+            response = self.client.get(reverse('assets:report_list'), {'user': 'audit', 'archives': '1'})
+            self.assertEqual([r.pk for r in response.context['reports']], [ancienne.pk])
+            response = self.client.get(reverse('assets:report_list'), {'archives': '1'})
+            self.assertEqual([r.pk for r in response.context['reports']], [recente.pk, ancienne.pk])
+            self.assertIsNone(response.context['lien_archives'])
+
+    def test_pagination_par_curseur_et_historique(self):
+        """Pages successives sans recouvrement, et historique d'un objet sur son index"""
+        from django.contrib.contenttypes.models import ContentType
+        from django.utils import timezone
+        from .models import AuditLog
+
+        User.objects.create_user(username='auditeur', password='testpass123')
+        ct = ContentType.objects.get_for_model(Departement)
+        maintenant = timezone.now()
+        AuditLog.objects.bulk_create([
+            AuditLog(
+                action=AuditLog.ACTION_UPDATE, content_type=ct, object_id=str(i % 3),
+                object_repr=f'Objet {i % 3}', changes={'nom': [str(i), str(i + 1)]},
+                # Horodatages en partie identiques: l'id départage
+                timestamp=maintenant - timedelta(minutes=i // 2),
+            )
+            for i in range(205)
+        ])
+        self.client.login(username='auditeur', password='testpass123')
+
+        premiere = self.client.get(reverse('assets:report_list'))
+        self.assertEqual(len(premiere.context['reports']), 200)
+        self.assertIsNotNone(premiere.context['page_suivante'])
+        seconde = self.client.get(reverse('assets:report_list') + '?' + premiere.context['page_suivante'])
+        self.assertEqual(len(seconde.context['reports']), 5)
+        self.assertIsNone(seconde.context['page_suivante'])
+        vus = [r.pk for r in premiere.context['reports'] + seconde.context['reports']]
+        self.assertEqual(sorted(vus), sorted(AuditLog.objects.values_list('pk', flat=True)))
+
+        historique = self.client.get(reverse('assets:report_object_history', args=[ct.pk, '1']))
+        self.assertEqual(historique.status_code, 200)
+        self.assertEqual(len(historique.context['reports']), 68)
+        self.assertEqual({r.object_id for r in historique.context['reports']}, {'1'})
+
+    def test_rendu_rapport_requetes_groupees(self):
+        """Les relations d'un rapport sont résolues par modèle et l'attribution chargée une fois"""
+        from django.contrib.contenttypes.models import ContentType
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import AuditLog
+        from .views import _report_context
+
+        dept = Departement.objects.create(code='RDU', nom='Rendu')
+        client_obj = Client.objects.create(nom='Client Rendu', departement=dept)
+        materiels = [
+            Materiel.objects.create(asset_id=f'RDU00{i}', numero_inventaire=f'INV-RDU-{i}', nom=f'Poste {i}', departement=dept)
+            for i in range(2)
+        ]
+        attribution = Attribution.objects.create(
+            materiel=materiels[1], client=client_obj, departement=dept,
+            date_retour_prevue=date.today() + timedelta(days=3),
+        )
+        report = AuditLog.objects.create(
+            action=AuditLog.ACTION_UPDATE,
+            content_type=ContentType.objects.get_for_model(Attribution),
+            object_id=str(attribution.pk),
+            changes={
+                'materiel': [materiels[0].pk, materiels[1].pk],
+                'client': [None, client_obj.pk],
+                'departement': [str(dept.pk), str(dept.pk)],
+                'notes': ['', 'Prêt'],
+            },
+        )
+
+        with CaptureQueriesContext(connection) as requetes:
+            context = _report_context(AuditLog.objects.select_related('user', 'content_type').get(pk=report.pk))
+        tables = [q['sql'].split('FROM', 1)[1].split()[0] for q in requetes.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(tables.count('"assets_attribution"'), 1)
+        self.assertEqual(tables.count('"assets_materiel"'), 1)
+        self.assertLessEqual(len(requetes.captured_queries), 6)
+
+        changements = {c['field_name']: (c['old'], c['new']) for c in context['formatted_changes']}
+        self.assertEqual(changements['materiel'], (str(materiels[0]), str(materiels[1])))
+        self.assertEqual(changements['client'], (None, str(client_obj)))
+        self.assertIn('RDU001', context['context_sentence'])
+
+    def test_pdf_rapport_mis_en_cache(self):
+        """Le PDF est rendu une fois puis servi depuis le disque; la pré-génération couvre les nouveaux rapports"""
+        import os
+        import tempfile
+        from unittest import mock
+        from django.contrib.contenttypes.models import ContentType
+        from django.test import override_settings
+        from django.utils import timezone
+        from .models import AuditLog
+        from .rapport_pdf_service import RapportPdfService
+
+        User.objects.create_user(username='auditeur', password='testpass123')
+        ct = ContentType.objects.get_for_model(Departement)
+        report = AuditLog.objects.create(action=AuditLog.ACTION_CREATE, content_type=ct, object_id='1', object_repr='PDF')
+        rendus = []
+
+        def moteur(html, base_url):
+            rendus.append(html)
+            return b'%PDF-1.4 test'
+
+        with tempfile.TemporaryDirectory() as repertoire, override_settings(REPORT_PDF_CACHE_DIR=repertoire), \
+                mock.patch.object(RapportPdfService, '_moteurs', [('test', moteur)]):
+            self.client.login(username='auditeur', password='testpass123')
+            for _ in range(2):
+                response = self.client.get(reverse('assets:report_pdf', args=[report.pk]))
+                self.assertEqual(response['Content-Type'], 'application/pdf')
+                self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4 test')
+            self.assertEqual(len(rendus), 1)
+            self.assertTrue(os.path.exists(RapportPdfService.chemin(report.pk)))
+
+            nouveau = AuditLog.objects.create(action=AuditLog.ACTION_UPDATE, content_type=ct, object_id='1', object_repr='PDF')
+            self.assertEqual(RapportPdfService.pregenerer(timezone.now() - timedelta(minutes=15)), 1)
+            self.assertTrue(os.path.exists(RapportPdfService.chemin(nouveau.pk)))
+            self.assertEqual(len(rendus), 2)
+
+        # L'empreinte couvre les gabarits inclus par le parent et la version du rendu
+        self.assertIn('includes/sidebar_actions.html', RapportPdfService.gabarits())
+        with override_settings(DEBUG=True), mock.patch.object(RapportPdfService, '_empreinte', None):
+            chemin = RapportPdfService.chemin(report.pk)
+            with mock.patch.object(RapportPdfService, 'VERSION_RENDU', RapportPdfService.VERSION_RENDU + 1):
+                self.assertNotEqual(RapportPdfService.chemin(report.pk), chemin)
+
+    def test_export_zip_des_rapports(self):
+        """L'export est écrit par le scheduler (un PDF par rapport et l'index CSV), suivi puis téléchargé"""
+        import csv
+        import io
+        import os
+        import tempfile
+        import zipfile
+        from unittest import mock
+        from django.contrib.contenttypes.models import ContentType
+        from django.test import override_settings
+        from django.utils import timezone
+        from .export_audit_service import ExportAuditService
+        from .models import AuditLog, ExportAudit
+        from .rapport_pdf_service import RapportPdfService
+
+        User.objects.create_user(username='conformite', password='testpass123', is_staff=True)
+        ct = ContentType.objects.get_for_model(Departement)
+        rapports = [
+            AuditLog.objects.create(action=AuditLog.ACTION_UPDATE, content_type=ct, object_id=str(i), object_repr=f'Objet {i}')
+            for i in range(3)
+        ]
+        AuditLog.objects.create(
+            action=AuditLog.ACTION_UPDATE, content_type=ct, object_id='9', timestamp=datetime(2020, 1, 1, tzinfo=rapports[0].timestamp.tzinfo),
+        )
+        jour = rapports[0].timestamp.date()
+
+        with tempfile.TemporaryDirectory() as repertoire, \
+                override_settings(REPORT_PDF_CACHE_DIR=repertoire, AUDIT_EXPORT_DIR=repertoire, AUDIT_EXPORT_PROCESSUS=0), \
+                mock.patch.object(RapportPdfService, '_moteurs', [('test', lambda html, base_url: b'%PDF-1.4 test')]):
+            self.client.login(username='conformite', password='testpass123')
+            response = self.client.get(reverse('assets:report_export'), {
+                'debut': jour.isoformat(), 'fin': (jour + timedelta(days=1)).isoformat(), 'action': AuditLog.ACTION_UPDATE,
+            })
+            self.assertEqual(response.status_code, 202)
+            demande = response.json()
+            self.assertEqual(self.client.get(demande['progression']).json()['statut'], ExportAudit.STATUT_EN_ATTENTE)
+            self.assertEqual(self.client.get(demande['telechargement']).status_code, 404)
+
+            self.assertEqual(ExportAuditService.traiter_demandes(), 1)
+            self.assertEqual(ExportAuditService.traiter_demandes(), 0)
+            self.assertEqual(self.client.get(demande['progression']).json(), {
+                'statut': ExportAudit.STATUT_TERMINE, 'faits': 3, 'total': 3, 'termine': True, 'erreur': '',
+            })
+            response = self.client.get(demande['telechargement'])
+            self.assertEqual(response['Content-Type'], 'application/zip')
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+            response.close()
+
+            # Les archives passées la durée de conservation sont supprimées avec leur demande
+            ExportAudit.objects.update(date_maj=timezone.now() - timedelta(days=8))
+            chemin = ExportAuditService.chemin(ExportAudit.objects.get())
+            self.assertEqual(ExportAuditService.purger(), 1)
+            self.assertFalse(os.path.exists(chemin))
+
+        self.assertEqual(
+            sorted(archive.namelist()),
+            sorted(['index.csv'] + [f'rapports/rapport_{r.pk}.pdf' for r in rapports]),
+        )
+        self.assertEqual(archive.read(f'rapports/rapport_{rapports[0].pk}.pdf'), b'%PDF-1.4 test')
+        index = list(csv.DictReader(io.StringIO(archive.read('index.csv').decode('utf-8-sig'))))
+        self.assertEqual([int(ligne['id']) for ligne in index], [r.pk for r in rapports])
+
+    def test_export_pool_de_processus(self):
+        """Le pool rend dans l'ordre hors du processus, et un export interrompu n'attend pas ses rapports restants"""
+        import os
+        import time
+        from .export_audit_service import ExportAuditService
+
+        resultats = ExportAuditService._resultats(list(range(40)), 1, rendu=_rendu_export_lent)
+        premiers = [next(resultats) for _ in range(3)]
+        self.assertEqual([pk for pk, _, _ in premiers], [0, 1, 2])
+        self.assertNotIn(f'pid {os.getpid()}', {erreur for _, _, erreur in premiers})
+        debut = time.monotonic()
+        resultats.close()
+        self.assertLess(time.monotonic() - debut, 1)
+
+        # Le même pool sert l'export suivant
+        resultats = list(ExportAuditService._resultats(range(5), 1, rendu=_rendu_export_lent))
+        self.assertEqual([pk for pk, _, _ in resultats], list(range(5)))
+        self.assertEqual(len(ExportAuditService._pools), 1)
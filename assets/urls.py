@@ -7,6 +7,7 @@ app_name = 'assets'
 urlpatterns = [
     # Dashboard
     path('', views.dashboard, name='dashboard'),
+    path('dashboard/snapshot.json', views.dashboard_snapshot, name='dashboard_snapshot'),
 
     # Materiel CRUD
     path('materiel/', views.materiel_list, name='materiel_list'),
@@ -53,4 +54,8 @@ urlpatterns = [
     path('rapports/', views.report_list, name='report_list'),
     path('rapports/<int:pk>/', views.report_detail, name='report_detail'),
     path('rapports/<int:pk>/pdf/', views.report_pdf, name='report_pdf'),
+    path('rapports/export/', views.report_export, name='report_export'),
+    path('rapports/export/<str:export_id>/progression/', views.report_export_progress, name='report_export_progress'),
+    path('rapports/export/<str:export_id>/archive/', views.report_export_download, name='report_export_download'),
+    path('rapports/objet/<int:content_type_id>/<str:object_id>/', views.report_object_history, name='report_object_history'),
 ]
\ No newline at end of file
@@ -1,11 +1,16 @@
 # assets/views.py
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Q, Max
-from django.http import JsonResponse, HttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
+from django.db.models import Count, Q, Max, F, Sum
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse, Http404, FileResponse
+from django.urls import reverse
+from django.core.paginator import Paginator
 from django.core.exceptions import PermissionDenied
 from .forms import MaterielForm, ClientForm, AttributionForm
-from .models import Materiel, Departement, Categorie, Attribution, Client, Alerte, Salle
+from .models import Materiel, Departement, Categorie, Attribution, Client, Alerte, Salle, NiveauStock
 from .models import AuditLog
 from .forms import CheckInForm
 from django.utils import timezone
@@ -13,6 +18,10 @@ from django.contrib import messages
 from .models import HistoriqueAttribution
 from users.permissions import role_required, can_view_department, can_manage_department, can_perform_checkout
 from .services import AlerteService
+from .dashboard_service import DashboardService
+from .archive_audit_service import ArchivageAuditService
+from .rapport_pdf_service import RapportPdfService
+from .export_audit_service import ExportAuditService
 
 from django.utils.text import capfirst
 from django.utils.formats import date_format
@@ -30,41 +39,92 @@ def _human_label_for_field(model_class, field_name):
         return field_name.replace('_', ' ').capitalize()
 
 
-def _resolve_relation_value(model_class, field_name, val):
-    """If the field is a FK, try to fetch the related object's display value.
+class _ReportRendering:
+    """Objects referenced by one audit report, loaded once for all the display helpers.
 
-    val may already be stringified; we try int conversion where appropriate.
+    Foreign keys found in the changes (old and new values) are resolved with one
+    ``in_bulk`` per related model, and the Attribution an attribution (or attribution
+    history) report is about is loaded once, with its relations, for the three
+    sentence builders.
     """
-    if val is None:
-        return None
-    if not model_class:
-        return val
-    try:
-        field = model_class._meta.get_field(field_name)
-    except Exception:
-        return val
 
-    # If it's a relation, attempt to load related instance
-    related_model = None
-    try:
-        related_model = getattr(field, 'related_model', None) or getattr(field.remote_field, 'model', None)
-    except Exception:
-        related_model = None
+    _NOT_LOADED = object()
 
-    if related_model:
-        # val may be numeric id or string id; try to coerce to int
+    def __init__(self, report):
+        self.report = report
         try:
-            pk = int(val)
+            self.model = report.content_type.model_class()
         except Exception:
-            pk = val
+            self.model = None
+        self._attribution = self._NOT_LOADED
+        self.related = self._load_related()
+
+    def _related_model(self, field_name):
+        if not self.model:
+            return None
         try:
-            obj = related_model.objects.filter(pk=pk).first()
-            if obj:
-                return str(obj)
+            field = self.model._meta.get_field(field_name)
         except Exception:
-            return val
+            return None
+        try:
+            return getattr(field, 'related_model', None) or getattr(field.remote_field, 'model', None)
+        except Exception:
+            return None
 
-    return val
+    @staticmethod
+    def _pk(related_model, val):
+        """val may be a numeric or string id; coerce it to the related model's pk type"""
+        try:
+            return related_model._meta.pk.to_python(val)
+        except Exception:
+            return None
+
+    def _load_related(self):
+        changes = self.report.changes or {}
+        if not isinstance(changes, dict) or 'snapshot' in changes:
+            return {}
+        pks = {}
+        for field, pair in changes.items():
+            related_model = self._related_model(field)
+            if not related_model or _is_technical_field(field):
+                continue
+            values = pair if isinstance(pair, (list, tuple)) else [pair]
+            for val in values:
+                pk = self._pk(related_model, val) if val is not None else None
+                if pk is not None:
+                    pks.setdefault(related_model, set()).add(pk)
+        related = {}
+        for related_model, ids in pks.items():
+            try:
+                related[related_model] = related_model._base_manager.in_bulk(ids)
+            except Exception:
+                related[related_model] = {}
+        return related
+
+    def resolve(self, field_name, val):
+        """Display value of a change value: the related object's label for a foreign key"""
+        if val is None:
+            return None
+        related_model = self._related_model(field_name)
+        if not related_model:
+            return val
+        obj = self.related.get(related_model, {}).get(self._pk(related_model, val))
+        return str(obj) if obj is not None else val
+
+    @property
+    def attribution(self):
+        """The live Attribution of an attribution or attribution history report, or None"""
+        if self._attribution is self._NOT_LOADED:
+            self._attribution = None
+            if self.model and self.model.__name__.lower() in ('attribution', 'historiqueattribution'):
+                from .models import Attribution
+                try:
+                    self._attribution = Attribution.objects.select_related(
+                        'materiel', 'client', 'employe_responsable', 'client__salle'
+                    ).filter(pk=self.report.object_id).first()
+                except Exception:
+                    self._attribution = None
+        return self._attribution
 
 
 def _is_technical_field(field_name):
@@ -138,17 +198,14 @@ def _sanitize_change_value(val):
     return s
 
 
-def _format_changes_for_display(report):
+def _format_changes_for_display(report, rendering=None):
     """Convert report.changes JSON into a list of human-readable change rows.
 
     Returns list of dicts: {'field': ..., 'old': ..., 'new': ...}
     """
+    rendering = rendering or _ReportRendering(report)
     changes = report.changes or {}
-    ct_model = None
-    try:
-        ct_model = report.content_type.model_class()
-    except Exception:
-        ct_model = None
+    ct_model = rendering.model
 
     rows = []
     # special-case snapshot (delete)
@@ -174,15 +231,15 @@ def _format_changes_for_display(report):
 
             # For technical fields, produce explicit, user-friendly label
             if _is_technical_field(field):
-                old_h = _sanitize_change_value(old_h)
-                new_h = _sanitize_change_value(new_h)
+                old_h = _sanitize_change_value(old_val)
+                new_h = _sanitize_change_value(new_val)
                 explicit = f"[Méta] champ technique: {label} — {new_h}"
                 rows.append({'field': label, 'old': old_h, 'new': explicit, 'field_name': field})
                 continue
 
             # Try to resolve relations to readable strings
-            old_h = _resolve_relation_value(ct_model, field, old_val)
-            new_h = _resolve_relation_value(ct_model, field, new_val)
+            old_h = rendering.resolve(field, old_val)
+            new_h = rendering.resolve(field, new_val)
 
             # Sanitize values that look like paths/urls or are excessively long
             old_h = _sanitize_change_value(old_h)
@@ -223,30 +280,21 @@ def _sanitize_metadata(metadata):
     return out
 
 
-def _build_human_readable_sentence(report, formatted_changes=None):
+def _build_human_readable_sentence(report, formatted_changes=None, rendering=None):
     """Build a clear, human-readable French sentence for important audit events.
 
     Currently specialises for Attribution events (create/update/delete).
     Falls back to the existing short `summary` when it cannot build a detailed sentence.
     """
-    try:
-        ct_model = report.content_type.model_class()
-    except Exception:
-        ct_model = None
+    rendering = rendering or _ReportRendering(report)
+    ct_model = rendering.model
 
     user_label = report.user.username if report.user else 'Système'
 
     # Special handling for Attribution model
     if ct_model and ct_model.__name__ == 'Attribution':
-        # Try to load the Attribution instance if still present
-        from .models import Attribution
-        attribution = None
-        try:
-            attribution = Attribution.objects.select_related(
-                'materiel', 'client', 'employe_responsable', 'client__salle'
-            ).filter(pk=report.object_id).first()
-        except Exception:
-            attribution = None
+        # The Attribution instance if still present
+        attribution = rendering.attribution
 
         # Helper to format date/time nicely
         def _fmt_dt(dt):
@@ -311,17 +359,15 @@ def _build_human_readable_sentence(report, formatted_changes=None):
     return None
 
 
-def _build_context_sentence(report):
+def _build_context_sentence(report, rendering=None):
     """Build a short, creative French context sentence for the report header.
 
     Examples:
       "Création — Attribution de matériel (OKP-000001) attribuée à M. Dupont par admin depuis 127.0.0.1"
       "Modification — Matériel: PC portable OKP-000123 (changement de statut) — par admin"
     """
-    try:
-        ct_model = report.content_type.model_class()
-    except Exception:
-        ct_model = None
+    rendering = rendering or _ReportRendering(report)
+    ct_model = rendering.model
 
     # action verb mapping
     action_map = {
@@ -356,10 +402,9 @@ def _build_context_sentence(report):
     # For Attribution, try to extract the asset id and client from the object_repr or load the object
     object_desc = obj_label
     if ct_model and ct_model.__name__ == 'Attribution':
-        # Try to load the Attribution instance when possible
+        # Use the Attribution instance when possible
         try:
-            from .models import Attribution
-            attribution = Attribution.objects.filter(pk=report.object_id).select_related('materiel', 'client').first()
+            attribution = rendering.attribution
             if attribution:
                 mat = getattr(attribution.materiel, 'asset_id', '') or str(attribution.materiel or '')
                 client = getattr(attribution.client, 'nom', '') or str(attribution.client or '')
@@ -392,8 +437,7 @@ def _build_context_sentence(report):
     client_label = ''
     if ct_model and ct_model.__name__.lower() in ('attribution', 'historiqueattribution'):
         try:
-            from .models import Attribution
-            at = Attribution.objects.filter(pk=report.object_id).select_related('materiel', 'client').first()
+            at = rendering.attribution
             if at:
                 asset_id = getattr(at.materiel, 'asset_id', '') or getattr(at.materiel, 'nom', '') or ''
                 client_label = getattr(at.client, 'nom', '') or ''
@@ -439,17 +483,15 @@ def _build_context_sentence(report):
     return ' — '.join(pieces)
 
 
-def _build_creative_summary(report):
+def _build_creative_summary(report, rendering=None):
     """Return a compact, creative French summary for the report header.
 
     Examples:
       "admin a créé une Attribution de matériel — OKP-000001 → M. Dupont"
       "admin a modifié Matériel — PC portable OKP-000123 (statut: DISPONIBLE)"
     """
-    try:
-        ct_model = report.content_type.model_class()
-    except Exception:
-        ct_model = None
+    rendering = rendering or _ReportRendering(report)
+    ct_model = rendering.model
 
     # nice model name mapping
     model_map = {
@@ -483,8 +525,7 @@ def _build_creative_summary(report):
     # For attribution try to extract asset and client names
     if ct_model and ct_model.__name__ == 'Attribution':
         try:
-            from .models import Attribution
-            attr = Attribution.objects.filter(pk=report.object_id).select_related('materiel', 'client').first()
+            attr = rendering.attribution
             if attr:
                 mat = getattr(attr.materiel, 'asset_id', None) or getattr(attr.materiel, 'nom', '')
                 client = getattr(attr.client, 'nom', '')
@@ -511,8 +552,7 @@ def _build_creative_summary(report):
     client_label = ''
     if ct_model and ct_model.__name__.lower() in ('attribution', 'historiqueattribution'):
         try:
-            from .models import Attribution
-            at = Attribution.objects.filter(pk=report.object_id).select_related('materiel', 'client').first()
+            at = rendering.attribution
             if at:
                 asset_id = getattr(at.materiel, 'asset_id', '') or getattr(at.materiel, 'nom', '') or ''
                 client_label = getattr(at.client, 'nom', '') or ''
@@ -795,13 +835,9 @@ def dashboard(request):
     
     # Super Admin: voir tous les données
     if profil and profil.role == 'SUPER_ADMIN':
-        total_materiel = Materiel.objects.count()
-        materiel_disponible = Materiel.objects.filter(statut_disponibilite='DISPONIBLE').count()
-        materiel_attribue = Materiel.objects.filter(statut_disponibilite='ATTRIBUE').count()
-        materiel_defectueux = Materiel.objects.filter(etat_technique='DEFECTUEUX').count()
+        snapshot = DashboardService.get_snapshot()
         materiel_recent = Materiel.objects.select_related('categorie', 'departement')\
                             .order_by('-date_creation')[:3]
-        departements_list = Departement.objects.all()
     else:
         # Utilisateur du département: voir seulement son département
         departement = getattr(request, 'departement', None)
@@ -811,45 +847,53 @@ def dashboard(request):
                 defaults={'nom': 'Département par défaut'}
             )
         
-        total_materiel = Materiel.objects.filter(departement=departement).count()
-        materiel_disponible = Materiel.objects.filter(departement=departement, statut_disponibilite='DISPONIBLE').count()
-        materiel_attribue = Materiel.objects.filter(departement=departement, statut_disponibilite='ATTRIBUE').count()
-        materiel_defectueux = Materiel.objects.filter(departement=departement, etat_technique='DEFECTUEUX').count()
+        snapshot = DashboardService.get_snapshot(departement)
         materiel_recent = Materiel.objects.filter(departement=departement)\
                             .select_related('categorie', 'departement')\
                             .order_by('-date_creation')[:3]
-        departements_list = [departement]
-
-    # Statistiques par département
-    departements = []
-    for dept in departements_list:
-        total = Materiel.objects.filter(departement=dept).count()
-        disponible = Materiel.objects.filter(departement=dept, statut_disponibilite='DISPONIBLE').count()
-        attribue = Materiel.objects.filter(departement=dept, statut_disponibilite='ATTRIBUE').count()
-        departements.append({
-            'nom': dept.nom,
-            'total': total,
-            'disponible': disponible,
-            'attribue': attribue,
-        })
     
     # Récupérer les alertes non réglées (limité à 3 pour le dashboard)
     departement = getattr(request, 'departement', None)
     alertes_recentes = AlerteService.get_alertes_non_reglementees(departement)[:3]
-    nombre_alertes_critiques = AlerteService.get_nombre_alertes_critiques(departement)
 
     context = {
-        'total_materiel': total_materiel,
-        'materiel_disponible': materiel_disponible,
-        'materiel_attribue': materiel_attribue,
-        'materiel_defectueux': materiel_defectueux,
+        'total_materiel': snapshot['total_materiel'],
+        'materiel_disponible': snapshot['materiel_disponible'],
+        'materiel_attribue': snapshot['materiel_attribue'],
+        'materiel_defectueux': snapshot['materiel_defectueux'],
         'materiel_recent': materiel_recent,
-        'departements': departements,
+        'departements': snapshot['departements'],
         'alertes_recentes': alertes_recentes,
-        'nombre_alertes_critiques': nombre_alertes_critiques,
+        'nombre_alertes_critiques': snapshot['nombre_alertes_critiques'],
     }
     return render(request, 'assets/dashboard.html', context)
 
+@login_required
+def dashboard_snapshot(request):
+    """Instantané JSON du tableau de bord, pour les écrans muraux qui l'interrogent périodiquement"""
+    profil = getattr(request, 'profil_utilisateur', None)
+    if profil and profil.role == 'SUPER_ADMIN':
+        snapshot = DashboardService.get_snapshot()
+    else:
+        departement = getattr(request, 'departement', None)
+        if not departement:
+            return JsonResponse({'error': 'Aucun département associé'}, status=403)
+        snapshot = DashboardService.get_snapshot(departement)
+    return JsonResponse(snapshot)
+
+# Colonnes triables de la liste groupée des matériels (?tri=...)
+MATERIEL_LIST_COLONNES_TRI = {
+    'nom': 'nom',
+    'quantite': 'quantite',
+    'categorie': 'categorie__nom',
+    'disponible': 'disponible',
+    'attribue': 'attribue',
+    'maintenance': 'maintenance',
+    'date_modification': 'date_modification',
+}
+MATERIEL_LIST_TAILLE_PAGE = 50
+
+
 @login_required
 def materiel_list(request):
     """Liste tous les matériels groupés par nom d'équipement avec quantités."""
@@ -880,52 +924,67 @@ def materiel_list(request):
     if categorie_filter:
         materiels_base = materiels_base.filter(categorie_id=categorie_filter)
     
-    # Grouper par nom d'équipement
-    groupes_materiels = materiels_base.values('nom', 'categorie').annotate(
-        quantite=Count('id'),
-        date_modification_max=Max('date_modification')
-    ).order_by('nom')
-    
-    # Enrichir avec les informations de catégorie
-    groupes_enrichis = []
-    for groupe in groupes_materiels:
-        nom = groupe['nom']
-        categorie_id = groupe.get('categorie')
-        
-        # Récupérer un exemple de matériel pour obtenir la catégorie
-        materiel_exemple = materiels_base.filter(nom=nom).first()
-        
-        # Compter les statuts
-        total = materiels_base.filter(nom=nom).count()
-        disponible = materiels_base.filter(nom=nom, statut_disponibilite='DISPONIBLE', etat_technique='FONCTIONNEL').count()
-        attribue = materiels_base.filter(nom=nom, statut_disponibilite='ATTRIBUE').count()
-        maintenance = materiels_base.filter(nom=nom, statut_disponibilite='MAINTENANCE').count()
-        
-        groupes_enrichis.append({
-            'nom': nom,
-            'categorie': materiel_exemple.categorie if materiel_exemple else None,
-            'quantite': total,
-            'disponible': disponible,
-            'attribue': attribue,
-            'maintenance': maintenance,
-            'date_modification': groupe['date_modification_max'],
-        })
+    if query:
+        # Recherche sur les champs des matériels: une seule requête GROUP BY avec comptages conditionnels
+        groupes_materiels = materiels_base.order_by().values(
+            'nom', 'categorie_id', 'categorie__nom'
+        ).annotate(
+            quantite=Count('id'),
+            disponible=Count('id', filter=Q(statut_disponibilite='DISPONIBLE', etat_technique='FONCTIONNEL')),
+            attribue=Count('id', filter=Q(statut_disponibilite='ATTRIBUE')),
+            maintenance=Count('id', filter=Q(statut_disponibilite='MAINTENANCE')),
+            date_modification=Max('date_modification'),
+        )
+    else:
+        # Sans recherche: lecture directe des niveaux de stock maintenus
+        niveaux = NiveauStock.objects.filter(departement=departement, total__gt=0)
+        if categorie_filter:
+            niveaux = niveaux.filter(categorie_id=categorie_filter)
+        groupes_materiels = niveaux.values(
+            'nom', 'categorie_id', 'categorie__nom', 'disponible', 'attribue', 'maintenance', 'date_modification',
+            quantite=F('total'),
+        )
     
-    # Statistiques pour les filtres
-    total_materiels = Materiel.objects.filter(departement=departement).count()
-    stats = {
-        'total': total_materiels,
-        'disponible': Materiel.objects.filter(departement=departement, statut_disponibilite='DISPONIBLE').count(),
-        'attribue': Materiel.objects.filter(departement=departement, statut_disponibilite='ATTRIBUE').count(),
-        'maintenance': Materiel.objects.filter(departement=departement, statut_disponibilite='MAINTENANCE').count(),
-        'hors_service': Materiel.objects.filter(departement=departement, statut_disponibilite='HORS_SERVICE').count(),
-    }
+    # Tri sur n'importe quelle colonne (?tri=colonne ou ?tri=-colonne), le nom départage
+    tri = request.GET.get('tri', 'nom')
+    colonne_tri = MATERIEL_LIST_COLONNES_TRI.get(tri.lstrip('-'))
+    if not colonne_tri:
+        tri, colonne_tri = 'nom', 'nom'
+    ordre = f"-{colonne_tri}" if tri.startswith('-') else colonne_tri
+    groupes_materiels = groupes_materiels.order_by(ordre, 'nom', 'categorie_id')
+    
+    # Pagination des groupes (COUNT + page: nombre de requêtes constant)
+    paginator = Paginator(groupes_materiels, MATERIEL_LIST_TAILLE_PAGE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    groupes_enrichis = [
+        {
+            'nom': groupe['nom'],
+            'categorie': {'id': groupe['categorie_id'], 'nom': groupe['categorie__nom']} if groupe['categorie_id'] else None,
+            'quantite': groupe['quantite'],
+            'disponible': groupe['disponible'],
+            'attribue': groupe['attribue'],
+            'maintenance': groupe['maintenance'],
+            'date_modification': groupe['date_modification'],
+        }
+        for groupe in page_obj
+    ]
+    
+    # Statistiques pour les filtres (somme des niveaux de stock du département)
+    stats = NiveauStock.objects.filter(departement=departement).aggregate(
+        total=Coalesce(Sum('total'), 0),
+        disponible=Coalesce(Sum('disponible'), 0),
+        attribue=Coalesce(Sum('attribue'), 0),
+        maintenance=Coalesce(Sum('maintenance'), 0),
+        hors_service=Coalesce(Sum('hors_service'), 0),
+    )
     
     # Catégories disponibles pour les filtres
     categories = Categorie.objects.filter(departement=departement)
     
     context = {
         'groupes_materiels': groupes_enrichis,
+        'page_obj': page_obj,
+        'tri': tri,
         'query': query,
         'categorie_filter': categorie_filter,
         'stats': stats,
@@ -954,17 +1013,16 @@ def materiel_group_detail(request, nom):
         messages.error(request, f'Aucun matériel trouvé avec le nom "{nom}".')
         return redirect('assets:materiel_list')
     
-    # Statistiques du groupe
+    # Statistiques du groupe (niveaux de stock maintenus, un par catégorie)
+    niveaux = list(NiveauStock.objects.filter(nom=nom, departement=departement).select_related('categorie'))
     stats_groupe = {
-        'total': materiels.count(),
-        'disponible': materiels.filter(statut_disponibilite='DISPONIBLE', etat_technique='FONCTIONNEL').count(),
-        'attribue': materiels.filter(statut_disponibilite='ATTRIBUE').count(),
-        'maintenance': materiels.filter(statut_disponibilite='MAINTENANCE').count(),
-        'defectueux': materiels.filter(etat_technique='DEFECTUEUX').count(),
+        champ: sum(getattr(niveau, champ) for niveau in niveaux)
+        for champ in ('total', 'disponible', 'attribue', 'maintenance', 'defectueux')
     }
     
     # Catégorie (tous les matériels du groupe ont la même catégorie normalement)
-    categorie = materiels.first().categorie if materiels.exists() else None
+    categories_groupe = {niveau.categorie for niveau in niveaux if niveau.total}
+    categorie = categories_groupe.pop() if len(categories_groupe) == 1 else None
     
     context = {
         'nom_equipement': nom,
@@ -1140,39 +1198,44 @@ def checkout(request, asset_id):
                 except Exception:
                     pass
 
-            attribution.save()
-
-            # Historique
-            HistoriqueAttribution.objects.create(
-                attribution=attribution,
-                action=HistoriqueAttribution.ACTION_CHECK_OUT,
-                utilisateur=request.user,
-                etat_avant=Materiel.STATUT_DISPONIBLE,
-                etat_apres=Materiel.STATUT_ATTRIBUE,
-                notes=attribution.notes
-            )
+            # Attribution, historique et alerte validés ensemble: la notification mise en file
+            # par l'attribution n'est visible du worker qu'une fois tout le check-out enregistré
+            with transaction.atomic():
+                attribution.save()
 
-            # Créer une alerte d'information pour le mouvement (matériel attribué)
-            try:
-                dest_label = ''
-                if attribution.client:
-                    dest_label = str(attribution.client)
-                elif attribution.salle:
-                    dest_label = f"Salle: {attribution.salle}"
-                else:
-                    dest_label = 'Destination inconnue'
-
-                Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_RETARD,
-                    severite=Alerte.SEVERITE_INFO,
-                    materiel=materiel,
+                # Historique
+                HistoriqueAttribution.objects.create(
                     attribution=attribution,
-                    departement=materiel.departement,
-                    description=f"Matériel attribué à {dest_label} (Date: {attribution.date_attribution.date()})"
+                    action=HistoriqueAttribution.ACTION_CHECK_OUT,
+                    utilisateur=request.user,
+                    etat_avant=Materiel.STATUT_DISPONIBLE,
+                    etat_apres=Materiel.STATUT_ATTRIBUE,
+                    notes=attribution.notes
                 )
-            except Exception:
-                # Ne pas bloquer le flux en cas d'erreur d'alerte
-                pass
+
+                # Créer une alerte d'information pour le mouvement (matériel attribué)
+                try:
+                    dest_label = ''
+                    if attribution.client:
+                        dest_label = str(attribution.client)
+                    elif attribution.salle:
+                        dest_label = f"Salle: {attribution.salle}"
+                    else:
+                        dest_label = 'Destination inconnue'
+
+                    # Point de sauvegarde: une erreur ignorée ici n'annule pas le reste du check-out
+                    with transaction.atomic():
+                        AlerteService.upsert_alerte(
+                            type_alerte=Alerte.TYPE_RETARD,
+                            severite=Alerte.SEVERITE_INFO,
+                            materiel=materiel,
+                            attribution=attribution,
+                            departement=materiel.departement,
+                            description=f"Matériel attribué à {dest_label} (Date: {attribution.date_attribution.date()})"
+                        )
+                except Exception:
+                    # Ne pas bloquer le flux en cas d'erreur d'alerte
+                    pass
 
             messages.success(request, 'Attribution enregistrée.')
             return redirect('assets:materiel_detail', pk=materiel.pk)
@@ -1206,73 +1269,80 @@ def checkin(request, asset_id):
             notes = form.cleaned_data.get('notes')
             maintenance = form.cleaned_data.get('mettre_en_maintenance')
 
-            attribution.date_retour_effective = date_retour
-            if notes:
-                attribution.notes = (attribution.notes or '') + '\n' + notes
-            attribution.save()
-
-            # Mettre à jour le matériel
-            etat_avant = materiel.statut_disponibilite
-            if maintenance or raison_non_retour in ['DAMAGE', 'OTHER']:
-                materiel.statut_disponibilite = Materiel.STATUT_MAINTENANCE
-                materiel.etat_technique = Materiel.ETAT_EN_MAINTENANCE
-            else:
-                materiel.statut_disponibilite = Materiel.STATUT_DISPONIBLE
-            materiel.save()
-
-            # Historique
-            historique_notes = notes or ''
-            if raison_non_retour != 'NORMAL':
-                historique_notes += f'\n[Raison: {dict(CheckInForm.RAISON_CHOICES).get(raison_non_retour)}]'
-                if description_damage:
-                    historique_notes += f'\n[Détails: {description_damage}]'
+            # Retour, matériel, historique et alertes validés ensemble (voir checkout)
+            with transaction.atomic():
+                attribution.date_retour_effective = date_retour
+                if notes:
+                    attribution.notes = (attribution.notes or '') + '\n' + notes
+                attribution.save()
+
+                # Mettre à jour le matériel
+                etat_avant = materiel.statut_disponibilite
+                if maintenance or raison_non_retour in ['DAMAGE', 'OTHER']:
+                    materiel.statut_disponibilite = Materiel.STATUT_MAINTENANCE
+                    materiel.etat_technique = Materiel.ETAT_EN_MAINTENANCE
+                else:
+                    materiel.statut_disponibilite = Materiel.STATUT_DISPONIBLE
+                materiel.save()
+
+                # Historique
+                historique_notes = notes or ''
+                if raison_non_retour != 'NORMAL':
+                    historique_notes += f'\n[Raison: {dict(CheckInForm.RAISON_CHOICES).get(raison_non_retour)}]'
+                    if description_damage:
+                        historique_notes += f'\n[Détails: {description_damage}]'
             
-            HistoriqueAttribution.objects.create(
-                attribution=attribution,
-                action=HistoriqueAttribution.ACTION_CHECK_IN,
-                utilisateur=request.user,
-                etat_avant=etat_avant,
-                etat_apres=materiel.statut_disponibilite,
-                notes=historique_notes
-            )
+                HistoriqueAttribution.objects.create(
+                    attribution=attribution,
+                    action=HistoriqueAttribution.ACTION_CHECK_IN,
+                    utilisateur=request.user,
+                    etat_avant=etat_avant,
+                    etat_apres=materiel.statut_disponibilite,
+                    notes=historique_notes
+                )
 
-            # Créer une alerte d'information pour le mouvement (matériel retourné normalement)
-            try:
-                if raison_non_retour == 'NORMAL':
-                    Alerte.objects.create(
-                        type_alerte=Alerte.TYPE_RETARD,
-                        severite=Alerte.SEVERITE_INFO,
+                # Créer une alerte d'information pour le mouvement (matériel retourné normalement).
+                # Écrite réglée: elle garde la trace du retour sans prendre la clé (ni remplacer
+                # la description) de l'alerte ouverte du check-out de la même attribution.
+                try:
+                    # Point de sauvegarde: une erreur ignorée ici n'annule pas le reste du check-in
+                    with transaction.atomic():
+                        if raison_non_retour == 'NORMAL':
+                            Alerte.objects.create(
+                                type_alerte=Alerte.TYPE_RETARD,
+                                severite=Alerte.SEVERITE_INFO,
+                                materiel=materiel,
+                                attribution=attribution,
+                                departement=materiel.departement,
+                                description=f"Matériel retourné par {attribution.client.nom} le {date_retour}.",
+                                reglementee=True,
+                            )
+                except Exception:
+                    # Ne pas bloquer le flux en cas d'erreur d'alerte
+                    pass
+
+                # Auto-créer une Alerte si matériel perdu ou endommagé
+                alerte_created = None
+                if raison_non_retour == 'LOST':
+                    dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
+                    alerte_created, _ = AlerteService.upsert_alerte(
+                        type_alerte=Alerte.TYPE_PERDU,
+                        severite=Alerte.SEVERITE_CRITICAL,
                         materiel=materiel,
                         attribution=attribution,
                         departement=materiel.departement,
-                        description=f"Matériel retourné par {attribution.client.nom} le {date_retour}."
+                        description=f"Matériel perdu lors de l'attribution à {dest_label}\n{description_damage or ''}"
+                    )
+                elif raison_non_retour == 'DAMAGE':
+                    dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
+                    alerte_created, _ = AlerteService.upsert_alerte(
+                        type_alerte=Alerte.TYPE_DEFECTUEUX,
+                        severite=Alerte.SEVERITE_CRITICAL,
+                        materiel=materiel,
+                        attribution=attribution,
+                        departement=materiel.departement,
+                        description=f"Matériel endommagé lors de l'attribution à {dest_label}\nDégâts: {description_damage or 'Non spécifiés'}"
                     )
-            except Exception:
-                # Ne pas bloquer le flux en cas d'erreur d'alerte
-                pass
-
-            # Auto-créer une Alerte si matériel perdu ou endommagé
-            alerte_created = None
-            if raison_non_retour == 'LOST':
-                dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
-                alerte_created = Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_PERDU,
-                    severite=Alerte.SEVERITE_CRITICAL,
-                    materiel=materiel,
-                    attribution=attribution,
-                    departement=materiel.departement,
-                    description=f"Matériel perdu lors de l'attribution à {dest_label}\n{description_damage or ''}"
-                )
-            elif raison_non_retour == 'DAMAGE':
-                dest_label = attribution.client.nom if attribution.client else (f"Salle: {attribution.salle}" if attribution.salle else 'Inconnu')
-                alerte_created = Alerte.objects.create(
-                    type_alerte=Alerte.TYPE_DEFECTUEUX,
-                    severite=Alerte.SEVERITE_CRITICAL,
-                    materiel=materiel,
-                    attribution=attribution,
-                    departement=materiel.departement,
-                    description=f"Matériel endommagé lors de l'attribution à {dest_label}\nDégâts: {description_damage or 'Non spécifiés'}"
-                )
 
             # Stocker les données dans la session pour la page de confirmation
             request.session['checkin_data'] = {
@@ -1335,37 +1405,135 @@ def client_list(request):
     return render(request, 'assets/client_list.html', {'clients': clients})
 
 
+TAILLE_PAGE_RAPPORTS = 200
+
+
+def _curseur_rapport(valeur):
+    """Décode un curseur de pagination `timestamp|id`; None s'il est absent ou invalide"""
+    from django.utils.dateparse import parse_datetime
+    try:
+        horodatage, pk = (valeur or '').rsplit('|', 1)
+        horodatage = parse_datetime(horodatage)
+        if horodatage is None:
+            return None
+        if timezone.is_naive(horodatage):
+            horodatage = timezone.make_aware(horodatage)
+        return horodatage, int(pk)
+    except ValueError:
+        return None
+
+
 @login_required
 def report_list(request):
-    """Liste des rapports d'audit (read-only for non-admins)."""
-    qs = AuditLog.objects.select_related('user', 'content_type').all()
+    """
+    Liste des rapports d'audit (read-only for non-admins).
+
+    Pagination par curseur (`avant=timestamp|id` du dernier rapport affiché) sur l'ordre
+    (-timestamp, -id): chaque page est une lecture d'index, quelle que soit sa profondeur.
+    Les filtres type de contenu et utilisateur sont résolus en identifiants pour que la
+    requête reste sur les index composites de AuditLog. Les archives ne sont lues que sur
+    demande (`archives=1`): leurs segments ne sont indexés ni par action ni par utilisateur.
+    """
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+
+    qs = AuditLog.objects.select_related('user', 'content_type')
     action = request.GET.get('action')
     ct = request.GET.get('content_type')
     user = request.GET.get('user')
+    avant = _curseur_rapport(request.GET.get('avant'))
+    avec_archives = request.GET.get('archives') == '1'
 
     if action:
         qs = qs.filter(action=action)
     if ct:
-        qs = qs.filter(content_type__model=ct)
+        qs = qs.filter(content_type_id__in=list(ContentType.objects.filter(model=ct).values_list('id', flat=True)))
     if user:
-        qs = qs.filter(user__username__icontains=user)
+        qs = qs.filter(user_id__in=list(User.objects.filter(username__icontains=user).values_list('id', flat=True)))
+    if avant:
+        qs = qs.filter(Q(timestamp__lt=avant[0]) | Q(timestamp=avant[0], id__lt=avant[1]))
+
+    reports = list(qs.order_by('-timestamp', '-id')[:TAILLE_PAGE_RAPPORTS + 1])
+    if avec_archives and len(reports) <= TAILLE_PAGE_RAPPORTS:
+        # Les lignes archivées sont toutes plus anciennes que celles de la table: elles complètent la liste
+        reports += ArchivageAuditService.entrees(
+            TAILLE_PAGE_RAPPORTS + 1 - len(reports), action=action, content_type=ct, user=user, avant=avant,
+        )
 
-    qs = qs.order_by('-timestamp')[:200]
-    return render(request, 'assets/report_list.html', {'reports': qs})
+    page_suivante = None
+    if len(reports) > TAILLE_PAGE_RAPPORTS:
+        reports = reports[:TAILLE_PAGE_RAPPORTS]
+        parametres = request.GET.copy()
+        parametres['avant'] = f"{reports[-1].timestamp.isoformat()}|{reports[-1].pk}"
+        page_suivante = parametres.urlencode()
+    lien_archives = None
+    if page_suivante is None and not avec_archives:
+        # Fin de la table: les rapports plus anciens, s'il y en a, sont dans les archives
+        parametres = request.GET.copy()
+        parametres['archives'] = '1'
+        lien_archives = parametres.urlencode()
+    return render(request, 'assets/report_list.html', {
+        'reports': reports,
+        'page_suivante': page_suivante,
+        'lien_archives': lien_archives,
+    })
 
 
 @login_required
-def report_detail(request, pk):
-    report = get_object_or_404(AuditLog, pk=pk)
-    # Prepare formatted changes and a short human summary for the UI
-    formatted_changes = _format_changes_for_display(report)
+def report_object_history(request, content_type_id, object_id):
+    """
+    Historique complet d'un objet: tous ses rapports d'audit, du plus récent au plus ancien,
+    lus sur l'index (content_type, object_id, -timestamp). Les archives ne sont parcourues
+    que sur demande (`archives=1`), leurs segments étant indexés par type et non par objet.
+    """
+    from django.contrib.contenttypes.models import ContentType
 
-    # If this is an Attribution event, prefer showing key fields first for clarity
     try:
-        ct_model = report.content_type.model_class()
-    except Exception:
-        ct_model = None
-    if ct_model and ct_model.__name__ == 'Attribution' and formatted_changes:
+        content_type = ContentType.objects.get_for_id(content_type_id)
+    except ContentType.DoesNotExist:
+        raise Http404("Type de contenu introuvable")
+    reports = list(
+        AuditLog.objects.filter(content_type_id=content_type_id, object_id=object_id)
+        .select_related('user')
+        .order_by('-timestamp', '-id')
+    )
+    avec_archives = request.GET.get('archives') == '1'
+    if avec_archives:
+        reports += ArchivageAuditService.historique(content_type_id, object_id)
+    for report in reports:
+        report.content_type = content_type
+    return render(request, 'assets/report_object_history.html', {
+        'reports': reports,
+        'content_type': content_type,
+        'object_id': object_id,
+        'object_repr': next((r.object_repr for r in reports if r.object_repr), object_id),
+        'avec_archives': avec_archives,
+    })
+
+
+def _get_report(pk):
+    """Rapport d'audit `pk`, lu dans la table ou à défaut dans les segments d'archive"""
+    report = AuditLog.objects.select_related('user', 'content_type').filter(pk=pk).first()
+    if report is None:
+        report = ArchivageAuditService.trouver(pk)
+    if report is None:
+        raise Http404("Rapport introuvable")
+    return report
+
+
+def _report_context(report, prioritise_fields=False):
+    """Template context of a report (detail page, PDF, headless rendering).
+
+    Everything the report references is loaded once through _ReportRendering and
+    shared by the formatted changes and the three sentence builders, so rendering
+    costs a fixed handful of queries whatever the number of changed fields.
+    """
+    rendering = _ReportRendering(report)
+    formatted_changes = _format_changes_for_display(report, rendering)
+
+    # If this is an Attribution event, prefer showing key fields first for clarity
+    ct_model = rendering.model
+    if prioritise_fields and ct_model and ct_model.__name__ == 'Attribution' and formatted_changes:
         priority = ['id', 'materiel', 'client', 'employe_responsable', 'departement', 'date_retour_prevue', 'notes']
         ordered = []
         rest = []
@@ -1394,146 +1562,112 @@ def report_detail(request, pk):
     else:
         summary = f"{user_label} — {action} — {obj_label}"
 
-    # Try to build a more detailed human-readable sentence for Attribution
-    human_sentence = _build_human_readable_sentence(report, formatted_changes)
-
-    # Build a creative context sentence for display
-    context_sentence = _build_context_sentence(report)
-
-    # Build a creative summary sentence for the 'Résumé' field
-    creative_summary = _build_creative_summary(report)
-
-    # Only admins can modify/delete via admin; in UI everyone can view
-    return render(request, 'assets/report_detail.html', {
+    return {
         'report': report,
         'formatted_changes': formatted_changes,
-        'summary': creative_summary or summary,
-        'human_sentence': human_sentence,
-        'context_sentence': context_sentence,
+        # Creative summary sentence for the 'Résumé' field
+        'summary': _build_creative_summary(report, rendering) or summary,
+        # More detailed human-readable sentence for Attribution
+        'human_sentence': _build_human_readable_sentence(report, formatted_changes, rendering),
+        'context_sentence': _build_context_sentence(report, rendering),
         'sanitized_metadata': _sanitize_metadata(getattr(report, 'metadata', None)),
-    })
+    }
+
+
+@login_required
+def report_detail(request, pk):
+    report = _get_report(pk)
+    # Only admins can modify/delete via admin; in UI everyone can view
+    return render(request, 'assets/report_detail.html', _report_context(report, prioritise_fields=True))
 
 
 @login_required
 def report_pdf(request, pk):
-    """Return a PDF version of the report detail. Uses WeasyPrint if available.
+    """Return a PDF version of the report detail, from the on-disk cache when already rendered.
 
-    Falls back to returning the HTML view with a warning if PDF library isn't present.
+    Uses WeasyPrint or wkhtmltopdf (see RapportPdfService). Falls back to returning the
+    HTML view with a warning if no PDF backend is available.
     """
-    report = get_object_or_404(AuditLog, pk=pk)
-    formatted_changes = _format_changes_for_display(report)
-    human_sentence = _build_human_readable_sentence(report, formatted_changes)
-    summary = None
-    # reuse summary logic from report_detail
-    user_label = report.user.username if report.user else 'System'
-    action = report.get_action_display()
-    obj_label = report.object_repr or ''
-    if report.action == AuditLog.ACTION_CREATE:
-        summary = f"{user_label} a créé {report.content_type.model.capitalize()} — {obj_label}"
-    elif report.action == AuditLog.ACTION_UPDATE:
-        changed_fields = ', '.join([c['field'] for c in formatted_changes]) if formatted_changes else ''
-        summary = f"{user_label} a modifié {report.content_type.model.capitalize()} — {obj_label}. Champs modifiés: {changed_fields}"
-    elif report.action == AuditLog.ACTION_DELETE:
-        summary = f"{user_label} a supprimé {report.content_type.model.capitalize()} — {obj_label}"
-    else:
-        summary = f"{user_label} — {action} — {obj_label}"
+    report = _get_report(pk)
+    chemin = RapportPdfService.obtenir(report, base_url=request.build_absolute_uri('/'))
+    if chemin:
+        return FileResponse(
+            open(chemin, 'rb'), as_attachment=True, filename=f"rapport_{report.pk}.pdf", content_type='application/pdf',
+        )
 
-    context = {
-        'report': report,
-        'formatted_changes': formatted_changes,
-        'summary': _build_creative_summary(report) or summary,
-        'human_sentence': human_sentence,
-        'context_sentence': _build_context_sentence(report),
-        'sanitized_metadata': _sanitize_metadata(getattr(report, 'metadata', None)),
-    }
+    # Nothing worked: show the HTML fallback with a helpful message
+    return render(request, 'assets/report_detail.html', dict(_report_context(report), pdf_unavailable=True))
 
-    # Render the HTML for the PDF (include `request` so context processors run)
-    from django.template.loader import render_to_string
-    html = render_to_string('assets/report_pdf.html', context, request=request)
+@staff_member_required
+def report_export(request):
+    """
+    Demande d'export zip des rapports d'une période (PDF + index CSV), réservé au staff.
+    Paramètres GET: debut, fin (AAAA-MM-JJ, fin exclue), action, content_type, user,
+    departement (code). L'archive est écrite en arrière-plan par le scheduler: la réponse
+    (202) donne l'identifiant de l'export et les adresses de suivi et de téléchargement.
+    """
+    import uuid
+    from datetime import datetime, time
+    from .models import ExportAudit
 
-    # Try to generate PDF using WeasyPrint if available. If it fails (native libs missing),
-    # fall back to wkhtmltopdf via `pdfkit` if available. If both fail, return HTML fallback.
     try:
-        from weasyprint import HTML
-        try:
-            pdf = HTML(string=html, base_url=request.build_absolute_uri('/')).write_pdf()
-            response = HttpResponse(pdf, content_type='application/pdf')
-            filename = f"rapport_{report.pk}.pdf"
-            response['Content-Disposition'] = f'attachment; filename="{filename}"'
-            return response
-        except Exception:
-            # WeasyPrint present but failed to render (likely missing native libs)
-            pass
-    except Exception:
-        # WeasyPrint not installed -- continue to next backend
-        pass
+        debut, fin = (
+            timezone.make_aware(datetime.combine(datetime.strptime(request.GET.get(cle, ''), '%Y-%m-%d').date(), time.min))
+            for cle in ('debut', 'fin')
+        )
+    except ValueError:
+        return JsonResponse({'error': "Paramètres 'debut' et 'fin' requis (AAAA-MM-JJ)"}, status=400)
+
+    demande = ExportAudit.objects.create(
+        identifiant=uuid.uuid4().hex,
+        demandeur=request.user,
+        debut=debut,
+        fin=fin,
+        filtres={
+            cle: request.GET[cle]
+            for cle in ('action', 'content_type', 'user', 'departement')
+            if request.GET.get(cle)
+        },
+    )
+    return JsonResponse({
+        'export_id': demande.identifiant,
+        'progression': reverse('assets:report_export_progress', args=[demande.identifiant]),
+        'telechargement': reverse('assets:report_export_download', args=[demande.identifiant]),
+    }, status=202)
 
-    # Try wkhtmltopdf via pdfkit (requires wkhtmltopdf binary on PATH or WKHTMLTOPDF_CMD env var)
-    try:
-        import pdfkit
-        import shutil, os
-        from django.conf import settings
 
-        # Prefer explicit env var, then PATH, then a bundled copy under <project>/bin/
-        wkhtml_cmd = os.environ.get('WKHTMLTOPDF_CMD') or shutil.which('wkhtmltopdf')
+@staff_member_required
+def report_export_progress(request, export_id):
+    """Avancement d'un export: {'statut', 'faits', 'total', 'termine', 'erreur'}"""
+    from .models import ExportAudit
 
-        # Look for a local copy under the repository `bin/` directory (common for portable zip)
-        if not wkhtml_cmd:
-            try:
-                base = getattr(settings, 'BASE_DIR', os.getcwd())
-            except Exception:
-                base = os.getcwd()
-
-            bin_dir = os.path.join(base, 'bin')
-            candidate = None
-            if os.path.isdir(bin_dir):
-                # search for an executable named wkhtmltopdf(.exe)
-                for root, dirs, files in os.walk(bin_dir):
-                    for f in files:
-                        if f.lower().startswith('wkhtmltopdf'):
-                            candidate = os.path.join(root, f)
-                            break
-                    if candidate:
-                        break
-            if candidate and os.path.exists(candidate):
-                wkhtml_cmd = candidate
-
-        if wkhtml_cmd:
-            try:
-                config = pdfkit.configuration(wkhtmltopdf=wkhtml_cmd)
-                # Allow local file access and ignore minor load errors so wkhtmltopdf
-                # can render templates referencing /static/... files when no HTTP server
-                # is available during headless requests.
-                options = {
-                    'enable-local-file-access': '',
-                    'load-error-handling': 'ignore',
-                    'encoding': 'UTF-8',
-                }
-                pdf = pdfkit.from_string(html, False, options=options, configuration=config)
-                response = HttpResponse(pdf, content_type='application/pdf')
-                filename = f"rapport_{report.pk}.pdf"
-                response['Content-Disposition'] = f'attachment; filename="{filename}"'
-                return response
-            except Exception as e:
-                # pdfkit/wkhtmltopdf invocation failed — capture the error for debugging.
-                try:
-                    base = getattr(settings, 'BASE_DIR', os.getcwd())
-                    tmpdir = os.path.join(base, 'tmp')
-                    os.makedirs(tmpdir, exist_ok=True)
-                    errfile = os.path.join(tmpdir, f'report_{report.pk}_pdf_error.txt')
-                    with open(errfile, 'w', encoding='utf-8') as ef:
-                        ef.write(str(e))
-                except Exception:
-                    # ignore file-writing errors
-                    pass
-                # fall through to HTML fallback
-                pass
-    except Exception:
-        # pdfkit not installed
-        pass
+    demande = ExportAudit.objects.filter(identifiant=export_id).first()
+    if demande is None:
+        return JsonResponse({'error': 'Export inconnu'}, status=404)
+    return JsonResponse({
+        'statut': demande.statut,
+        'faits': demande.faits,
+        'total': demande.total,
+        'termine': demande.statut == ExportAudit.STATUT_TERMINE,
+        'erreur': demande.erreur,
+    })
+
+
+@staff_member_required
+def report_export_download(request, export_id):
+    """Archive d'un export terminé (404 tant qu'elle n'est pas écrite)"""
+    from .models import ExportAudit
+
+    demande = get_object_or_404(ExportAudit, identifiant=export_id, statut=ExportAudit.STATUT_TERMINE)
+    try:
+        fichier = open(ExportAuditService.chemin(demande), 'rb')
+    except FileNotFoundError:
+        raise Http404("Archive d'export introuvable")
+    return FileResponse(
+        fichier, as_attachment=True, filename=f"audit_{demande.debut:%Y-%m-%d}_{demande.fin:%Y-%m-%d}.zip",
+        content_type='application/zip',
+    )
 
-    # Nothing worked: show the HTML fallback with a helpful message
-    return render(request, 'assets/report_detail.html', dict(context, pdf_unavailable=True))
 
 @login_required
 def client_create(request):
@@ -1632,21 +1766,18 @@ def alerte_list(request):
     if severite_filter:
         alertes = alertes.filter(severite=severite_filter)
     
-    # Statistiques
-    stats = {
-        'total': alertes.count(),
-        'critique': alertes.filter(severite=Alerte.SEVERITE_CRITICAL).count(),
-        'warning': alertes.filter(severite=Alerte.SEVERITE_WARNING).count(),
-        'info': alertes.filter(severite=Alerte.SEVERITE_INFO).count(),
-        'retard': alertes.filter(type_alerte=Alerte.TYPE_RETARD).count(),
-        'defectueux': alertes.filter(type_alerte=Alerte.TYPE_DEFECTUEUX).count(),
-        'stock_critique': alertes.filter(type_alerte=Alerte.TYPE_STOCK_CRITIQUE).count(),
-        'perdu': alertes.filter(type_alerte=Alerte.TYPE_PERDU).count(),
-    }
+    # Statistiques (une seule requête agrégée)
+    stats = AlerteService.statistiques_alertes(alertes)
+    
+    # Pagination par curseur
+    curseur = request.GET.get('apres', '')
+    page_alertes, curseur_suivant = AlerteService.page_alertes(alertes, curseur)
     
     context = {
-        'alertes': alertes,
+        'alertes': page_alertes,
         'stats': stats,
+        'curseur': curseur,
+        'curseur_suivant': curseur_suivant,
         'type_filter': type_filter,
         'severite_filter': severite_filter,
         'type_choices': Alerte.TYPE_CHOICES,
@@ -1739,7 +1870,7 @@ def notifications_dashboard(request):
     
     # Récupérer toutes les notifications
     all_notifications = NotificationLog.objects.select_related(
-        'attribution__materiel', 'attribution__client'
+        'attribution__materiel', 'attribution__client', 'alerte'
     ).order_by('-date_envoi')
     
     # Statistiques globales
@@ -2,8 +2,14 @@
 WhatsApp notification service for RadGestMat
 Integrates with Twilio for sending WhatsApp messages
 """
+import time
+import uuid
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.db import connection
+from django.utils import timezone
 from assets.models import NotificationLog
 from assets.whatsapp_templates import WhatsAppTemplates
 
@@ -16,12 +22,57 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter
+    `rate` tokens are added per second, up to `capacity` (the allowed burst)
+    """
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self):
+        """Block until a token is available, then consume it"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+    
+    def penalize(self, seconds):
+        """Drain the bucket so that no caller sends for `seconds` (after an HTTP 429)"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
 class WhatsAppNotificationService:
     """
     Service for sending WhatsApp notifications via Twilio
+    
+    Optional settings:
+    - TWILIO_API_BASE_URL: Twilio REST API base URL (e.g. a local stand-in for tests)
+    - WHATSAPP_RATE_LIMIT: messages per second shared by all sending threads (default 10)
+    - WHATSAPP_BURST: token bucket capacity (default: WHATSAPP_RATE_LIMIT)
+    - WHATSAPP_CONCURRENCY: size of the dispatcher thread pool (default 4)
+    - WHATSAPP_429_RETRIES / WHATSAPP_429_BACKOFF: retries and base delay (s) on HTTP 429
     """
     
     _twilio_client = None
+    _rate_limiter = None
+    _rate_limiter_lock = threading.Lock()
     
     @classmethod
     def _get_twilio_client(cls):
@@ -40,12 +91,76 @@ class WhatsAppNotificationService:
                     return None
                 
                 cls._twilio_client = Client(account_sid, auth_token)
+                base_url = getattr(settings, 'TWILIO_API_BASE_URL', None)
+                if base_url:
+                    cls._twilio_client.api.base_url = base_url
             except AttributeError:
                 logger.error("TWILIO_ACCOUNT_SID or TWILIO_AUTH_TOKEN not configured")
                 return None
         
         return cls._twilio_client
     
+    @classmethod
+    def get_rate_limiter(cls):
+        """Process-wide token bucket shared by every thread sending WhatsApp messages"""
+        with cls._rate_limiter_lock:
+            if cls._rate_limiter is None:
+                rate = getattr(settings, 'WHATSAPP_RATE_LIMIT', 10)
+                cls._rate_limiter = TokenBucket(rate, getattr(settings, 'WHATSAPP_BURST', None))
+            return cls._rate_limiter
+    
+    @classmethod
+    def _create_message(cls, client, **kwargs):
+        """
+        Create a Twilio message through the rate limiter
+        On HTTP 429 the shared bucket is drained for the backoff delay (exponential)
+        and the call is retried; other errors are raised to the caller
+        """
+        limiter = cls.get_rate_limiter()
+        retries = getattr(settings, 'WHATSAPP_429_RETRIES', 3)
+        backoff = getattr(settings, 'WHATSAPP_429_BACKOFF', 1.0)
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            try:
+                return client.messages.create(**kwargs)
+            except Exception as e:
+                if getattr(e, 'status', None) != 429 or attempt == retries:
+                    raise
+                delay = backoff * (2 ** attempt)
+                logger.warning(f"Twilio rate limit hit (429), backing off {delay:.2f}s")
+                limiter.penalize(delay)
+    
+    @classmethod
+    def _send(cls, unit):
+        """Send one dispatch unit: a single notification, or a list sent as one digest message"""
+        if isinstance(unit, list):
+            return cls.send_digest(unit)
+        return cls.send_notification(unit)
+    
+    @classmethod
+    def dispatch(cls, notification_logs, concurrency=None):
+        """
+        Send WhatsApp notifications through a bounded thread pool
+        Each item is a NotificationLog, or a list of them sent as a single digest
+        All threads share the process-wide token bucket, so `concurrency` only hides
+        Twilio latency and never exceeds WHATSAPP_RATE_LIMIT
+        Returns the list of send results (bool), in input order
+        """
+        if concurrency is None:
+            concurrency = getattr(settings, 'WHATSAPP_CONCURRENCY', 4)
+        if concurrency <= 1 or len(notification_logs) <= 1:
+            return [cls._send(unit) for unit in notification_logs]
+        
+        def send_in_thread(unit):
+            try:
+                return cls._send(unit)
+            finally:
+                # Each pool thread owns its database connection
+                connection.close()
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(send_in_thread, notification_logs))
+    
     @staticmethod
     def send_notification(notification_log):
         """
@@ -93,8 +208,11 @@ class WhatsAppNotificationService:
                 notification_log.save(update_fields=['statut', 'erreur_message'])
                 return False
             
-            # Send message
-            message = client.messages.create(
+            # Send message (settings may already carry the "whatsapp:" prefix)
+            if twilio_phone.startswith('whatsapp:'):
+                twilio_phone = twilio_phone[len('whatsapp:'):]
+            message = WhatsAppNotificationService._create_message(
+                client,
                 from_=f"whatsapp:{twilio_phone}",
                 body=full_message,
                 to=f"whatsapp:{recipient_phone}"
@@ -102,8 +220,9 @@ class WhatsAppNotificationService:
             
             # Update notification log
             notification_log.statut = NotificationLog.STATUT_ENVOYEE
-            notification_log.date_envoi = __import__('django.utils.timezone', fromlist=['now']).now()
-            notification_log.save(update_fields=['statut', 'date_envoi'])
+            notification_log.message_id = message.sid
+            notification_log.date_envoi = timezone.now()
+            notification_log.save(update_fields=['statut', 'message_id', 'date_envoi'])
             
             logger.info(f"WhatsApp message {message.sid} sent to {recipient_phone} "
                        f"for notification {notification_log.id}")
@@ -114,16 +233,69 @@ class WhatsAppNotificationService:
                         exc_info=True)
             
             # Update notification log with error
+            # Retry scheduling and promotion to ECHEC_PERM are handled by NotificationRetryService
             notification_log.statut = NotificationLog.STATUT_ECHEC
             notification_log.erreur_message = str(e)
-            notification_log.nb_tentatives = (notification_log.nb_tentatives or 0) + 1
+            notification_log.save(update_fields=['statut', 'erreur_message'])
+            return False
+    
+    @classmethod
+    def send_digest(cls, notification_logs):
+        """
+        Send one WhatsApp message listing every item of the notifications
+        (same recipient and type); each NotificationLog row gets the message SID,
+        the shared digest id and the same status
+        """
+        from assets.outbox_service import NotificationOutboxService
+        
+        first = notification_logs[0]
+        try:
+            client = cls._get_twilio_client()
+            if client is None:
+                logger.warning(f"Twilio client unavailable for digest to {first.destinataire}")
+                return False
             
-            # Mark as permanent failure after 3 attempts
-            if notification_log.nb_tentatives >= 3:
-                notification_log.statut = NotificationLog.STATUT_ECHEC_PERMANENT
+            recipient_phone = first.destinataire
+            twilio_phone = getattr(settings, 'TWILIO_WHATSAPP_FROM', None)
+            if not recipient_phone or '@' in recipient_phone or not twilio_phone:
+                NotificationOutboxService.marquer(
+                    notification_logs,
+                    statut=NotificationLog.STATUT_ECHEC_PERMANENT,
+                    erreur_message="Invalid recipient phone number or sender not configured",
+                )
+                return False
+            if not recipient_phone.startswith('+'):
+                recipient_phone = '+' + recipient_phone
+            if twilio_phone.startswith('whatsapp:'):
+                twilio_phone = twilio_phone[len('whatsapp:'):]
             
-            notification_log.save(update_fields=['statut', 'erreur_message', 'nb_tentatives'])
+            body = WhatsAppTemplates.digest(
+                attributions=[log.attribution for log in notification_logs],
+                client=first.attribution.client,
+            )
+            message = cls._create_message(
+                client,
+                from_=f"whatsapp:{twilio_phone}",
+                body=f"*{cls._get_subject(first)}*\n\n{body}",
+                to=f"whatsapp:{recipient_phone}"
+            )
+        except Exception as e:
+            logger.error(f"Error sending WhatsApp digest to {first.destinataire}: {e}", exc_info=True)
+            NotificationOutboxService.marquer(
+                notification_logs, statut=NotificationLog.STATUT_ECHEC, erreur_message=str(e),
+            )
             return False
+        
+        NotificationOutboxService.marquer(
+            notification_logs,
+            statut=NotificationLog.STATUT_ENVOYEE,
+            message_id=message.sid,
+            digest=uuid.uuid4().hex,
+            date_envoi=timezone.now(),
+        )
+        logger.info(f"WhatsApp digest {message.sid} ({len(notification_logs)} notifications) "
+                   f"sent to {recipient_phone}")
+        return True
     
     @staticmethod
     def _get_subject(notification_log):
@@ -15,12 +15,12 @@ class WhatsAppTemplates:
         """
         Message sent when material is borrowed
         """
-        return f"""Bonjour {client.first_name or client.name}! 👋
+        return f"""Bonjour {client.nom}! 👋
 
 Votre demande d'emprunt a été confirmée:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 📅 *Date retour:* {attribution.date_retour_prevue}
 🕐 *Heure retour:* {attribution.heure_retour_prevue or 'À convenir'}
 
@@ -36,12 +36,12 @@ Pour toute question, contactez-nous!"""
         """
         return f"""⏰ *RAPPEL - 2 heures avant la restitution!*
 
-Bonjour {client.first_name or client.name},
+Bonjour {client.nom},
 
 Vous devez restituer le matériel suivant dans 2 heures:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 🕐 *Heure limite:* {attribution.heure_retour_prevue}
 
 ⚠️ Vérifiez que le matériel est en bon état avant la restitution.
@@ -56,12 +56,12 @@ Vous devez restituer le matériel suivant dans 2 heures:
         """
         return f"""📋 *RAPPEL - Restitution dans 2 jours*
 
-Bonjour {client.first_name or client.name},
+Bonjour {client.nom},
 
 Vous avez emprunté un matériel qui doit être restitué dans 2 jours:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 📅 *Date retour:* {attribution.date_retour_prevue}
 🕐 *Heure retour:* {attribution.heure_retour_prevue or 'Avant 18h'}
 
@@ -77,12 +77,12 @@ Préparez le matériel et vérifiez son état.
         """
         return f"""🚨 *RAPPEL URGENT - Restitution DEMAIN!*
 
-Bonjour {client.first_name or client.name},
+Bonjour {client.nom},
 
 Votre emprunt expire DEMAIN:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 📅 *Date retour:* {attribution.date_retour_prevue}
 🕐 *Heure limite:* {attribution.heure_retour_prevue or 'Avant 18h'}
 
@@ -101,12 +101,12 @@ Votre emprunt expire DEMAIN:
         """
         return f"""🔴 *CRITIQUE - RESTITUTION AUJOURD'HUI!*
 
-URGENT {client.first_name or client.name}!
+URGENT {client.nom}!
 
 Le matériel DOIT être restitué AUJOURD'HUI:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 ⏰ *Heure limite:* {attribution.heure_retour_prevue or 'Avant 18h'}
 
 🚨 *CONSÉQUENCES du dépassement:*
@@ -124,12 +124,12 @@ Le matériel DOIT être restitué AUJOURD'HUI:
         """
         return f"""⚠️ *ALERTE - MATÉRIEL EN RETARD*
 
-{client.first_name or client.name},
+{client.nom},
 
 Le matériel suivant est EN RETARD:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 📅 *Date retour prévue:* {attribution.date_retour_prevue}
 
 🚨 *Situation actuelle:*
@@ -150,12 +150,12 @@ Pour tout problème, contactez-nous immédiatement."""
         """
         return f"""✨ *MATÉRIEL RESTITUÉ - MERCI!*
 
-Bonjour {client.first_name or client.name},
+Bonjour {client.nom},
 
 Votre emprunt a été officiellement clôturé:
 
 📦 *Matériel:* {materiel.nom}
-🏷️ *Référence:* {materiel.code}
+🏷️ *Référence:* {materiel.numero_inventaire}
 ✅ *Statut:* Restitué avec succès
 
 📊 *Détails de l'emprunt:*
@@ -166,3 +166,23 @@ Merci d'avoir utilisé notre service de gestion des matériels!
 
 📈 Vous pouvez à nouveau faire une demande d'emprunt.
 👍 Bon travail!"""
+    
+    @staticmethod
+    def digest(attributions, client, **kwargs):
+        """
+        Single message listing every item of a digest
+        Sent instead of one message per attribution for the same recipient and type
+        """
+        lines = "\n".join(
+            f"• {attribution.materiel.nom} ({attribution.materiel.numero_inventaire}) - "
+            f"retour {attribution.date_retour_prevue}"
+            + (f" à {attribution.heure_retour_prevue}" if attribution.heure_retour_prevue else "")
+            for attribution in attributions
+        )
+        return f"""Bonjour {client.nom},
+
+Cette notification concerne {len(attributions)} matériels:
+
+{lines}
+
+Pour tout problème, contactez-nous."""
@@ -73,55 +73,57 @@ def stop_scheduler():
 def _register_jobs():
     """Register all notification scheduling jobs"""
     from assets.scheduler_jobs import (
-        check_court_terme_reminders,
-        check_moyen_terme_reminders,
-        check_long_terme_reminders,
-        check_overdue_materials,
+        process_due_notifications,
+        reminder_safety_sweep,
+        detect_alerts_incremental,
+        refresh_dashboard_snapshots,
         cleanup_old_notifications,
+        archive_audit_logs,
+        pregenerate_report_pdfs,
+        process_audit_exports,
     )
     
-    # Court terme (Short term): Check every 30 minutes
-    # For loans < 4 hours, remind at 2 hours before return
+    # Planned reminders and overdue notices: Every minute
+    # Pops due rows of the reminder plan written when attributions are saved
     scheduler.add_job(
-        func=check_court_terme_reminders,
-        trigger=CronTrigger(minute='*/30'),
-        id='check_court_terme_reminders',
-        name='Check court terme (short-term) loan reminders',
+        func=process_due_notifications,
+        trigger=CronTrigger(minute='*'),
+        id='process_due_notifications',
+        name='Queue due planned notifications',
         replace_existing=True,
     )
-    logger.info("Registered job: check_court_terme_reminders (every 30 min)")
+    logger.info("Registered job: process_due_notifications (every minute)")
     
-    # Moyen terme (Medium term): Check twice daily
-    # For loans 4-24 hours, remind at 2 hours before return
+    # Safety sweep: Daily at 8:30 AM
+    # Full scans catching loans written without a plan (bulk imports, raw updates)
     scheduler.add_job(
-        func=check_moyen_terme_reminders,
-        trigger=CronTrigger(hour='*/12'),
-        id='check_moyen_terme_reminders',
-        name='Check moyen terme (medium-term) loan reminders',
+        func=reminder_safety_sweep,
+        trigger=CronTrigger(hour=8, minute=30),
+        id='reminder_safety_sweep',
+        name='Reminder and overdue safety sweep',
         replace_existing=True,
     )
-    logger.info("Registered job: check_moyen_terme_reminders (every 12 hours)")
+    logger.info("Registered job: reminder_safety_sweep (daily at 8:30 AM)")
     
-    # Long terme (Long term): Check daily at 8 AM
-    # For loans > 24 hours, remind at J-2 and J-1
+    # Alert detection (incremental, watermark-based): Every 15 minutes
     scheduler.add_job(
-        func=check_long_terme_reminders,
-        trigger=CronTrigger(hour=8, minute=0),
-        id='check_long_terme_reminders',
-        name='Check long terme (long-term) loan reminders',
+        func=detect_alerts_incremental,
+        trigger=CronTrigger(minute='*/15'),
+        id='detect_alerts_incremental',
+        name='Incremental alert detection',
         replace_existing=True,
     )
-    logger.info("Registered job: check_long_terme_reminders (daily at 8:00 AM)")
+    logger.info("Registered job: detect_alerts_incremental (every 15 min)")
     
-    # Check for overdue materials: Every 15 minutes
+    # Dashboard snapshots: Every 5 minutes
     scheduler.add_job(
-        func=check_overdue_materials,
-        trigger=CronTrigger(minute='*/15'),
-        id='check_overdue_materials',
-        name='Check for overdue materials',
+        func=refresh_dashboard_snapshots,
+        trigger=CronTrigger(minute='*/5'),
+        id='refresh_dashboard_snapshots',
+        name='Refresh dashboard snapshots',
         replace_existing=True,
     )
-    logger.info("Registered job: check_overdue_materials (every 15 min)")
+    logger.info("Registered job: refresh_dashboard_snapshots (every 5 min)")
     
     # Cleanup old notifications: Daily at 2 AM
     # Remove old notification logs older than 90 days
@@ -134,6 +136,39 @@ def _register_jobs():
     )
     logger.info("Registered job: cleanup_old_notifications (daily at 2:00 AM)")
 
+    # Audit archival: Daily at 2:30 AM
+    # Old AuditLog rows move to compressed segment files, still readable from the report pages
+    scheduler.add_job(
+        func=archive_audit_logs,
+        trigger=CronTrigger(hour=2, minute=30),
+        id='archive_audit_logs',
+        name='Archive old audit logs',
+        replace_existing=True,
+    )
+    logger.info("Registered job: archive_audit_logs (daily at 2:30 AM)")
+
+    # Report PDF cache: Every 5 minutes
+    # Renders the PDF of new audit rows ahead of the first download
+    scheduler.add_job(
+        func=pregenerate_report_pdfs,
+        trigger=CronTrigger(minute='*/5'),
+        id='pregenerate_report_pdfs',
+        name='Pre-generate report PDFs',
+        replace_existing=True,
+    )
+    logger.info("Registered job: pregenerate_report_pdfs (every 5 min)")
+
+    # Audit exports: Every minute
+    # Writes the archives requested from the report pages (the web processes only record the request)
+    scheduler.add_job(
+        func=process_audit_exports,
+        trigger=CronTrigger(minute='*'),
+        id='process_audit_exports',
+        name='Write requested audit exports',
+        replace_existing=True,
+    )
+    logger.info("Registered job: process_audit_exports (every minute)")
+
 
 def get_scheduler_status():
     """Get current scheduler status"""
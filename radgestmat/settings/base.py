@@ -290,3 +290,26 @@ CACHES = {
 FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5 MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5 MB
 
+
+# Audit trail: models left out of AuditLog entirely (high-churn rows such as
+# notification status flips), as "app_label.ModelName"
+AUDIT_EXCLUDED_MODELS = get_csv(
+    'AUDIT_EXCLUDED_MODELS',
+    default='assets.NotificationLog,assets.NotificationPlanifiee',
+)
+
+# Audit archival: rows older than AUDIT_ARCHIVE_APRES_JOURS move to compressed
+# segment files under AUDIT_ARCHIVE_DIR (manage.py archiver_audit, daily job)
+AUDIT_ARCHIVE_DIR = get_config('AUDIT_ARCHIVE_DIR', default=str(BASE_DIR / 'archives' / 'audit'))
+AUDIT_ARCHIVE_APRES_JOURS = get_config('AUDIT_ARCHIVE_APRES_JOURS', default=180, cast=int)
+
+# Report PDF cache (see assets/rapport_pdf_service.py)
+REPORT_PDF_CACHE_DIR = get_config('REPORT_PDF_CACHE_DIR', default=str(BASE_DIR / 'cache' / 'rapports_pdf'))
+
+# Bulk audit export (see assets/export_audit_service.py): exports requested from the
+# report pages are written by the scheduler under AUDIT_EXPORT_DIR and kept
+# AUDIT_EXPORT_CONSERVATION_JOURS days; PDF rendering processes of the scheduler,
+# 0 to render in the scheduler's own process
+AUDIT_EXPORT_DIR = get_config('AUDIT_EXPORT_DIR', default=str(BASE_DIR / 'exports' / 'audit'))
+AUDIT_EXPORT_CONSERVATION_JOURS = get_config('AUDIT_EXPORT_CONSERVATION_JOURS', default=7, cast=int)
+AUDIT_EXPORT_PROCESSUS = get_config('AUDIT_EXPORT_PROCESSUS', default=4, cast=int)
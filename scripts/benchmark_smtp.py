@@ -0,0 +1,90 @@
+"""
+Benchmark de l'envoi d'emails contre un serveur SMTP local factice.
+
+Compare une session SMTP par message (ancien comportement de `send_mail`) et une
+connexion partagée par lot (ConnexionEmailPartagee, utilisée par le worker de l'outbox).
+--latence simule le coût d'établissement d'une session (réseau + TLS) en millisecondes.
+
+Usage: python scripts/benchmark_smtp.py [--messages 200] [--latence 20]
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'radgestmat.settings')
+
+import django
+django.setup()
+
+from django.core.mail import EmailMessage, get_connection, send_mail
+from assets.email_service import ConnexionEmailPartagee
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """Serveur SMTP minimal: accepte tout et jette les messages"""
+    latence = 0.0
+
+    def ecrire(self, ligne):
+        self.wfile.write(ligne.encode() + b'\r\n')
+
+    def handle(self):
+        time.sleep(self.latence)
+        self.ecrire('220 stub ESMTP')
+        while True:
+            ligne = self.rfile.readline()
+            if not ligne:
+                return
+            commande = ligne.decode(errors='replace').strip().upper()
+            if commande.startswith(('EHLO', 'HELO')):
+                self.ecrire('250 stub')
+            elif commande == 'DATA':
+                self.ecrire('354 fin par <CRLF>.<CRLF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.ecrire('250 OK')
+            elif commande == 'QUIT':
+                self.ecrire('221 Bye')
+                return
+            else:
+                self.ecrire('250 OK')
+
+
+def connexion(port):
+    return get_connection('django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1', port=port,
+                          use_tls=False, use_ssl=False, username='', password='', fail_silently=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--latence', type=float, default=20.0, help='ms par ouverture de session')
+    args = parser.parse_args()
+
+    StubSMTPHandler.latence = args.latence / 1000
+    serveur = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubSMTPHandler)
+    serveur.daemon_threads = True
+    port = serveur.server_address[1]
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+
+    debut = time.perf_counter()
+    for i in range(args.messages):
+        send_mail(f'Test {i}', 'Corps', 'noreply@example.com', ['dest@example.com'], connection=connexion(port))
+    avant = args.messages / (time.perf_counter() - debut)
+
+    with ConnexionEmailPartagee(connexion(port)) as partagee:
+        for i in range(args.messages):
+            partagee.envoyer(EmailMessage(f'Test {i}', 'Corps', 'noreply@example.com', ['dest@example.com']))
+    apres = partagee.metriques()['debit']
+
+    serveur.shutdown()
+    print(f"{args.messages} messages, latence de session {args.latence} ms")
+    print(f"  une session par message : {avant:8.1f} msg/s")
+    print(f"  connexion partagée      : {apres:8.1f} msg/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import sys
 import django
 import json
 
@@ -7,11 +8,14 @@ django.setup()
 
 from assets.services import AlerteService
 
-res = AlerteService.detecter_toutes_alertes()
+# --incremental: ne réévaluer que ce qui a changé depuis le dernier passage
+res = AlerteService.detecter_toutes_alertes(incremental='--incremental' in sys.argv)
 
 summary = {
     'total': res.get('total'),
-    'counts': {k: len(v) if isinstance(v, list) else 0 for k, v in res.items()}
+    'counts': {k: len(v) for k, v in res.items() if isinstance(v, list)},
+    'stats': res.get('stats'),
+    'modes': res.get('modes'),
 }
 print(json.dumps(summary, indent=2, default=str))
 